@@ -1,5 +1,6 @@
 import os
 import boto3
+import httpx
 from contextvars import ContextVar
 from dotenv import load_dotenv
 
@@ -11,6 +12,40 @@ APP_NAME = "chatbot"
 REQUEST_ID_CONTEXT = ContextVar("trace_id", default="N/A")
 
 CHAT_CALLBACK_URL = os.getenv("CHAT_CALLBACK_URL", "http://localhost:3000")
+# 判断是否需要搜索的同时就先发起搜索，不需要时丢弃结果，用搜索费用换延迟（每条文字消息都会搜索一次）；
+# 同步模式下预先发起的搜索在单独的几个线程里执行，都在忙时不再预先发起
+CHAT_SPECULATIVE_SEARCH = os.getenv("CHAT_SPECULATIVE_SEARCH", "false").lower() == "true"
+CHAT_SPECULATIVE_SEARCH_WORKERS = int(os.getenv("CHAT_SPECULATIVE_SEARCH_WORKERS", 4))
+# 是否搜索直接基于原始问题判断，不等历史压缩和问题重写
+CHAT_FAST_SEARCH_DECISION = os.getenv("CHAT_FAST_SEARCH_DECISION", "false").lower() == "true"
+# 流式获取最终回复，按段落/句子切分后逐条发送；句子至少多少字才切
+CHAT_STREAM = os.getenv("CHAT_STREAM", "false").lower() == "true"
+CHAT_STREAM_MIN_CHARS = int(os.getenv("CHAT_STREAM_MIN_CHARS", 40))
+# 最终 completion 的输入 token 预算，以及 token 估算方式：heuristic | tiktoken（需另外安装）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+CONTEXT_TOKEN_ESTIMATOR = os.getenv("CONTEXT_TOKEN_ESTIMATOR", "heuristic")
+# 回调并发发送的线程数、超时（秒）、重试次数
+CHAT_CALLBACK_WORKERS = int(os.getenv("CHAT_CALLBACK_WORKERS", 10))
+CHAT_CALLBACK_TIMEOUT = float(os.getenv("CHAT_CALLBACK_TIMEOUT", 10))
+CHAT_CALLBACK_RETRIES = int(os.getenv("CHAT_CALLBACK_RETRIES", 5))
+# 重试后还是发送失败的回复放回队列，每失败一次等待时间翻倍，最长多少秒
+CHAT_CALLBACK_REQUEUE_MAX_DELAY = int(os.getenv("CHAT_CALLBACK_REQUEUE_MAX_DELAY", 300))
+# 同一个 session 积压的回复最多合并多少条为一次回调，1 为不合并
+CHAT_CALLBACK_BATCH_SIZE = int(os.getenv("CHAT_CALLBACK_BATCH_SIZE", 1))
+# 并发处理对话的线程数
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", 5))
+# 开启后 chatflow 在 fastapi 的 event loop 上以协程方式运行，网络请求不再占用线程
+CHAT_ASYNC_MODE = os.getenv("CHAT_ASYNC_MODE", "false").lower() == "true"
+# 准入控制：全局 session 数、全局积压消息数、单 session 积压消息数上限，
+# 群聊在达到全局上限的 ADMISSION_GROUP_SHARE 比例时就开始拒绝，单 session 超限时丢弃最旧的群聊消息
+ADMISSION_MAX_SESSIONS = int(os.getenv("ADMISSION_MAX_SESSIONS", 10000))
+ADMISSION_MAX_QUEUED_MESSAGES = int(os.getenv("ADMISSION_MAX_QUEUED_MESSAGES", 50000))
+ADMISSION_MAX_SESSION_MESSAGES = int(os.getenv("ADMISSION_MAX_SESSION_MESSAGES", 20))
+ADMISSION_GROUP_SHARE = float(os.getenv("ADMISSION_GROUP_SHARE", 0.8))
+# 启动时以及之后每隔 QUEUE_RECOVER_INTERVAL_SECONDS 秒（0 只在启动时）重放还没处理完的消息和没发出去的回复，
+# 只重放这么多秒之前收到的，留给其他实例正在 debounce 的消息
+QUEUE_RECOVER_GRACE_SECONDS = int(os.getenv("QUEUE_RECOVER_GRACE_SECONDS", 60))
+QUEUE_RECOVER_INTERVAL_SECONDS = int(os.getenv("QUEUE_RECOVER_INTERVAL_SECONDS", 60))
 
 # files storage
 LOCAL_TEMP_FILE_PATH_BASE = os.getenv(
@@ -33,4 +68,101 @@ s3_client = boto3.client(
     config=boto3.session.Config(s3={"addressing_style": "path"}),
 )
 
-ZHIPUAI_API_KEY = os.getenv("ZHIPUAI_API_KEY", "")
\ No newline at end of file
+ZHIPUAI_API_KEY = os.getenv("ZHIPUAI_API_KEY", "")
+ZHIPUAI_BASE_URL = os.getenv("ZHIPUAI_BASE_URL", "https://open.bigmodel.cn/api/paas/v4")
+# 历史压缩、问题重写、是否搜索这些小任务用谁回答：ddgs（免费）| openai（走 OPENAI_BASE_URL）
+CHAT_CONSIDER_BACKEND = os.getenv("CHAT_CONSIDER_BACKEND", "ddgs")
+
+# 共享的 http 连接池，openai / 搜索 / 回调都复用
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 200))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 50))
+http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(300, connect=10),
+)
+async_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(300, connect=10),
+)
+
+# ai_consider 结果缓存：条数上限（0 关闭）、过期秒数、是否使用数据库共享给其他实例
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 2048))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 600))
+LLM_CACHE_SHARED = os.getenv("LLM_CACHE_SHARED", "false").lower() == "true"
+
+# 最终回复的模型路由：短的纯文字闲聊用快模型，其余用强模型；快模型的回答不合格时升级
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4o-mini")
+LLM_STRONG_MODEL = os.getenv("LLM_STRONG_MODEL", "gpt-4o")
+LLM_ROUTE_SHORT_CHARS = int(os.getenv("LLM_ROUTE_SHORT_CHARS", 30))
+
+# 超时与截止时间（秒）：单次 llm 请求、一次 llm 调用（含重试）、一轮对话（收到消息到回复）
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", 90))
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", 180))
+# processing / sending 的消息超过这么多秒还没结束才视为抢占它的实例已经崩溃，
+# 要比 CHAT_DEADLINE 和回调重试的总耗时都长，否则会重放其他实例还在处理的对话
+QUEUE_RECOVER_STALE_SECONDS = int(os.getenv("QUEUE_RECOVER_STALE_SECONDS", CHAT_DEADLINE + 60))
+# hedge：请求超过该模型最近耗时的分位数（不低于最小延迟）还没返回时，再发一个相同的请求，先返回的为准
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 1))
+
+# 是否搜索的判断跨 session 攒批：第一个请求最多等多少毫秒、一批最多几个问题、同时最多几批在请求
+CONSIDER_BATCH = os.getenv("CONSIDER_BATCH", "false").lower() == "true"
+CONSIDER_BATCH_WINDOW_MS = int(os.getenv("CONSIDER_BATCH_WINDOW_MS", 10))
+CONSIDER_BATCH_MAX_SIZE = int(os.getenv("CONSIDER_BATCH_MAX_SIZE", 16))
+CONSIDER_BATCH_WORKERS = int(os.getenv("CONSIDER_BATCH_WORKERS", 4))
+
+# 搜索结果缓存：条数上限（0 关闭）、默认过期秒数、按搜索意图覆盖的过期秒数（意图=秒,...）
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 1800))
+SEARCH_CACHE_INTENT_TTL = os.getenv(
+    "SEARCH_CACHE_INTENT_TTL", "天气=300,新闻=300,体育=300,财经=60,股票=60,百科=86400,历史=86400"
+)
+
+# 同时向智谱和 DDGS 搜索，超时（秒）内返回的结果去重合并；搜索结果按与问题的相关度保留前几条（0 不排序不裁剪）
+SEARCH_FANOUT = os.getenv("SEARCH_FANOUT", "false").lower() == "true"
+SEARCH_FANOUT_TIMEOUT = float(os.getenv("SEARCH_FANOUT_TIMEOUT", 8))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", 6))
+
+# 链接抓取：后台线程数、连接 / 读取 / 总超时（秒）、最多读取的字节数、正文最多保留的字数
+LINK_FETCH_WORKERS = int(os.getenv("LINK_FETCH_WORKERS", 8))
+LINK_CONNECT_TIMEOUT = float(os.getenv("LINK_CONNECT_TIMEOUT", 5))
+LINK_READ_TIMEOUT = float(os.getenv("LINK_READ_TIMEOUT", 10))
+LINK_TOTAL_TIMEOUT = float(os.getenv("LINK_TOTAL_TIMEOUT", 20))
+LINK_MAX_BYTES = int(os.getenv("LINK_MAX_BYTES", 2 * 1024 * 1024))
+LINK_MAX_CHARS = int(os.getenv("LINK_MAX_CHARS", 20000))
+
+# 链接抓取结果按归一化的 url 缓存在数据库里，多个会话共享；过期（秒）后用 ETag / Last-Modified 重新验证
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", 24 * 3600))
+
+# 图片缩放：长边像素、输出格式（JPEG | WEBP）、质量，在几个进程里执行（0 在接口线程里执行）
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 512))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 75))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", min(os.cpu_count() or 1, 4)))
+
+# 图片等附件按 sha256 去重存储：存在库里（db）| 本地磁盘（disk）| s3；进程内缓存热点内容的字节数上限
+BLOB_STORAGE = os.getenv("BLOB_STORAGE", "db")
+BLOB_CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", 64 * 1024 * 1024))
+
+# 给 llm 的图片：data（base64 内联）| presigned（上传 s3 后给预签名链接）| public（S3_ENDPOINT_DOMAIN 下的公开链接）；
+# 链接要能被 llm 服务访问到，失败时退回 data。预签名有效秒数、内联 data url 的进程内缓存字节数
+IMAGE_URL_MODE = os.getenv("IMAGE_URL_MODE", "data")
+IMAGE_URL_EXPIRES = int(os.getenv("IMAGE_URL_EXPIRES", 3600))
+IMAGE_DATA_URL_CACHE_BYTES = int(os.getenv("IMAGE_DATA_URL_CACHE_BYTES", 32 * 1024 * 1024))
+
+# completion 审计记录里超过这么多字节的请求 / 回复用 zstd 压缩后保存（0 不压缩，需要安装 zstandard）
+AUDIT_ZSTD_MIN_BYTES = int(os.getenv("AUDIT_ZSTD_MIN_BYTES", 0))
+
+# 回复消息和 completion 记录先放进缓冲区，由后台线程每隔多少毫秒或攒满多少条批量写库，不阻塞回复
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", 200))
+WRITE_BEHIND_MAX_SIZE = int(os.getenv("WRITE_BEHIND_MAX_SIZE", 200))
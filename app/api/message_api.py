@@ -1,19 +1,20 @@
-import io
-import shortuuid
-import requests
-from typing import Tuple
-from bs4 import BeautifulSoup
+from typing import Optional, Tuple
 from datetime import datetime
-from fastapi import APIRouter, Depends, File, Path, UploadFile, Form, BackgroundTasks
-from PIL import Image
+from fastapi import APIRouter, File, UploadFile, Form
 
+from app import ADMISSION_MAX_SESSION_MESSAGES
 from app.core import message_receive_queue, message_reply_queue
-from app.database import save_entity
+from app.database import session_scope
+from app.errors import RateLimitException, TOO_MANY_MESSAGES
 from app.model import message as msg_storage
 from app.model.message import Message, MessageExtra
 from app.logging_ import logger
-from app.utils import datetime_string, get_file_extension, file_relative_path
-from app.service import file as file_service
+from app.service import blob as blob_service
+from app.service import image as image_service
+from app.service import link as link_service
+from app.service.chatflow import search_decision_batcher, write_behind
+from app.service.llm import consider_cache, model_router, hedger
+from app.service.net_search import search_cache
 
 router = APIRouter()
 
@@ -48,70 +49,87 @@ def receive_msg(
         type_, content, from_username, to_username, session_id, is_group
     )
     if reply_message:
-        message_reply_queue.send(session_id, reply_message.id)
+        # 清除记忆、写入消息和回复在同一个事务里；不进接收队列，积压再多也不拒绝
+        with session_scope() as db:
+            if messaged.is_clear:
+                msg_storage.clear_messages(db, session_id)
+            db.add_all([messaged, reply_message])
+        message_reply_queue.send(session_id, reply_message.id, reply_message.content)
         return
 
+    retry_after = message_receive_queue.admit(session_id, is_group)
+    if retry_after is not None:
+        logger.warning(f"reject message from {session_id}, retry after {retry_after}s")
+        raise RateLimitException(TOO_MANY_MESSAGES, retry_after=retry_after)
+
     content_meta = None
-    content_bytes = b""
+    blob_digest = None
     if uploaded_file:
         file_content_type = uploaded_file.content_type
         file_size = uploaded_file.size
         file_name = uploaded_file.filename
-        # relate_path = f"{type_}/{session_id}/{datetime_string()}_{shortuuid.uuid()}{get_file_extension(file_name)}"
-        # local_path, s3_path = file_service.upload(uploaded_file.file.read(), relate_path)
         content_meta = {
             "type": type_,
             "content_type": file_content_type,
             "size": file_size,
             "file_name": file_name,
-            # "relate_path": relate_path,
-            # "local_path": local_path,
-            # "s3_path": s3_path,
         }
     # content包含链接??
     if type_ == "pic":
-        # resize
-        # 获取原始宽高
-        img = Image.open(uploaded_file.file)
-        img = img.convert("RGB")
-        original_width, original_height = img.size
-        # 计算缩放比例
-        scaling_factor = min(512 / original_width, 512 / original_height)
-
-        # 确定新尺寸，保持比例
-        new_width = int(original_width * scaling_factor)
-        new_height = int(original_height * scaling_factor)
-
-        content_meta["resize_pixels"] = f"{new_width}*{new_height}"
-        content_meta["real_pixels"] = f"{img.width}*{img.height}"
-        bio = io.BytesIO()
-        img.resize((new_width, new_height), Image.LANCZOS).save(bio, format="JPEG")
-        content_bytes = bio.getvalue()
-        bio.close()
-    if type_ == "link":
-        content_meta = {"link": content}
-        # scratch text data
-        response = requests.get(content)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, "html.parser")
-            text = soup.get_text(separator="\n", strip=True)
-            logger.info(f"scratch from url: {content}, data: {text}")
-            content_bytes = text.encode("UTF-8")
-
-    if content_meta and content_bytes:
-        msg_extra = MessageExtra(
-            message_id=messaged.id,
-            content_meta=content_meta,
-            content_bytes=content_bytes,
-        )
-        save_entity(msg_extra)
+        image = image_service.resize(uploaded_file.file.read())
+        content_meta["resize_pixels"] = f"{image.width}*{image.height}"
+        content_meta["real_pixels"] = f"{image.original_width}*{image.original_height}"
+        content_meta["resize_content_type"] = image.content_type
+        content_meta["frames"] = image.frames
+        blob_digest = blob_service.put(image.data, image.content_type)
+
+    # 消息和附件一次提交，附件的 message_id 由关系在 flush 时填上
+    with session_scope() as db:
+        if content_meta and blob_digest:
+            messaged.message_extra = MessageExtra(content_meta=content_meta, blob_digest=blob_digest)
+        db.add(messaged)
+
+    if messaged.type_ == "link":
+        # 后台抓取，不等页面下载完就返回；chat 处理前会等待抓取结果
+        link_service.prefetch(messaged.id, content)
+
+    # 群聊刷屏时丢弃最旧的积压消息，私聊已在准入时拒绝
+    shed = message_receive_queue.send(
+        session_id,
+        messaged.id,
+        delay={"pic": 7}.get(type_, 1),
+        max_pending=ADMISSION_MAX_SESSION_MESSAGES if is_group else None,
+    )
+    if shed:
+        msg_storage.update_state(shed, msg_storage.STATE_DROPPED)
 
-    message_receive_queue.send(session_id, messaged.id, delay={"pic": 7}.get(type_, 1))
+
+@router.get(
+    "/messages/stats",
+    tags=["Messages"],
+)
+def queue_stats() -> dict:
+    """
+    消息队列、缓存的实时状态，用于观察积压情况
+    """
+    return {
+        "receive": message_receive_queue.stats(),
+        "reply": message_reply_queue.stats(),
+        "llm_cache": consider_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "link_cache": link_service.stats(),
+        "blob_cache": blob_service.blob_cache.stats(),
+        "image_data_url_cache": blob_service.data_url_cache.stats(),
+        "write_behind": write_behind.stats() if write_behind else None,
+        "model_router": model_router.stats(),
+        "hedge": hedger.stats(),
+        "search_decision_batch": search_decision_batcher.stats() if search_decision_batcher else None,
+    }
 
 
 def _decorate_message(
     type_, content, from_username, to_username, session_id, is_group
-) -> Tuple[Message, "ReplyMessage"]:
+) -> Tuple[Message, Optional[Message]]:
     is_clear = False
     reply_msg = None
 
@@ -121,7 +139,6 @@ def _decorate_message(
         # 清除记忆
         type_ = "func"
         is_clear = True
-        msg_storage.clear_messages(session_id)
         reply_msg = Message(
             type_=type_,
             content="我已经忘了之前聊过的内容了",
@@ -130,6 +147,7 @@ def _decorate_message(
             session_id=session_id,
             is_group=is_group,
             is_clear=is_clear,
+            state=msg_storage.STATE_UNSENT,
             created_at=datetime.now(),
         )
 
@@ -141,11 +159,8 @@ def _decorate_message(
         session_id=session_id,
         is_group=is_group,
         is_clear=is_clear,
+        state=msg_storage.STATE_PROCESSED if is_clear else msg_storage.STATE_PENDING,
         created_at=datetime.now(),
     )
 
-    save_entity(msg)
-    if reply_msg:
-        save_entity(reply_msg)
-
     return msg, reply_msg
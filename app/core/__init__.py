@@ -1,92 +1,427 @@
-from typing import Dict, List, Any
-from copy import deepcopy
-from collections import defaultdict
+import asyncio
+import heapq
+import math
+import multiprocessing
 import time
-from threading import Thread, Lock
-from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Awaitable, Callable, Dict, List, Any, NamedTuple, Optional, Tuple
+from threading import Thread, Lock, Condition
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from app import (
+    CHAT_WORKERS,
+    CHAT_CALLBACK_WORKERS,
+    CHAT_SPECULATIVE_SEARCH_WORKERS,
+    CONSIDER_BATCH_WORKERS,
+    LINK_FETCH_WORKERS,
+    IMAGE_WORKERS,
+    QUEUE_RECOVER_GRACE_SECONDS,
+    QUEUE_RECOVER_INTERVAL_SECONDS,
+    QUEUE_RECOVER_STALE_SECONDS,
+    ADMISSION_MAX_SESSIONS,
+    ADMISSION_MAX_QUEUED_MESSAGES,
+    ADMISSION_MAX_SESSION_MESSAGES,
+    ADMISSION_GROUP_SHARE,
+)
 from app.utils import current_timestamp
 
 
-executor = ThreadPoolExecutor(max_workers=5)
+executor = ThreadPoolExecutor(max_workers=CHAT_WORKERS, thread_name_prefix="chat_worker")
+# chat 内部各阶段并发执行用，每个对话同时最多有几个阶段在跑
+stage_executor = ThreadPoolExecutor(
+    max_workers=CHAT_WORKERS * 4, thread_name_prefix="chat_stage"
+)
+reply_executor = ThreadPoolExecutor(
+    max_workers=CHAT_CALLBACK_WORKERS, thread_name_prefix="reply_worker"
+)
+# 收到链接消息后在后台抓取页面，不占用接口的线程
+link_executor = ThreadPoolExecutor(
+    max_workers=LINK_FETCH_WORKERS, thread_name_prefix="link_fetcher"
+)
+# 多个搜索来源并发请求
+search_executor = ThreadPoolExecutor(
+    max_workers=CHAT_WORKERS * 2, thread_name_prefix="search_worker"
+)
+# 预先发起的搜索单独一个小线程池，上游搜索变慢时不会占住 chat 各阶段共用的 stage_executor
+speculative_executor = ThreadPoolExecutor(
+    max_workers=CHAT_SPECULATIVE_SEARCH_WORKERS, thread_name_prefix="speculative_search"
+)
+# 攒批后的请求单独一个线程池：等批结果的调用方占着 stage_executor，批本身再排进去可能一直轮不到，直到截止时间
+batch_executor = ThreadPoolExecutor(
+    max_workers=CONSIDER_BATCH_WORKERS, thread_name_prefix="micro_batch"
+)
+# hedge 的 llm 请求在这里执行，调用方线程只等待先返回的那个
+hedge_executor = ThreadPoolExecutor(
+    max_workers=CHAT_WORKERS * 4, thread_name_prefix="llm_hedge"
+)
+# 图片解码缩放是 CPU 密集的，放到子进程里；用 spawn，避免 fork 时带上其他线程持有的锁
+image_executor = (
+    ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    if IMAGE_WORKERS > 0
+    else None
+)
+
+
+class ReplyItem(NamedTuple):
+    """待发送的回复，内容随队列携带，发送时不用再查库"""
+
+    session_id: str
+    msg_id: int
+    content: str
+    # 已经发送失败了几次，决定重新入队后等多久
+    attempts: int = 0
+    # 本进程刚生成的回复，写库时就是 sending，发送前不用再去数据库抢占
+    claimed: bool = False
 
 
 class TimedList:
+    """
+    session 内等待合并的消息，每次 append 都会把 flush 的截止时间往后推 delay 秒
+    """
 
-    _create_at: int
+    # session 数量可能很大，不需要 __dict__
+    __slots__ = ("_deadline", "_list_")
+
+    _deadline: int
     _list_: List[Any]
 
     def __init__(self):
-        self._create_at = current_timestamp()
+        self._deadline = current_timestamp()
         self._list_ = []
 
-    def append(self, element, *, delay: int = 3):
+    def __len__(self):
+        return len(self._list_)
+
+    def __iter__(self):
+        return iter(self._list_)
+
+    @property
+    def deadline(self) -> int:
+        return self._deadline
+
+    def append(self, element, *, delay: int = 3) -> int:
+        """
+        :return: 新的 flush 截止时间（毫秒）
+        """
+        if not self._list_:
+            # 空列表从现在开始计时，避免长时间空闲后消息被立刻 flush
+            self._deadline = max(self._deadline, current_timestamp())
         self._list_.append(element)
-        self._create_at += delay * 1000
+        self._deadline += delay * 1000
+        return self._deadline
 
-    def clear(self) -> List[Any]:
-        if self._create_at < current_timestamp():
-            pop_list = self._list_
-            self._list_ = []
-            self._create_at = current_timestamp()
-            return pop_list
-        return []
+    def requeue(self, elements: List[Any], *, delay: int) -> int:
+        """
+        放回队首，保证排在处理期间新来的元素之前；至少 delay 秒后才 flush
+        :return: 新的 flush 截止时间（毫秒）
+        """
+        self._list_[:0] = elements
+        self._deadline = max(self._deadline, current_timestamp() + delay * 1000)
+        return self._deadline
+
+    def pop_oldest(self) -> Any:
+        return self._list_.pop(0)
 
+    def clear(self) -> List[Any]:
+        pop_list = self._list_
+        self._list_ = []
+        self._deadline = current_timestamp()
+        return pop_list
 
 
 class MessageReceiveQueue:
+    """
+    按 session 合并消息后交给 chat 处理。
+
+    用小顶堆保存每个 session 的 flush 截止时间，配合条件变量等待最近的截止时间，
+    没有轮询；到期的 session 丢给线程池并发处理，同一个 session 同时只有一个 chat 在跑，
+    跑的过程中新来的消息会在结束后再调度，保证 session 内的顺序。
+    session 处理完且没有新消息时立即从内存移除，空闲 session 不占内存。
 
-    lock = Lock() # 反正单机的，简单标志就行
-    session_id_to_msgs : Dict[str, TimedList] = defaultdict(TimedList)
+    绑定 event loop 后（CHAT_ASYNC_MODE），到期的 session 以协程方式提交到该 loop 上执行，
+    不再占用线程池。
 
-    def send(self, session_id, msg, delay=3):
-        if session_id not in self.session_id_to_msgs:
-            with self.lock:
-                self.session_id_to_msgs[session_id].append(msg, delay=delay)
-        self.session_id_to_msgs[session_id].append(msg, delay=delay)
+    admit 做准入控制：全局 session 数、全局积压消息数、单 session 积压消息数超限时拒绝，
+    群聊在达到全局上限的 ADMISSION_GROUP_SHARE 时就开始拒绝，保证私聊优先。
+    """
+
+    def __init__(
+        self,
+        handler: Optional[Callable[[List[Any]], None]] = None,
+        pool: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.lock = Lock()  # 反正单机的，简单标志就行
+        self.cond = Condition(self.lock)
+        self.session_id_to_msgs: Dict[str, TimedList] = {}
+        # (deadline, session_id)，deadline 与 TimedList 不一致的是过期条目，弹出时直接丢弃
+        self._deadlines: List[Tuple[int, str]] = []
+        # 处理中的 session 和交给它的那批消息
+        self._running: Dict[str, List[Any]] = {}
+        # 还没开始处理的消息数，包括已经派发、还在线程池里排队的
+        self._queued = 0
+        # 到期后等了多久 worker 才开始处理，指数移动平均，毫秒
+        self._wait_ms_avg = 0.0
+        self._wait_ms_max = 0
+        self._handler = handler
+        self._pool = pool or executor
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_handler: Optional[Callable[[List[Any]], Awaitable[None]]] = None
+
+    def bind_loop(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        async_handler: Optional[Callable[[List[Any]], Awaitable[None]]] = None,
+    ):
+        if async_handler is None:
+            async_handler = self._default_async_handler()
+        self._async_handler = async_handler
+        self._loop = loop
+
+    def admit(self, session_id: str, is_group: bool = False) -> Optional[int]:
+        """
+        判断是否还能接收该 session 的消息
+        :return: None 表示可以接收，否则为建议的重试等待秒数
+        """
+        share = ADMISSION_GROUP_SHARE if is_group else 1.0
+        with self.cond:
+            tls_ = self.session_id_to_msgs.get(session_id)
+            if tls_ is None and len(self.session_id_to_msgs) >= ADMISSION_MAX_SESSIONS * share:
+                return self._retry_after()
+            if self._queued >= ADMISSION_MAX_QUEUED_MESSAGES * share:
+                return self._retry_after()
+            if tls_ is not None and len(tls_) >= ADMISSION_MAX_SESSION_MESSAGES and not is_group:
+                return self._retry_after()
+            return None
+
+    def send(self, session_id, msg, delay=3, max_pending: Optional[int] = None) -> List[Any]:
+        """
+        :param max_pending: session 内积压超过该数量时丢弃最旧的消息，用于群聊刷屏
+        :return: 被丢弃的消息
+        """
+        shed = []
+        with self.cond:
+            tls_ = self.session_id_to_msgs.get(session_id)
+            if tls_ is None:
+                tls_ = self.session_id_to_msgs[session_id] = TimedList()
+            while max_pending is not None and len(tls_) >= max(max_pending, 1):
+                shed.append(tls_.pop_oldest())
+                self._queued -= 1
+            deadline = tls_.append(msg, delay=delay)
+            self._queued += 1
+            if session_id not in self._running:
+                heapq.heappush(self._deadlines, (deadline, session_id))
+                self.cond.notify()
+        return shed
 
     def _proceed(self):
-        from app.service.chatflow import chat
+        while True:
+            with self.cond:
+                session_id, msgs, deadline = self._next_ready()
+                self._running[session_id] = msgs
+            self._dispatch(session_id, msgs, deadline)
 
+    def _dispatch(self, session_id: str, msgs: List[Any], deadline: int):
+        if self._loop is None:
+            self._pool.submit(self._run, session_id, msgs, deadline)
+            return
+
+        future = asyncio.run_coroutine_threadsafe(self._arun(msgs, deadline), self._loop)
+        future.add_done_callback(lambda f: self._done(session_id, f.exception()))
+
+    def _next_ready(self) -> Tuple[str, List[Any], int]:
+        """阻塞直到有 session 到期，需持有锁调用"""
         while True:
-            with self.lock:
-                futures = []
-                for session_id, tls_ in self.session_id_to_msgs.items():
-                    msgs = tls_.clear()
-                    if len(msgs) > 0:
-                        # futures.append(executor.submit(chat, msgs))
-                        chat(msgs)
-                # for f in futures:
-                #     f.result()
-            time.sleep(0.1)
+            if not self._deadlines:
+                self.cond.wait()
+                continue
 
+            deadline, session_id = self._deadlines[0]
+            wait_ms = deadline - current_timestamp()
+            if wait_ms > 0:
+                self.cond.wait(wait_ms / 1000)
+                continue
 
-class MessageReplyQueue:
+            heapq.heappop(self._deadlines)
+            tls_ = self.session_id_to_msgs.get(session_id)
+            if (
+                tls_ is None
+                or len(tls_) == 0
+                or tls_.deadline != deadline
+                or session_id in self._running
+            ):
+                continue
+            return session_id, tls_.clear(), deadline
 
-    lock = Lock()
-    session_id_to_msgs : Dict[str, List[str]] = defaultdict(list)
+    def _started(self, msgs: List[Any], deadline: int):
+        """worker 开始处理这批消息，不再算作积压；记录到期后等了多久"""
+        wait_ms = max(current_timestamp() - deadline, 0)
+        with self.cond:
+            self._queued -= len(msgs)
+            self._wait_ms_avg = self._wait_ms_avg * 0.9 + wait_ms * 0.1
+            self._wait_ms_max = max(self._wait_ms_max, wait_ms)
 
-    def send(self, session_id, msg_id):
-        if session_id not in self.session_id_to_msgs:
-            with self.lock:
-                self.session_id_to_msgs[session_id].append(msg_id)
-        self.session_id_to_msgs[session_id].append(msg_id)
+    def _run(self, session_id: str, msgs: List[Any], deadline: int):
+        self._started(msgs, deadline)
+        error = None
+        try:
+            self._get_handler()(msgs)
+        except Exception as e:
+            error = e
+        finally:
+            self._done(session_id, error)
 
-    def _proceed(self):
+    async def _arun(self, msgs: List[Any], deadline: int):
+        self._started(msgs, deadline)
+        await self._async_handler(msgs)
+
+    def _done(self, session_id: str, error: Optional[BaseException] = None):
+        if error is not None:
+            from app.errors import log_exception
+
+            log_exception(error)
+        with self.cond:
+            self._running.pop(session_id, None)
+            tls_ = self.session_id_to_msgs.get(session_id)
+            if tls_ is None:
+                return
+            if len(tls_) > 0:
+                heapq.heappush(self._deadlines, (tls_.deadline, session_id))
+                self.cond.notify()
+            else:
+                # 处理期间没有新消息，直接移除，TimedList 为空时没有需要保留的状态
+                del self.session_id_to_msgs[session_id]
+
+    def resident(self) -> List[Any]:
+        """本进程持有的消息：等待合并的，以及已经交给 worker 还没处理完的"""
+        with self.cond:
+            msgs = [m for tls_ in self.session_id_to_msgs.values() for m in tls_]
+            msgs.extend(m for batch in self._running.values() for m in batch)
+            return msgs
+
+    def stats(self) -> Dict[str, int]:
+        """
+        队列的 gauge：常驻内存的 session 数、处理中的 session 数、还没开始处理的消息数，
+        以及到期后等待 worker 开始处理的时间（平均 & 自上次调用以来的最大值）
+        """
+        with self.cond:
+            wait_ms_max, self._wait_ms_max = self._wait_ms_max, 0
+            return {
+                "resident_sessions": len(self.session_id_to_msgs),
+                "running_sessions": len(self._running),
+                "queued_messages": self._queued,
+                "wait_ms_avg": int(self._wait_ms_avg),
+                "wait_ms_max": wait_ms_max,
+            }
+
+    def _retry_after(self) -> int:
+        """按当前的排队等待时间估算重试间隔，需持有锁调用"""
+        return max(1, math.ceil(self._wait_ms_avg / 1000))
+
+    def _get_handler(self) -> Callable[[List[Any]], None]:
+        if self._handler is None:
+            self._handler = self._default_handler()
+        return self._handler
+
+    def _default_handler(self) -> Callable[[List[Any]], None]:
+        from app.service.chatflow import chat
+
+        return chat
+
+    def _default_async_handler(self) -> Callable[[List[Any]], Awaitable[None]]:
+        from app.service.chatflow import achat
+
+        return achat
+
+
+class MessageReplyQueue(MessageReceiveQueue):
+    """
+    回复发送队列，复用 MessageReceiveQueue 的调度：不做 debounce，
+    session 内按入队顺序（FIFO）串行发送，不同 session 在 reply_executor 上并发；
+    发送时 session 内积压的回复会一次性交给 reply，由它决定是否合并发送
+    """
+
+    def __init__(
+        self,
+        handler: Optional[Callable[[List[ReplyItem]], None]] = None,
+        pool: Optional[ThreadPoolExecutor] = None,
+    ):
+        super().__init__(handler=handler, pool=pool or reply_executor)
+
+    def send(self, session_id, msg_id, content, claimed: bool = False):
+        super().send(session_id, ReplyItem(session_id, msg_id, content, claimed=claimed), delay=0)
+
+    def retry(self, items: List[ReplyItem], delay: int):
+        """发送失败的回复放回 session 队首，delay 秒后按原来的顺序重新发送"""
+        if not items:
+            return
+        session_id = items[0].session_id
+        with self.cond:
+            tls_ = self.session_id_to_msgs.get(session_id)
+            if tls_ is None:
+                tls_ = self.session_id_to_msgs[session_id] = TimedList()
+            deadline = tls_.requeue(items, delay=delay)
+            self._queued += len(items)
+            # 一般在 reply 里调用，session 还在 running，结束后由 _done 按新的截止时间调度
+            if session_id not in self._running:
+                heapq.heappush(self._deadlines, (deadline, session_id))
+                self.cond.notify()
+
+    def _default_handler(self) -> Callable[[List[ReplyItem]], None]:
         from app.service.chatflow import reply
 
-        while True:
-            with self.lock:
-                for session_id, msg_ids in self.session_id_to_msgs.items():
-                    if len(msg_ids) > 0:
-                        msg_id = msg_ids.pop()
-                        reply(msg_id)
-            time.sleep(0.1)
+        return reply
+
+    def _default_async_handler(self) -> Callable[[List[ReplyItem]], Awaitable[None]]:
+        from app.service.chatflow import areply
+
+        return areply
+
+
+def recover(grace_seconds: int = QUEUE_RECOVER_GRACE_SECONDS, stale_seconds: int = QUEUE_RECOVER_STALE_SECONDS):
+    """
+    重放未处理完的消息和未发送的回复。
+    只捞 grace_seconds 之前收到的，避免抢走其他实例正在 debounce 的消息；
+    processing / sending 的要被抢占超过 stale_seconds 才重放，避免重复处理其他实例还在跑的对话。
+    重复放进队列的消息和回复在处理前都要先抢占，只会处理一次；本进程队列里已经有的不再捞，也不改它们的状态
+    """
+    from datetime import datetime, timedelta
+    from app.logging_ import logger
+    from app.model import message as msg_storage
+
+    now = datetime.now()
+    inbound, outbound = msg_storage.recover_messages(
+        now - timedelta(seconds=grace_seconds),
+        now - timedelta(seconds=stale_seconds),
+        exclude=set(message_receive_queue.resident()) | {item.msg_id for item in message_reply_queue.resident()},
+    )
+    for m in inbound:
+        message_receive_queue.send(m.session_id, m.id, delay=0)
+    for m in outbound:
+        message_reply_queue.send(m.session_id, m.id, m.content)
+    if inbound or outbound:
+        logger.info(f"recovered {len(inbound)} pending messages, {len(outbound)} unsent replies")
+
+
+def recover_periodically(interval_seconds: int = QUEUE_RECOVER_INTERVAL_SECONDS):
+    """
+    启动时那一次只能捞到 grace_seconds 之前的消息，崩溃前几秒收到的、正在处理的要等过了宽限期再捞；
+    其他实例崩溃后留下的消息也靠这里接手
+    """
+    if interval_seconds <= 0:
+        return
+    while True:
+        time.sleep(interval_seconds)
+        try:
+            recover()
+        except Exception as e:
+            from app.errors import log_exception
+
+            log_exception(e)
 
 
+# 调度线程不阻止进程退出（包括导入了 app.core 的测试），没处理完的消息已经落库，由 recover 重放
 message_receive_queue = MessageReceiveQueue()
-_thread0 = Thread(name="message_queue_thread", target=message_receive_queue._proceed).start()
+_thread0 = Thread(name="message_queue_thread", target=message_receive_queue._proceed, daemon=True).start()
 
 
 message_reply_queue = MessageReplyQueue()
-_thread1 = Thread(name="message_reply_thread", target=message_reply_queue._proceed).start()
+_thread1 = Thread(name="message_reply_thread", target=message_reply_queue._proceed, daemon=True).start()
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from concurrent.futures import Executor, Future
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.core.deadline import remaining
+
+
+class MicroBatcher:
+    """
+    把短时间内来自不同 session 的同类小请求攒成一批，一次调用处理后按顺序把结果分发给各个调用方。
+
+    第一个请求到达后最多等 window_ms，或攒满 max_size 立即发出；批处理在 pool 上执行，
+    handler 返回的结果数量必须与请求数量一致，handler 抛出的异常会分发给这一批的所有调用方
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], List[Any]],
+        window_ms: int,
+        max_size: int,
+        pool: Executor,
+    ):
+        self._handler = handler
+        self._window = window_ms / 1000
+        self._max_size = max(max_size, 1)
+        self._pool = pool
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._items: List[Tuple[Any, Future]] = []
+        self._first_at = 0.0
+        self._thread: Optional[Thread] = None
+        self._counters = {"batches": 0, "items": 0, "max_batch": 0}
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = Thread(name="micro_batcher", target=self._proceed, daemon=True)
+                self._thread.start()
+            if not self._items:
+                self._first_at = time.monotonic()
+            self._items.append((item, future))
+            self._cond.notify()
+        return future
+
+    def run(self, item: Any) -> Any:
+        """阻塞等待结果，不超过当前的截止时间"""
+        return self.submit(item).result(timeout=remaining())
+
+    async def arun(self, item: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(item))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        counters["avg_batch"] = round(counters["items"] / counters["batches"], 2) if counters["batches"] else 0
+        return counters
+
+    def _proceed(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+                self._counters["batches"] += 1
+                self._counters["items"] += len(batch)
+                self._counters["max_batch"] = max(self._counters["max_batch"], len(batch))
+            self._pool.submit(self._execute, batch)
+
+    def _next_batch(self) -> List[Tuple[Any, Future]]:
+        """阻塞直到攒满或等待窗口结束，需持有锁调用"""
+        while True:
+            if not self._items:
+                self._cond.wait()
+                continue
+            wait = self._first_at + self._window - time.monotonic()
+            if len(self._items) < self._max_size and wait > 0:
+                self._cond.wait(wait)
+                continue
+            batch, self._items = self._items[: self._max_size], self._items[self._max_size :]
+            # 剩下的请求重新开始计时
+            self._first_at = time.monotonic()
+            return batch
+
+    def _execute(self, batch: List[Tuple[Any, Future]]):
+        try:
+            results = self._handler([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"batch handler returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from tenacity.stop import stop_base
+from tenacity.wait import wait_base
+
+# time.monotonic() 的绝对截止时间，随 context 传递：协程创建的 task、asyncio.to_thread 自动继承，
+# 线程池需要 copy_context 后提交（StageGraph.run 已处理）
+_DEADLINE_CONTEXT: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[float]:
+    """
+    在 seconds 秒内完成，嵌套时取更早的截止时间：对话的截止时间会约束其中每次调用的截止时间
+    """
+    at = time.monotonic() + seconds
+    outer = _DEADLINE_CONTEXT.get()
+    if outer is not None:
+        at = min(at, outer)
+    token = _DEADLINE_CONTEXT.set(at)
+    try:
+        yield at
+    finally:
+        _DEADLINE_CONTEXT.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """剩余秒数，没有截止时间时为 None"""
+    at = _DEADLINE_CONTEXT.get()
+    if at is None:
+        return None
+    return at - time.monotonic()
+
+
+def bounded_timeout(default: float) -> float:
+    """
+    单次请求的超时：不超过剩余时间；已经过了截止时间直接抛出，不再发请求
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left)
+
+
+class stop_at_deadline(stop_base):
+    """tenacity 的 stop：过了截止时间不再重试"""
+
+    def __call__(self, retry_state) -> bool:
+        left = remaining()
+        return left is not None and left <= 0
+
+
+class wait_within_deadline(wait_base):
+    """tenacity 的 wait：退避时间不超过剩余时间，避免睡过截止时间"""
+
+    def __init__(self, wait: wait_base):
+        self.wait = wait
+
+    def __call__(self, retry_state) -> float:
+        seconds = self.wait(retry_state)
+        left = remaining()
+        if left is None:
+            return seconds
+        return max(min(seconds, left), 0)
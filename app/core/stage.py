@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import inspect
+import time
+from threading import Lock
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class StageGraph:
+    """
+    按依赖关系并发执行的阶段图。
+
+    阶段函数的入参为依赖阶段的结果（按 deps 顺序），依赖必须先于自身 add，
+    因此 add 的顺序就是拓扑序。同一个图可以用 run 在线程池上执行，也可以用 arun 在 event loop 上执行，
+    arun 时阶段函数返回 awaitable 会被 await。
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Tuple[Callable[..., Any], Tuple[str, ...]]] = {}
+        # 阶段名 -> (开始, 结束)，相对图开始执行的秒数
+        self.timings: Dict[str, Tuple[float, float]] = {}
+        self._begin: Optional[float] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def add(self, name: str, fn: Callable[..., Any], deps: Tuple[str, ...] = ()):
+        for d in deps:
+            if d not in self._stages:
+                raise ValueError(f"stage {name} depends on unknown stage {d}")
+        self._stages[name] = (fn, tuple(deps))
+        return self
+
+    def run(self, pool: Executor) -> Dict[str, Future]:
+        """
+        依赖全部完成后才提交到线程池，不会有线程阻塞等待依赖；
+        阶段在调用方 context 的副本里执行，截止时间等 context 变量会传递下去
+        """
+        self._begin = time.perf_counter()
+        futures: Dict[str, Future] = {name: Future() for name in self._stages}
+        ctx = contextvars.copy_context()
+
+        def start(name: str):
+            fn, deps = self._stages[name]
+
+            def task():
+                started = time.perf_counter()
+                result, error = None, None
+                try:
+                    result = fn(*[futures[d].result() for d in deps])
+                except BaseException as e:
+                    error = e
+                # 先记录耗时再设置结果，设置结果会触发下游阶段
+                self.timings[name] = (started - self._begin, time.perf_counter() - self._begin)
+                if error is not None:
+                    futures[name].set_exception(error)
+                else:
+                    futures[name].set_result(result)
+
+            pool.submit(ctx.copy().run, task)
+
+        for name, (_, deps) in self._stages.items():
+            if not deps:
+                start(name)
+                continue
+
+            lock = Lock()
+            remaining = [len(deps)]
+
+            def on_dep_done(_, name=name, lock=lock, remaining=remaining):
+                with lock:
+                    remaining[0] -= 1
+                    ready = remaining[0] == 0
+                if ready:
+                    start(name)
+
+            for d in deps:
+                futures[d].add_done_callback(on_dep_done)
+        return futures
+
+    def arun(self) -> Dict[str, asyncio.Task]:
+        """
+        需要在 event loop 内调用
+        """
+        self._begin = time.perf_counter()
+
+        async def task(name: str):
+            fn, deps = self._stages[name]
+            args = [await self._tasks[d] for d in deps]
+            started = time.perf_counter()
+            try:
+                result = fn(*args)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            finally:
+                self.timings[name] = (started - self._begin, time.perf_counter() - self._begin)
+
+        for name in self._stages:
+            self._tasks[name] = asyncio.create_task(task(name))
+        return self._tasks
+
+    def cancel(self, name: str):
+        """取消不再需要的阶段（仅 arun），线程池里已开始的阶段无法取消，结果直接丢弃即可"""
+        t = self._tasks.get(name)
+        if t is None:
+            return
+        if not t.done():
+            t.cancel()
+        elif not t.cancelled():
+            # 标记异常已读取，避免 event loop 打印 never retrieved
+            t.exception()
+
+    def critical_path(self, sink: str) -> List[str]:
+        """
+        从 sink 往回找最晚结束的依赖，得到决定 sink 完成时间的阶段链
+        """
+        path = [sink]
+        while True:
+            deps = [d for d in self._stages[path[-1]][1] if d in self.timings]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda d: self.timings[d][1]))
+        return list(reversed(path))
+
+    def report(self, sinks: List[str]) -> str:
+        """
+        各阶段耗时以及 sinks 中最晚完成者的关键路径，用于日志
+        """
+        done = [s for s in sinks if s in self.timings]
+        stages = ", ".join(
+            [f"{n} {s * 1000:.0f}-{e * 1000:.0f}ms" for n, (s, e) in self.timings.items()]
+        )
+        if not done:
+            return stages
+        sink = max(done, key=lambda s: self.timings[s][1])
+        return (
+            f"{stages}; critical path {'>'.join(self.critical_path(sink))} "
+            f"{self.timings[sink][1] * 1000:.0f}ms"
+        )
@@ -0,0 +1,127 @@
+import time
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from app.logging_ import logger
+
+
+class WriteBehind:
+    """
+    写库不阻塞调用方：先放进缓冲区，攒满 max_size 或者每隔 interval_ms 由后台线程一次写入。
+
+    按放入的顺序写入，同一时间只有一个 flush 在执行；retryable 类型的异常（数据库不可用）整批留在缓冲区头部下次重试，
+    其他异常（个别数据有问题）逐条写入，写不进去的记录日志后丢弃，不会卡住后面的数据。
+    进程崩溃时最多丢失一个间隔内的数据，正常退出时调用 close 写完
+    """
+
+    def __init__(
+        self,
+        name: str,
+        writer: Callable[[List[Any]], None],
+        interval_ms: int,
+        max_size: int,
+        retryable: Tuple[Type[BaseException], ...] = (),
+    ):
+        self._name = name
+        self._writer = writer
+        self._retryable = retryable
+        self._interval = interval_ms / 1000
+        self._max_size = max(max_size, 1)
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._flush_lock = Lock()
+        self._items: List[Any] = []
+        self._thread: Optional[Thread] = None
+        self._closed = False
+        self._counters = {"flushes": 0, "rows": 0, "failures": 0, "dropped": 0}
+
+    def add(self, item: Any):
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                if self._thread is None:
+                    self._thread = Thread(name=f"write_behind_{self._name}", target=self._proceed, daemon=True)
+                    self._thread.start()
+                self._items.append(item)
+                if len(self._items) >= self._max_size:
+                    self._cond.notify()
+        # 关闭之后（进程退出时还在处理的对话）等缓冲区写完后直接写入
+        if closed:
+            with self._flush_lock:
+                self._writer([item])
+            self._count(rows=1)
+
+    def flush(self):
+        """把目前缓冲区里的都写进去，返回时之前 add 的都已经写入（或被丢弃）"""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._items[: self._max_size]
+                if not batch:
+                    return
+                done = self._write(batch)
+                with self._lock:
+                    del self._items[:done]
+                    pending = len(self._items)
+                if done < len(batch):
+                    raise RuntimeError(f"write behind {self._name} flush failed, {pending} pending")
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, pending=len(self._items))
+
+    def _proceed(self):
+        while True:
+            with self._cond:
+                if len(self._items) < self._max_size and not self._closed:
+                    self._cond.wait(self._interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"{e}, retry later")
+                time.sleep(self._interval)
+
+    def _write(self, batch: List[Any]) -> int:
+        """
+        :return: 这一批从头开始有几条已经处理完（写入或丢弃），可以从缓冲区移除
+        """
+        try:
+            self._writer(batch)
+            self._count(flushes=1, rows=len(batch))
+            return len(batch)
+        except self._retryable as e:
+            self._count(failures=1)
+            logger.warning(f"write behind {self._name} batch of {len(batch)} failed: {e!r}")
+            return 0
+        except Exception as e:
+            self._count(failures=1)
+            logger.warning(f"write behind {self._name} batch of {len(batch)} rejected, write one by one: {e!r}")
+
+        done = 0
+        for item in batch:
+            try:
+                self._writer([item])
+                self._count(rows=1)
+            except self._retryable as e:
+                # 逐条写到一半数据库不可用了，已经写入的不再重复写
+                logger.warning(f"write behind {self._name} failed: {e!r}")
+                return done
+            except Exception as e:
+                logger.error(f"write behind {self._name} drop {item!r}: {e!r}")
+                self._count(dropped=1)
+            done += 1
+        self._count(flushes=1)
+        return done
+
+    def _count(self, **deltas: int):
+        with self._lock:
+            for key, delta in deltas.items():
+                self._counters[key] += delta
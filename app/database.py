@@ -1,17 +1,29 @@
 import os
+from contextlib import contextmanager
+from threading import Lock
+from typing import Iterator, List
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, insert, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from app import CHAT_WORKERS, CHAT_CALLBACK_WORKERS, LINK_FETCH_WORKERS
 
 DB_URL = os.getenv("DB_URL")
 DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))
+# 常驻连接按同时访问数据库的后台线程数算：chat worker、回调 worker、链接抓取，再加 write behind 等零散的线程；
+# 接口线程（starlette 默认 40 个）和 chat 的并发阶段靠 overflow 兜底，session 用完即还，一般用不满
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", CHAT_WORKERS + CHAT_CALLBACK_WORKERS + LINK_FETCH_WORKERS + 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 40))
+# 连接池用尽时最多等多久（秒），超时抛错，不无限排队
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
 engine = create_engine(
     DB_URL,
     pool_recycle=DB_POOL_RECYCLE,
     pool_pre_ping=True,
-    # 应该要比executor的数量稍微大一点
-    max_overflow=36,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -41,14 +53,108 @@ def vector_db_session():
         vdb.close()
 
 
+def add_missing_columns(bind, table) -> None:
+    """
+    create_all 不会给已存在的表加字段，这里把 model 上新增的可空字段补上
+    """
+    existing = {c["name"] for c in inspect(bind).get_columns(table.name)}
+    with bind.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            col_type = column.type.compile(dialect=bind.dialect)
+            conn.execute(
+                text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN IF NOT EXISTS "{column.name}" {col_type}'
+                )
+            )
+            if column.index:
+                conn.execute(
+                    text(
+                        f'CREATE INDEX IF NOT EXISTS "ix_{table.name}_{column.name}" '
+                        f'ON "{table.name}" ("{column.name}")'
+                    )
+                )
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    一个工作单元一个事务：正常结束时提交，出错回滚，最后关闭 session 把连接还给连接池。
+    提交后不让实体过期，离开之后还能读取已经加载的字段
+    """
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 def save_entity(entity: Base):
-    db = next(get_db())
-    db.add(entity)
-    db.commit()
-    db.refresh(entity)
+    # 提交时回填主键，不需要再 refresh 一次
+    with session_scope() as db:
+        db.add(entity)
+
+
+def delete_entity(entity: Base):
+    with session_scope() as db:
+        db.delete(entity)
+
+
+def insert_all(entities: List[Base]) -> None:
+    """
+    一个事务里批量写入，相邻的同类实体合并为一条多行 insert，按传入的顺序写入；
+    不回填数据库生成的主键，需要 id 的先用 SequenceAllocator 分配
+    """
+    groups = []
+    for entity in entities:
+        if groups and groups[-1][0] is type(entity):
+            groups[-1][1].append(entity)
+        else:
+            groups.append((type(entity), [entity]))
+    with session_scope() as db:
+        for cls, group in groups:
+            attrs = inspect(cls).column_attrs
+            rows = [
+                {
+                    a.key: getattr(e, a.key)
+                    for a in attrs
+                    if not (a.columns[0].primary_key and getattr(e, a.key) is None)
+                }
+                for e in group
+            ]
+            db.execute(insert(cls), rows)
+
+
+class SequenceAllocator:
+    """
+    预先从自增主键的 sequence 里取一段 id，写库前就能知道 id，一次查询分配 block 个
+    """
+
+    def __init__(self, table: str, column: str = "id", block: int = 64):
+        self._table = table
+        self._column = column
+        self._block = block
+        self._lock = Lock()
+        self._ids: List[int] = []
 
+    def next(self) -> int:
+        with self._lock:
+            if not self._ids:
+                self._ids = self._fetch()
+            return self._ids.pop(0)
 
-def delete_entity(id_):
-    db = next(get_db())
-    db.delete(id_)
-    db.commit()
+    def _fetch(self) -> List[int]:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT nextval(pg_get_serial_sequence(:table, :column)) "
+                    "FROM generate_series(1, :block)"
+                ),
+                {"table": self._table, "column": self._column, "block": self._block},
+            )
+            return sorted([r[0] for r in rows])
@@ -28,6 +28,8 @@ class Fault(BaseModel):
 class ErrorCodeException(Exception):
     """内部异常类"""
 
+    headers: Optional[dict[str, str]] = None
+
     def __init__(self, error: Error, code: int = 400, details: Any = None):
         self.error = error
         self.code = code
@@ -71,10 +73,12 @@ class BadRequestException(ErrorCodeException):
 class RateLimitException(ErrorCodeException):
     """Open AI服务繁忙"""
 
-    def __init__(self, error: Error, details: Any = None):
+    def __init__(self, error: Error, details: Any = None, retry_after: Optional[int] = None):
         self.error = error
         self.code = HTTPStatus.TOO_MANY_REQUESTS
         self.details = details
+        if retry_after is not None:
+            self.headers = {"Retry-After": str(retry_after)}
 
 
 class ConflictException(ErrorCodeException):
@@ -101,6 +105,7 @@ def err_code_exception_handler(request: Request, exp: ErrorCodeException):
         status_code=exp.code,
         content=exp.error.model_dump(by_alias=True),
         media_type=JSONResponse.media_type,
+        headers=exp.headers,
     )
 
 
@@ -138,6 +143,7 @@ def to_json_response(exp: ErrorCodeException):
         status_code=exp.code,
         content=exp.error.model_dump(by_alias=True),
         media_type=JSONResponse.media_type,
+        headers=exp.headers,
     )
 
 
@@ -198,6 +204,9 @@ LABEL_TASK_RERUN_FORBIDDEN = Error(
 )
 
 IP_NOT_ALLOWED = Error(error=ErrorBody(code="IpNotAllowed", message="IP not allowed"))
+TOO_MANY_MESSAGES = Error(
+    error=ErrorBody(code="TooManyMessages", message="消息处理繁忙，请稍后再试")
+)
 LLM_QUOTA_EXCEED_LIMIT = Error(
     error=ErrorBody(code="LlmQuotaExceedLimit", message="用量已超过限制额度")
 )
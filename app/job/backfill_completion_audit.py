@@ -0,0 +1,63 @@
+"""
+把旧的 completion 审计记录转换成精简格式：图片存进 blob 后换成 digest，system prompt 换成模板引用，
+回复内容不再在 response_body 里重复，按 AUDIT_ZSTD_MIN_BYTES 压缩大字段。
+按 id 分批处理，每批一个事务，中断后重新执行会从没转换的记录继续。
+模板改过的旧记录匹配不上当前模板，system prompt 保持原样
+
+python -m app.job.backfill_completion_audit --batch 200
+python -m app.job.backfill_completion_audit --dry-run
+"""
+import argparse
+import json
+
+from app.database import SessionLocal
+from app.logging_ import logger
+from app.model import completion as completion_storage
+from app.service import audit as audit_service
+
+
+def _size(*values) -> int:
+    return sum([len(json.dumps(v, ensure_ascii=False).encode("UTF-8")) for v in values if v is not None])
+
+
+def run(batch: int, dry_run: bool):
+    # 每批单独提交，不用 session_scope 的一个大事务
+    db = SessionLocal()
+    last_id, converted, before, after = 0, 0, 0, 0
+    try:
+        while True:
+            rows = completion_storage.list_legacy(db, last_id, batch)
+            if not rows:
+                break
+            for row in rows:
+                before += _size(row.request_body, row.response_body)
+                # dry run 不往 blob 里写图片，只估算
+                messages = audit_service.compact_request(row.request_body or [], store_media=not dry_run)
+                response = completion_storage.slim_response(row.response_body, row.result)
+                after += _size(messages, response)
+                if not dry_run:
+                    completion_storage.convert_legacy(db, row, messages)
+            last_id = rows[-1].id
+            converted += len(rows)
+            if dry_run:
+                db.rollback()
+            else:
+                db.commit()
+            # 已经处理过的不用留在 session 里
+            db.expunge_all()
+            logger.info(f"backfill completion audit: {converted} rows, last id {last_id}")
+    finally:
+        db.close()
+    # 压缩后的大小不在这里统计
+    logger.info(
+        f"backfill completion audit done: {converted} rows, json {before / 1024 / 1024:.1f}MB -> {after / 1024 / 1024:.1f}MB"
+        f"{' (dry run)' if dry_run else ''}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--dry-run", action="store_true", help="只统计转换前后的大小，不写库")
+    args = parser.parse_args()
+    run(args.batch, args.dry_run)
@@ -83,15 +83,51 @@ async def startup_event():
 
     :return:
     """
+    import asyncio
     import logging
 
-    from app.database import Base, engine
+    from app import CHAT_ASYNC_MODE
+    from threading import Thread
+    from app.core import message_receive_queue, message_reply_queue, recover, recover_periodically
+    from app.database import Base, engine, add_missing_columns
     from app.model.user import User
     from app.model.message import Message, MessageExtra
     from app.model.completion import Completion
+    from app.model.llm_cache import LlmCache
+    from app.model.session_summary import SessionSummary
+    from app.model.link_cache import LinkCache
+    from app.model.blob import Blob
+    from app.model.prompt_template import PromptTemplate
 
     logging.getLogger("uvicorn").addHandler(file_handler)
     Base.metadata.create_all(bind=engine, checkfirst=True)
+    add_missing_columns(engine, Message.__table__)
+    add_missing_columns(engine, MessageExtra.__table__)
+    add_missing_columns(engine, Completion.__table__)
+
+    if CHAT_ASYNC_MODE:
+        loop = asyncio.get_running_loop()
+        message_receive_queue.bind_loop(loop)
+        message_reply_queue.bind_loop(loop)
+
+    recover()
+    Thread(name="message_recover_thread", target=recover_periodically, daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    from app import http_client, async_http_client
+    from app.core import image_executor
+    from app.service.chatflow import write_behind
+
+    # 缓冲区里的回复消息、completion 记录写完再退出
+    if write_behind is not None:
+        write_behind.close()
+
+    http_client.close()
+    await async_http_client.aclose()
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Integer, DateTime
+from sqlalchemy.dialects.postgresql import BYTEA, insert
+
+from app.database import Base, session_scope
+
+# 存储位置：库里 | 本地磁盘 | s3（本地磁盘作为缓存）
+STORAGE_DB = "db"
+STORAGE_DISK = "disk"
+STORAGE_S3 = "s3"
+
+
+class Blob(Base):
+    __tablename__ = "blob"
+
+    digest = Column(String(64), primary_key=True, comment="sha256(内容)")
+    size = Column(Integer)
+    content_type = Column(String(128))
+    storage = Column(String(16), comment="存储位置，`db`|`disk`|`s3`")
+    path = Column(String(255), comment="相对于 LOCAL_TEMP_FILE_PATH_BASE 的路径，存在库里的为空")
+    data = Column(BYTEA, comment="存在库里的内容")
+    created_at = Column(DateTime)
+
+
+def get_blob(digest: str) -> Optional[Blob]:
+    with session_scope() as db:
+        return db.query(Blob).filter(Blob.digest == digest).first()
+
+
+def exists(digest: str) -> bool:
+    with session_scope() as db:
+        return db.query(Blob.digest).filter(Blob.digest == digest).first() is not None
+
+
+def save_blob(blob: Blob) -> None:
+    """内容相同的 digest 相同，已经存在的直接跳过"""
+    blob.created_at = datetime.now()
+    values = {c.name: getattr(blob, c.name) for c in Blob.__table__.columns}
+    with session_scope() as db:
+        db.execute(insert(Blob).values(**values).on_conflict_do_nothing(index_elements=[Blob.digest]))
@@ -1,12 +1,19 @@
+import functools
+import json
 from datetime import datetime
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel
 
-from app.database import Base, get_db
-from sqlalchemy.dialects.postgresql import JSONB
+from app import AUDIT_ZSTD_MIN_BYTES
+from app.database import Base, session_scope
+from app.logging_ import logger
+from sqlalchemy.dialects.postgresql import BYTEA, JSONB
 from sqlalchemy import Column, String, DateTime, Integer, JSON
 
+# 2：请求里的图片、system prompt 是引用，回复内容只存在 result，大字段可能压缩
+AUDIT_VERSION = 2
+
 
 class Completion(Base):
     __tablename__ = "completion"
@@ -20,21 +27,149 @@ class Completion(Base):
     begin_at = Column(DateTime, comment="request begin time")
     end_at = Column(DateTime)
     created_by = Column(String(255), index=True)
+    model = Column(String(64), comment="model actually answered")
+    route = Column(String(128), comment="routing decision, e.g. gpt-4o-mini:short>escalated:refusal")
+    audit_version = Column(Integer, index=True, comment="审计记录的格式，为空的是完整保存的旧数据")
+    request_zstd = Column(BYTEA, comment="zstd 压缩的 request_body，此时 request_body 为空")
+    response_zstd = Column(BYTEA, comment="zstd 压缩的 response_body，此时 response_body 为空")
+
+
+def save_llm_result(
+    messages: List[Dict],
+    result: BaseModel,
+    begin_at: datetime,
+    username: str,
+    route: Optional[str] = None,
+    persist: Optional[Callable[[Completion], None]] = None,
+) -> Completion:
+    return save_completion(
+        messages,
+        result.choices[0].message.content,
+        result.model_dump(),
+        result.usage,
+        begin_at,
+        username,
+        model=result.model,
+        route=route,
+        persist=persist,
+    )
 
 
-def save_llm_result(messages: List[Dict], result: BaseModel, begin_at: datetime, username: str) -> Completion:
-    db = next(get_db())
+def save_completion(
+    messages: List[Dict],
+    result: str,
+    response_body: Dict[str, Any],
+    usage: Optional[BaseModel],
+    begin_at: datetime,
+    username: str,
+    model: Optional[str] = None,
+    route: Optional[str] = None,
+    persist: Optional[Callable[[Completion], None]] = None,
+) -> Completion:
+    """
+    流式 completion 没有完整的 ChatCompletion 对象，直接传入汇总后的结果
+    :param messages: 精简后的请求，见 audit_service.compact_request
+    :param persist: 不直接写库时的写入方式（比如放进 write behind 的缓冲区），此时返回的实体没有 id
+    """
+    request_body, request_zstd = _pack(messages)
+    response_body, response_zstd = _pack(slim_response(response_body, result))
     entity = Completion(
-        request_body=messages,
-        result=result.choices[0].message.content,
-        response_body=result.model_dump(),
-        prompt_tokens=result.usage.prompt_tokens,
-        completion_tokens=result.usage.completion_tokens,
+        request_body=request_body,
+        request_zstd=request_zstd,
+        result=result,
+        response_body=response_body,
+        response_zstd=response_zstd,
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
         begin_at=begin_at,
         end_at=datetime.now(),
         created_by=username,
+        model=model,
+        route=route,
+        audit_version=AUDIT_VERSION,
     )
-    db.add(entity)
-    db.commit()
-    db.refresh(entity)
-    return entity
\ No newline at end of file
+    if persist is not None:
+        persist(entity)
+        return entity
+    with session_scope() as db:
+        db.add(entity)
+    return entity
+
+
+def slim_response(response_body: Optional[Dict[str, Any]], result: Optional[str]) -> Optional[Dict[str, Any]]:
+    """回复内容和 result 重复，去掉，读取时用 response_of 补回来"""
+    if not response_body:
+        return response_body
+    choices = []
+    for choice in response_body.get("choices") or []:
+        message = choice.get("message") or {}
+        if message.get("content") is not None and message.get("content") == result:
+            choice = {**choice, "message": {k: v for k, v in message.items() if k != "content"}}
+        choices.append(choice)
+    return {**response_body, "choices": choices}
+
+
+def request_of(entity: Completion) -> Optional[List[Dict]]:
+    return _unpack(entity.request_body, entity.request_zstd)
+
+
+def response_of(entity: Completion) -> Optional[Dict[str, Any]]:
+    body = _unpack(entity.response_body, entity.response_zstd)
+    if body and entity.audit_version:
+        for choice in body.get("choices") or []:
+            message = choice.get("message")
+            if message is not None and "content" not in message:
+                message["content"] = entity.result
+    return body
+
+
+def list_legacy(db, after_id: int, limit: int) -> List[Completion]:
+    """还没转换成精简格式的旧记录"""
+    return (
+        db.query(Completion)
+        .filter(Completion.audit_version.is_(None), Completion.id > after_id)
+        .order_by(Completion.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def convert_legacy(db, entity: Completion, messages: List[Dict]) -> None:
+    """不提交，由调用方按批提交"""
+    entity.request_body, entity.request_zstd = _pack(messages)
+    entity.response_body, entity.response_zstd = _pack(slim_response(entity.response_body, entity.result))
+    entity.audit_version = AUDIT_VERSION
+
+
+def _pack(value: Any) -> Tuple[Any, Optional[bytes]]:
+    """
+    :return: 超过 AUDIT_ZSTD_MIN_BYTES 且装了 zstandard 时压缩（jsonb 字段为空 & 压缩后的内容），否则原样返回
+    """
+    zstd = _zstd()
+    if value is None or AUDIT_ZSTD_MIN_BYTES <= 0 or zstd is None:
+        return value, None
+    raw = json.dumps(value, ensure_ascii=False).encode("UTF-8")
+    if len(raw) < AUDIT_ZSTD_MIN_BYTES:
+        return value, None
+    return None, zstd.ZstdCompressor(level=3).compress(raw)
+
+
+def _unpack(value: Any, compressed: Optional[bytes]) -> Any:
+    if compressed is None:
+        return value
+    zstd = _zstd()
+    if zstd is None:
+        raise RuntimeError("zstandard is required to read compressed completion records")
+    return json.loads(zstd.ZstdDecompressor().decompress(bytes(compressed)))
+
+
+@functools.lru_cache(maxsize=1)
+def _zstd():
+    # 可选依赖，没有安装时不压缩
+    try:
+        import zstandard
+    except ImportError:
+        if AUDIT_ZSTD_MIN_BYTES > 0:
+            logger.warning("zstandard not installed, completion records stored uncompressed")
+        return None
+    return zstandard
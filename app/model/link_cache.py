@@ -0,0 +1,51 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Text, Integer, Boolean, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import Base, session_scope
+
+
+class LinkCache(Base):
+    __tablename__ = "link_cache"
+
+    key = Column(String(64), primary_key=True, comment="sha256(归一化的 url)")
+    url = Column(Text, comment="第一次抓取时的原始链接")
+    final_url = Column(Text, comment="跳转后的链接")
+    status = Column(Integer)
+    content_type = Column(String(128))
+    charset = Column(String(64))
+    title = Column(Text)
+    text = Column(Text, comment="抽取出的正文，非 html 页面为空")
+    truncated = Column(Boolean, comment="超过字节上限被截断")
+    etag = Column(String(512), comment="重新验证用的 ETag")
+    last_modified = Column(String(128), comment="重新验证用的 Last-Modified")
+    fetched_at = Column(DateTime, comment="最后一次抓取或验证的时间")
+    expires_at = Column(DateTime, index=True, comment="过期后需要重新验证")
+
+
+def get_entry(key: str) -> Optional[LinkCache]:
+    """过期的也返回，用 etag / last_modified 重新验证"""
+    with session_scope() as db:
+        return db.query(LinkCache).filter(LinkCache.key == key).first()
+
+
+def save_entry(entry: LinkCache) -> None:
+    with session_scope() as db:
+        values = {c.name: getattr(entry, c.name) for c in LinkCache.__table__.columns}
+        stmt = insert(LinkCache).values(**values)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[LinkCache.key],
+                set_={k: stmt.excluded[k] for k in values if k != "key"},
+            )
+        )
+
+
+def refresh_entry(key: str, fetched_at: datetime, expires_at: datetime) -> None:
+    """重新验证未变化（304），只延长过期时间"""
+    with session_scope() as db:
+        db.query(LinkCache).filter(LinkCache.key == key).update(
+            {"fetched_at": fetched_at, "expires_at": expires_at}, synchronize_session=False
+        )
@@ -0,0 +1,44 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Text, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import Base, session_scope
+
+
+class LlmCache(Base):
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True, comment="sha256(model, 参数, 归一化的 prompt)")
+    model = Column(String(255), comment="模型")
+    result = Column(Text, comment="llm 返回的内容")
+    expires_at = Column(DateTime, index=True, comment="过期时间")
+    created_at = Column(DateTime)
+
+
+def get_result(key: str) -> Optional[str]:
+    with session_scope() as db:
+        entity = (
+            db.query(LlmCache)
+            .filter(LlmCache.key == key, LlmCache.expires_at > datetime.now())
+            .first()
+        )
+        return entity.result if entity else None
+
+
+def save_result(key: str, model: str, result: str, expires_at: datetime) -> None:
+    with session_scope() as db:
+        stmt = insert(LlmCache).values(
+            key=key,
+            model=model,
+            result=result,
+            expires_at=expires_at,
+            created_at=datetime.now(),
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[LlmCache.key],
+                set_={"result": stmt.excluded.result, "expires_at": stmt.excluded.expires_at},
+            )
+        )
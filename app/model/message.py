@@ -1,14 +1,26 @@
 from collections.abc import Collection
 from datetime import datetime
-from typing import List
+from typing import List, Tuple
 
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import foreign, relationship, selectinload, undefer
 from sqlalchemy.dialects.postgresql import BYTEA, JSONB
-from sqlalchemy import Column, String, Text, JSON, Integer, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, String, Text, JSON, Integer, DateTime, ForeignKey, Boolean, true
 
-from app.database import Base, get_db
+from app.database import Base, session_scope
+from app.model.link_cache import LinkCache
 from sqlalchemy.sql.operators import or_
 
+# 收到的消息：pending -> processing -> processed | failed，积压过多被丢弃的为 dropped
+STATE_PENDING = "pending"
+STATE_PROCESSING = "processing"
+STATE_PROCESSED = "processed"
+STATE_FAILED = "failed"
+STATE_DROPPED = "dropped"
+# 回复的消息：unsent -> sending -> sent，发送失败回到 unsent 等待重试
+STATE_UNSENT = "unsent"
+STATE_SENDING = "sending"
+STATE_SENT = "sent"
+
 
 class Message(Base):
     __tablename__ = "message"
@@ -21,6 +33,8 @@ class Message(Base):
     session_id = Column(String(255), comment="itchat 发送消息过来时的user id，每次重启就会变化，只能当session id")
     is_group = Column(Boolean, comment="是否是群聊")
     is_clear = Column(Boolean, comment="清除记忆")
+    state = Column(String(32), index=True, comment="处理状态，为空的是历史数据，视为已处理")
+    claimed_at = Column(DateTime, comment="进入 processing / sending 的时间")
     created_at = Column(DateTime)
 
     message_extra = relationship(
@@ -37,23 +51,158 @@ class MessageExtra(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     message_id = Column(Integer, ForeignKey(f"{Message.__tablename__}.id", ondelete="CASCADE"), index=True, nullable=False)
     content_meta = Column(JSONB, comment="消息的元信息")
-    content_bytes = Column(BYTEA, comment="消息内容，一般是图片、链接抓取等")
+    content_bytes = Column(BYTEA, comment="旧数据的消息内容（图片、链接抓取结果），新数据在 blob / link_cache")
+    blob_digest = Column(String(64), index=True, comment="附件内容，引用 blob，相同的内容只存一份")
+    link_key = Column(String(64), index=True, comment="链接抓取结果，引用 link_cache，多个消息共享同一份")
 
     message = relationship(Message, back_populates="message_extra")
+    link_cache = relationship(
+        LinkCache,
+        primaryjoin=lambda: foreign(MessageExtra.link_key) == LinkCache.key,
+        viewonly=True,
+        lazy="joined",
+    )
+
+    @property
+    def link_text(self) -> str:
+        """链接抓取的正文，旧数据没有引用 link_cache，直接存在 content_bytes"""
+        if self.link_key is not None:
+            return self.link_cache.text or "" if self.link_cache is not None else ""
+        return str(self.content_bytes or b"", encoding="UTF-8")
+
+    @property
+    def is_legacy(self) -> bool:
+        """内容还在 content_bytes 里的旧数据"""
+        return not self.blob_digest and self.link_key is None
 
 
 def list_messages(db, id_: str | Collection[str]) -> List[Message]:
+    """
+    message_extra 和链接正文一次查出来，不再逐条懒加载，离开 session 后也能读取；
+    新数据的附件内容在 blob 里，用到时才读，不查 content_bytes
+    """
     ids = id_ if isinstance(id_, Collection) else [id_]
-    return db.query(Message).filter(Message.id.in_(ids)).all()
+    messages = (
+        db.query(Message)
+        .options(selectinload(Message.message_extra).defer(MessageExtra.content_bytes))
+        .filter(Message.id.in_(ids))
+        .all()
+    )
+    # 旧数据的内容在 content_bytes 里，离开 session 后不能再懒加载，一次补查出来
+    legacy = [m.message_extra.id for m in messages if m.message_extra is not None and m.message_extra.is_legacy]
+    if legacy:
+        db.query(MessageExtra).options(undefer(MessageExtra.content_bytes)).filter(MessageExtra.id.in_(legacy)).all()
+    return messages
 
 
-def clear_messages(session_id: str) -> None:
-    db = next(get_db())
+def list_extra_message_ids(id_: Collection[int]) -> List[int]:
+    """这些消息里已经有 message_extra 的"""
+    with session_scope() as db:
+        return [r.message_id for r in db.query(MessageExtra.message_id).filter(MessageExtra.message_id.in_(id_))]
+
+
+def clear_messages(db, session_id: str) -> None:
+    """在调用方的事务里执行，与写入清除记忆的消息一起提交"""
+    from app.model import session_summary as summary_storage
+
     db.query(Message).filter(Message.session_id == session_id).update({
         "is_clear": True
     })
+    # 滚动总结基于被清除的记录，一起作废
+    summary_storage.delete_summary(db, session_id)
 
 
 def list_previous_messages(session_id: str, create_at_gt: datetime) -> List[Message]:
-    db = next(get_db())
-    return db.query(Message).filter(Message.session_id == session_id, Message.is_clear == True, Message.created_at >= create_at_gt).all()
\ No newline at end of file
+    with session_scope() as db:
+        # 回复消息的 is_clear 为空，也算没清除
+        return (
+            db.query(Message)
+            .filter(Message.session_id == session_id, Message.is_clear.isnot(True), Message.created_at >= create_at_gt)
+            .order_by(Message.id)
+            .all()
+        )
+
+
+def claim_messages(id_: Collection[int]) -> List[int]:
+    """
+    把 pending 的消息标记为 processing，被其他 worker 锁住或者已经处理过的直接跳过
+    :return: 抢到的消息 id
+    """
+    return _claim(id_, STATE_PENDING, STATE_PROCESSING)
+
+
+def claim_replies(id_: Collection[int]) -> List[int]:
+    """
+    把 unsent 的回复标记为 sending，重放时同一条回复被重复放进队列也只会发送一次
+    :return: 抢到的回复 id
+    """
+    return _claim(id_, STATE_UNSENT, STATE_SENDING)
+
+
+def _claim(id_: Collection[int], from_state: str, to_state: str) -> List[int]:
+    with session_scope() as db:
+        rows = (
+            db.query(Message.id)
+            .filter(Message.id.in_(id_), Message.state == from_state)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        claimed = [r.id for r in rows]
+        if claimed:
+            db.query(Message).filter(Message.id.in_(claimed)).update(
+                {"state": to_state, "claimed_at": datetime.now()},
+                synchronize_session=False,
+            )
+        return claimed
+
+
+def update_state(id_: int | Collection[int], state: str) -> None:
+    ids = id_ if isinstance(id_, Collection) else [id_]
+    with session_scope() as db:
+        db.query(Message).filter(Message.id.in_(ids)).update(
+            {"state": state}, synchronize_session=False
+        )
+
+
+def recover_messages(
+    before: datetime, stale_before: datetime, exclude: Collection[int] = ()
+) -> Tuple[List[Message], List[Message]]:
+    """
+    找回未完成的工作：before 之前收到但没处理完的消息，以及没发出去的回复；
+    stale_before 之前就被抢占、到现在还是 processing / sending 的视为抢占它的实例已经崩溃，重置后重放
+    :param exclude: 调用方队列里已经有的消息和回复，不返回也不重置状态
+    :return: 待处理的消息 & 待发送的回复，均按 id 排序
+    """
+    resident = Message.id.notin_(exclude) if exclude else true()
+    with session_scope() as db:
+        inbound = (
+            db.query(Message)
+            .filter(
+                or_(
+                    (Message.state == STATE_PENDING) & (Message.created_at < before),
+                    (Message.state == STATE_PROCESSING) & (Message.claimed_at < stale_before),
+                ),
+                resident,
+            )
+            .order_by(Message.id)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for m in inbound:
+            m.state = STATE_PENDING
+        outbound = (
+            db.query(Message)
+            .filter(
+                or_(
+                    (Message.state == STATE_UNSENT) & (Message.created_at < before),
+                    (Message.state == STATE_SENDING) & (Message.claimed_at < stale_before),
+                ),
+                resident,
+            )
+            .order_by(Message.id)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for m in outbound:
+            m.state = STATE_UNSENT
+        return inbound, outbound
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from sqlalchemy import Column, String, Text, Integer, DateTime, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import Base, session_scope
+
+
+class PromptTemplate(Base):
+    __tablename__ = "prompt_template"
+    __table_args__ = (UniqueConstraint("name", "version"),)
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    name = Column(String(255), comment="prompts 目录下的文件名")
+    version = Column(String(16), comment="sha256(模板内容) 的前 16 位")
+    content = Column(Text)
+    created_at = Column(DateTime)
+
+
+def get_or_create(name: str, version: str, content: str) -> int:
+    """
+    :return: 模板的 id，内容变化后是新的版本、新的 id
+    """
+    with session_scope() as db:
+        db.execute(
+            insert(PromptTemplate)
+            .values(name=name, version=version, content=content, created_at=datetime.now())
+            .on_conflict_do_nothing(index_elements=[PromptTemplate.name, PromptTemplate.version])
+        )
+        return (
+            db.query(PromptTemplate.id)
+            .filter(PromptTemplate.name == name, PromptTemplate.version == version)
+            .scalar()
+        )
+
+
+def get_content(id_: int) -> str:
+    with session_scope() as db:
+        return db.query(PromptTemplate.content).filter(PromptTemplate.id == id_).scalar()
@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Column, String, Text, Integer, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import Base, session_scope
+
+
+class SessionSummary(Base):
+    __tablename__ = "session_summary"
+
+    session_id = Column(String(255), primary_key=True)
+    summary = Column(Text, comment="聊天记录的滚动总结")
+    last_message_id = Column(Integer, comment="已经合并进总结的最后一条消息")
+    updated_at = Column(DateTime, index=True)
+
+
+def get_summary(session_id: str, updated_at_gt: datetime) -> Optional[SessionSummary]:
+    with session_scope() as db:
+        return (
+            db.query(SessionSummary)
+            .filter(
+                SessionSummary.session_id == session_id,
+                SessionSummary.updated_at >= updated_at_gt,
+            )
+            .first()
+        )
+
+
+def save_summary(session_id: str, summary: str, last_message_id: int) -> None:
+    with session_scope() as db:
+        stmt = insert(SessionSummary).values(
+            session_id=session_id,
+            summary=summary,
+            last_message_id=last_message_id,
+            updated_at=datetime.now(),
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[SessionSummary.session_id],
+                set_={
+                    "summary": stmt.excluded.summary,
+                    "last_message_id": stmt.excluded.last_message_id,
+                    "updated_at": stmt.excluded.updated_at,
+                },
+            )
+        )
+
+
+def delete_summary(db, session_id: str) -> None:
+    db.query(SessionSummary).filter(SessionSummary.session_id == session_id).delete()
@@ -0,0 +1,124 @@
+import base64
+import hashlib
+import re
+import string
+from threading import Lock
+from typing import Any, Dict, List, Optional, Pattern
+
+from app.model import prompt_template as template_storage
+from app.service import blob as blob_service
+from app.utils import file_relative_path
+
+# 会出现在 completion 记录里的 system prompt 模板
+_TEMPLATE_NAMES = ["system_prompt"]
+_DATA_URL = re.compile(r"data:(?P<type>[\w/+.-]+);base64,(?P<data>.+)", re.S)
+
+
+class _Template:
+    def __init__(self, name: str, content: str):
+        self.name = name
+        self.content = content
+        self.version = hashlib.sha256(content.encode("UTF-8")).hexdigest()[:16]
+        self.pattern = _template_pattern(content)
+        self.id: Optional[int] = None
+
+
+def _template_pattern(content: str) -> Pattern:
+    """把模板的占位符换成命名分组，用来从渲染后的 prompt 里反解出变量"""
+    pattern, seen = "", set()
+    for literal, field, _, _ in string.Formatter().parse(content):
+        pattern += re.escape(literal)
+        if field is None:
+            continue
+        pattern += f"(?P={field})" if field in seen else f"(?P<{field}>.*?)"
+        seen.add(field)
+    return re.compile(pattern, re.S)
+
+
+def _load_templates() -> List[_Template]:
+    templates = []
+    for name in _TEMPLATE_NAMES:
+        with open(file_relative_path(__file__, f"../prompts/{name}.txt"), "r") as file:
+            templates.append(_Template(name, file.read()))
+    return templates
+
+
+_templates = _load_templates()
+_templates_lock = Lock()
+
+
+def compact_request(
+    messages: List[Dict[str, Any]], store_media: bool = False, digests: Optional[Dict[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    completion 审计记录里的请求：
+    内联的图片换成 blob 的 digest；system prompt 换成模板 id、版本和填入的变量
+    :param store_media: 图片不一定已经在 blob 里（转换旧数据时），先保存再引用
+    :param digests: 内联图片的 data url -> 已经在 blob 里的 digest，有的不用再解码计算
+    """
+    return [_compact_message(m, store_media, digests or {}) for m in messages]
+
+
+def expand_request(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """还原 system prompt；图片只还原成 blob 的引用，需要时用 blob_service.get 读取"""
+    expanded = []
+    for m in messages:
+        if "template_id" in m:
+            content = template_storage.get_content(m["template_id"])
+            m = {"role": m["role"], "content": content.format(**m.get("variables", {}))}
+        expanded.append(m)
+    return expanded
+
+
+def _compact_message(message: Dict[str, Any], store_media: bool, digests: Dict[str, str]) -> Dict[str, Any]:
+    content = message.get("content")
+    if message.get("role") == "system" and isinstance(content, str):
+        ref = _template_ref(content)
+        if ref is not None:
+            return {"role": message["role"], **ref}
+    if isinstance(content, list):
+        return {**message, "content": [_compact_part(p, store_media, digests) for p in content]}
+    return message
+
+
+def _compact_part(part: Dict[str, Any], store_media: bool, digests: Dict[str, str]) -> Dict[str, Any]:
+    if part.get("type") != "image_url":
+        return part
+    url = part["image_url"].get("url", "")
+    matched = _DATA_URL.fullmatch(url)
+    # 按链接引用的图片本来就很短
+    if matched is None:
+        return part
+    content_type = matched.group("type")
+    digest = digests.get(url)
+    if digest is not None:
+        encoded = matched.group("data")
+        size = len(encoded) * 3 // 4 - (len(encoded) - len(encoded.rstrip("=")))
+    else:
+        data = base64.b64decode(matched.group("data"))
+        digest = blob_service.put(data, content_type) if store_media else blob_service.digest_of(data)
+        size = len(data)
+    return {"type": "image_url", "image_url": {"digest": digest, "content_type": content_type, "size": size}}
+
+
+def _template_ref(content: str) -> Optional[Dict[str, Any]]:
+    for template in _templates:
+        matched = template.pattern.fullmatch(content)
+        if matched is None:
+            continue
+        return {
+            "template_id": _template_id(template),
+            "template": template.name,
+            "version": template.version,
+            "variables": matched.groupdict(),
+        }
+    return None
+
+
+def _template_id(template: _Template) -> int:
+    # 第一次用到时才写库，进程内记住 id
+    if template.id is None:
+        with _templates_lock:
+            if template.id is None:
+                template.id = template_storage.get_or_create(template.name, template.version, template.content)
+    return template.id
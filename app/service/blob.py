@@ -0,0 +1,182 @@
+import hashlib
+import time
+from base64 import b64encode
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple, Union
+
+from app import (
+    BLOB_STORAGE,
+    BLOB_CACHE_BYTES,
+    IMAGE_URL_MODE,
+    IMAGE_URL_EXPIRES,
+    IMAGE_DATA_URL_CACHE_BYTES,
+)
+from app.logging_ import logger
+from app.model import blob as blob_storage
+from app.model.blob import Blob, STORAGE_DB, STORAGE_DISK, STORAGE_S3
+from app.model.message import MessageExtra
+from app.service import file as file_service
+
+
+class BlobCache:
+    """进程内的 LRU，按内容的总长度淘汰；内容按 digest 寻址，不会过期"""
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._items: OrderedDict[str, Union[bytes, str]] = OrderedDict()
+        self._bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, digest: str) -> Optional[Union[bytes, str]]:
+        with self._lock:
+            data = self._items.get(digest)
+            if data is None:
+                self._counters["misses"] += 1
+                return None
+            self._items.move_to_end(digest)
+            self._counters["hits"] += 1
+            return data
+
+    def put(self, digest: str, data: Union[bytes, str]):
+        # 单个超过上限的不缓存，免得把其他的都挤出去
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            if digest in self._items:
+                self._items.move_to_end(digest)
+                return
+            self._items[digest] = data
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counters["evictions"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, size=len(self._items), bytes=self._bytes)
+
+
+blob_cache = BlobCache(BLOB_CACHE_BYTES)
+# 同一张图片在多轮对话里反复发给 llm，base64 编码的结果按 digest 缓存
+data_url_cache = BlobCache(IMAGE_DATA_URL_CACHE_BYTES)
+# digest -> (链接, 有效期截止的 monotonic 时间)
+_remote_urls: Dict[str, Tuple[str, float]] = {}
+_remote_lock = Lock()
+
+
+def digest_of(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def put(data: bytes, content_type: str, storage: str = BLOB_STORAGE) -> str:
+    """
+    按 sha256 保存，同样的内容（重复发的表情、图片）只存一份
+    :return: digest
+    """
+    digest = digest_of(data)
+    if blob_storage.exists(digest):
+        blob_cache.put(digest, data)
+        return digest
+
+    if storage not in (STORAGE_DB, STORAGE_DISK, STORAGE_S3):
+        raise ValueError(f"unknown blob storage: {storage}")
+    path = None if storage == STORAGE_DB else _relate_path(digest)
+    if storage == STORAGE_DISK:
+        file_service.save_local(data, path)
+    elif storage == STORAGE_S3:
+        file_service.upload(data, path)
+
+    blob_storage.save_blob(
+        Blob(
+            digest=digest,
+            size=len(data),
+            content_type=content_type,
+            storage=storage,
+            path=path,
+            data=data if storage == STORAGE_DB else None,
+        )
+    )
+    blob_cache.put(digest, data)
+    return digest
+
+
+def get(digest: str) -> bytes:
+    """先查进程内缓存，再按保存时的位置读取；s3 上的先下载到本地"""
+    data = blob_cache.get(digest)
+    if data is not None:
+        return data
+
+    blob = blob_storage.get_blob(digest)
+    if blob is None:
+        raise FileNotFoundError(f"blob {digest} not found")
+    if blob.storage == STORAGE_DB:
+        data = blob.data
+    else:
+        data = file_service.read_local(blob.path)
+        if data is None and blob.storage == STORAGE_S3:
+            file_service.get_local_file(blob.path)
+            data = file_service.read_local(blob.path)
+        if data is None:
+            raise FileNotFoundError(f"blob {digest} not found in {blob.storage}: {blob.path}")
+    data = bytes(data)
+    blob_cache.put(digest, data)
+    return data
+
+
+def read(extra: MessageExtra) -> bytes:
+    """消息附件的内容，真正用到时才读取；旧数据直接存在 content_bytes"""
+    if extra.blob_digest:
+        return get(extra.blob_digest)
+    return bytes(extra.content_bytes or b"")
+
+
+def image_url(digest: str, content_type: str) -> str:
+    """
+    给 llm 的图片地址：按 IMAGE_URL_MODE 上传一次后给链接，请求体里不再带图片内容；
+    上传或签名失败时退回内联的 data url
+    """
+    if IMAGE_URL_MODE in ("presigned", "public"):
+        try:
+            return _remote_url(digest)
+        except Exception as e:
+            logger.warning(f"image {digest} by reference failed, fallback to data url: {e!r}")
+    return data_url(digest, content_type)
+
+
+def data_url(digest: str, content_type: str) -> str:
+    url = data_url_cache.get(digest)
+    if url is None:
+        url = f"data:{content_type};base64,{b64encode(get(digest)).decode('UTF-8')}"
+        data_url_cache.put(digest, url)
+    return url
+
+
+def _remote_url(digest: str) -> str:
+    with _remote_lock:
+        cached = _remote_urls.get(digest)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    path = _relate_path(digest)
+    blob = blob_storage.get_blob(digest)
+    # 存在 s3 上的不用再传；其他的可能已经被别的进程传过
+    if blob is None or blob.storage != STORAGE_S3:
+        if not file_service.exists_remote(path):
+            file_service.upload(get(digest), path)
+
+    if IMAGE_URL_MODE == "presigned":
+        url = file_service.presigned_url(path, IMAGE_URL_EXPIRES)
+        # 留一半的有效期，避免 llm 服务拿到的是快过期的链接
+        valid_until = time.monotonic() + IMAGE_URL_EXPIRES / 2
+    else:
+        url, valid_until = file_service.public_url(path), float("inf")
+    with _remote_lock:
+        _remote_urls[digest] = (url, valid_until)
+    return url
+
+
+def _relate_path(digest: str) -> str:
+    return f"blobs/{digest[:2]}/{digest}"
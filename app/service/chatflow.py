@@ -1,24 +1,97 @@
-import requests
+import asyncio
+import contextvars
+import functools
+import httpx
+import json
+import re
 
 from base64 import b64encode
+from concurrent.futures import Future
 from datetime import datetime
-from typing import List
+from threading import BoundedSemaphore
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from app import CHAT_CALLBACK_URL
-from app.core import message_reply_queue
+from sqlalchemy.exc import InterfaceError, OperationalError
+from tenacity import (
+    retry,
+    wait_random_exponential,
+    stop_after_attempt,
+    retry_if_exception_type,
+)
+
+from app import (
+    CHAT_CALLBACK_URL,
+    CHAT_CALLBACK_TIMEOUT,
+    CHAT_CALLBACK_RETRIES,
+    CHAT_CALLBACK_REQUEUE_MAX_DELAY,
+    CHAT_CALLBACK_BATCH_SIZE,
+    CHAT_SPECULATIVE_SEARCH,
+    CHAT_SPECULATIVE_SEARCH_WORKERS,
+    CHAT_FAST_SEARCH_DECISION,
+    CHAT_STREAM,
+    CHAT_STREAM_MIN_CHARS,
+    CHAT_DEADLINE,
+    CHAT_CONSIDER_BACKEND,
+    CONSIDER_BATCH,
+    CONSIDER_BATCH_WINDOW_MS,
+    CONSIDER_BATCH_MAX_SIZE,
+    SEARCH_FANOUT,
+    SEARCH_TOP_K,
+    WRITE_BEHIND,
+    WRITE_BEHIND_INTERVAL_MS,
+    WRITE_BEHIND_MAX_SIZE,
+    http_client,
+    async_http_client,
+)
+from app.core import message_reply_queue, stage_executor, speculative_executor, batch_executor, ReplyItem
+from app.core.batch import MicroBatcher
+from app.core.deadline import deadline
+from app.core.stage import StageGraph
+from app.core.write_behind import WriteBehind
+from app.errors import log_exception
 from app.logging_ import logger
 from app.model import completion as completion_storage
 from app.model import message as msg_storage
-from app.database import save_entity, get_db
+from app.model import session_summary as summary_storage
+from app.database import save_entity, session_scope, insert_all, SequenceAllocator
 from app.model.message import Message
-from app.service.net_search import web_search_pro, ai_consider
-from app.service.llm import chat_completions, LlmMessage, SYSTEM_ROLE, USER_ROLE
+from app.model.session_summary import SessionSummary
+from app.service import llm as llm_service
+from app.service import net_search
+from app.service import link as link_service
+from app.service import blob as blob_service
+from app.service import audit as audit_service
+from app.service.rerank import rerank
+from app.service.context import ContextBuilder, IMAGE_TOKENS
+from app.service.llm import (
+    consider_cache,
+    routed_chat_completions,
+    arouted_chat_completions,
+    model_router,
+    RouteFeatures,
+    stream_chat_completions,
+    astream_chat_completions,
+    SentenceChunker,
+    LlmMessage,
+    SYSTEM_ROLE,
+    USER_ROLE,
+)
 from app.utils import (
     file_relative_path,
     current_timestamp,
     DATE_TIME_PATTERN,
 )
 
+if CHAT_CONSIDER_BACKEND == "openai":
+    ai_consider, aai_consider = llm_service.ai_consider, llm_service.aai_consider
+else:
+    ai_consider, aai_consider = net_search.ai_consider, net_search.aai_consider
+
+if SEARCH_FANOUT:
+    web_search, aweb_search = net_search.fan_out_search, net_search.afan_out_search
+else:
+    web_search, aweb_search = net_search.web_search_pro, net_search.aweb_search_pro
+
 
 with open(file_relative_path(__file__, "../prompts/system_prompt.txt"), "r") as file:
     system_prompt = file.read()
@@ -28,6 +101,11 @@ with open(
 ) as file:
     histories_compress_prompt = file.read()
 
+with open(
+    file_relative_path(__file__, "../prompts/histories_fold_prompt.txt"), "r"
+) as file:
+    histories_fold_prompt = file.read()
+
 with open(
     file_relative_path(__file__, "../prompts/question_rewrite_prompt.txt"), "r"
 ) as file:
@@ -38,6 +116,11 @@ with open(
 ) as file:
     net_search_prompt = file.read()
 
+with open(
+    file_relative_path(__file__, "../prompts/net_search_batch_prompt.txt"), "r"
+) as file:
+    net_search_batch_prompt = file.read()
+
 with open(
     file_relative_path(__file__, "../prompts/net_search_context_prompt.txt"), "r"
 ) as file:
@@ -57,7 +140,109 @@ with open(
     link_default_prompt = file.read()
 
 
+def _decide_batch(questions: List[str]) -> List[str]:
+    """
+    一次请求判断多个问题是否需要搜索，结果解析失败时退回逐个判断
+    """
+    if len(questions) == 1:
+        return [ai_consider(net_search_prompt.format(content=questions[0]))]
+
+    numbered = "\n".join([f"{i}. {json.dumps(q, ensure_ascii=False)}" for i, q in enumerate(questions, start=1)])
+    # 整批的 prompt 不会重复出现，不走结果缓存
+    consider = getattr(ai_consider, "__wrapped__", ai_consider)
+    result = consider(net_search_batch_prompt.format(count=len(questions), questions=numbered))
+    answers = _parse_decisions(result, len(questions))
+    if answers is None:
+        logger.warning(f"batched search decision unparsable, fallback to single calls: {result}")
+        return [ai_consider(net_search_prompt.format(content=q)) for q in questions]
+    return answers
+
+
+def _parse_decisions(result: Optional[str], count: int) -> Optional[List[str]]:
+    found = re.search(r"\[.*\]", result or "", re.S)
+    if not found:
+        return None
+    try:
+        answers = json.loads(found.group())
+    except ValueError:
+        return None
+    if len(answers) != count or any([a not in ("是", "否") for a in answers]):
+        return None
+    return answers
+
+
+# 是否搜索的判断跨 session 攒批，单个问题的结果按问题缓存
+batched_decide, abatched_decide = None, None
+if CONSIDER_BATCH:
+    search_decision_batcher = MicroBatcher(
+        _decide_batch, CONSIDER_BATCH_WINDOW_MS, CONSIDER_BATCH_MAX_SIZE, batch_executor
+    )
+    batched_decide = consider_cache.cached(f"{CHAT_CONSIDER_BACKEND}-batch")(search_decision_batcher.run)
+    abatched_decide = consider_cache.cached(f"{CHAT_CONSIDER_BACKEND}-batch")(search_decision_batcher.arun)
+else:
+    search_decision_batcher = None
+
+class _StateChange(NamedTuple):
+    """回复的状态变更，和回复消息走同一个 write behind，在回复消息写入之后才执行"""
+
+    ids: List[int]
+    state: str
+
+
+def _write_rows(items: List[Any]):
+    # 状态变更针对的回复消息在同一批或者更早的批次里，先写入这一批的实体
+    entities = [i for i in items if not isinstance(i, _StateChange)]
+    if entities:
+        insert_all(entities)
+    for change in items:
+        if isinstance(change, _StateChange):
+            msg_storage.update_state(change.ids, change.state)
+
+
+# 回复消息、completion 记录和回复的状态按产生的顺序批量写库，回复消息的 id 预先从 sequence 分配，
+# 发送回复不用等写库
+write_behind, reply_ids = None, None
+if WRITE_BEHIND:
+    write_behind = WriteBehind(
+        "chat", _write_rows, WRITE_BEHIND_INTERVAL_MS, WRITE_BEHIND_MAX_SIZE, retryable=(OperationalError, InterfaceError)
+    )
+    reply_ids = SequenceAllocator(Message.__tablename__)
+
+
 def chat(message_ids: List[str]):
+    """
+    抢占消息后处理，处理结果记录到消息的 state 上，崩溃时未完成的消息会在重启后重放。
+    整轮处理（含各次 llm、搜索的重试）不超过 CHAT_DEADLINE，超时的消息记为 failed，不再占着 session
+    """
+    message_ids = msg_storage.claim_messages(message_ids)
+    if not message_ids:
+        return
+    try:
+        with deadline(CHAT_DEADLINE):
+            _chat(message_ids)
+    except Exception:
+        msg_storage.update_state(message_ids, msg_storage.STATE_FAILED)
+        raise
+    msg_storage.update_state(message_ids, msg_storage.STATE_PROCESSED)
+
+
+async def achat(message_ids: List[str]):
+    """
+    chat 的协程版本，流程一致；llm、搜索走异步客户端，数据库操作放到线程里执行
+    """
+    message_ids = await asyncio.to_thread(msg_storage.claim_messages, message_ids)
+    if not message_ids:
+        return
+    try:
+        with deadline(CHAT_DEADLINE):
+            await _achat(message_ids)
+    except Exception:
+        await asyncio.to_thread(msg_storage.update_state, message_ids, msg_storage.STATE_FAILED)
+        raise
+    await asyncio.to_thread(msg_storage.update_state, message_ids, msg_storage.STATE_PROCESSED)
+
+
+def _chat(message_ids: List[str]):
     """
     设定规则：
     包含session id一小时以前的context；
@@ -73,61 +258,40 @@ def chat(message_ids: List[str]):
     【n条消息，文字+视频】：暂不支持；
 
     """
-    db = next(get_db())
-    messages = msg_storage.list_messages(db, message_ids)
+    messages, previous, summary = _load_messages(message_ids)
     session_id = messages[0].session_id
     is_group = messages[0].is_group
+    is_text_type = all([m.type_ == "text" for m in messages])
 
-    # 历史记录跳过图片，只回忆30分钟前的
-    histories = msg_storage.list_previous_messages(
-        session_id,
-        datetime.fromtimestamp((current_timestamp() - 30 * 60 * 1000) / 1000),
-    )
-    previous = [h for h in histories if h.type_ == "text" and h.id not in message_ids]
-    histories_content = "\n".join(
-        [
-            f"#{p.created_at.strftime(DATE_TIME_PATTERN)} #{p.from_} #{p.content}"
-            for p in previous
-        ]
+    graph = _pre_completion_graph(
+        messages, previous, summary, is_text_type, ai_consider, web_search, batched_decide,
+        speculate=functools.partial(_speculate, web_search),
     )
-    # 字数太多影响发挥，压缩一下
-    if len(histories_content) > 300:
-        histories_content = ai_consider(
-            histories_compress_prompt.format(
-                user=messages[0].from_,
-                histories="\n".join(
-                    [
-                        f"#{p.created_at.strftime(DATE_TIME_PATTERN)} #{p.from_} #{p.content}"
-                        for p in previous
-                    ]
-                ),
-            )
-        )
-
-    llm_messages = [
-        LlmMessage(
-            role=SYSTEM_ROLE, content=system_prompt.format(histories=histories_content)
-        )
-    ]
+    futures = graph.run(stage_executor)
+    histories_content = futures["histories"].result()
+    if _summary_outdated(previous, summary):
+        summary_storage.save_summary(session_id, histories_content, previous[-1].id)
 
     # 目前问题
     # 重写基本无效
     # 多轮下来有点弱智，不能简单把记录放到system，前面总结一部份记录，然后role message放6条试一试
     # 图片识别，prompt需要调整，一张也会分几张说
 
-    is_text_type = all([m.type_ == "text" for m in messages])
+    searched = False
+    question, search_contexts = None, None
     if is_text_type:
         question = "\n".join([m.content for m in messages])
-        # 结合历史问题重写
-        question_rewrite = ai_consider(question_rewrite_prompt.format(histories=histories_content, content=question))
-        logger.info(f"【{messages[0].from_}】question rewrite：{question}")
+        question_rewrite = futures["rewrite"].result()
+        logger.info(f"【{messages[0].from_}】question rewrite：{question_rewrite}")
 
-        is_net_search = ai_consider(net_search_prompt.format(content=question_rewrite))
+        is_net_search = futures["decide"].result()
         logger.info(f"【{messages[0].from_}】：{question}")
         logger.info(f"【{messages[0].from_}】问题是否搜索：{is_net_search}")
 
         if is_net_search == "是":
-            intent, search_contexts, links = web_search_pro(question)
+            searched = True
+            intent, search_contexts, links = futures["search"].result()
+            search_contexts, links = _rerank_search(question_rewrite, search_contexts, links)
             logger.info(f"【{messages[0].from_}】搜索意图：{intent}")
             # todo 保存一下相关意图和问题，方便调整
             # 意图识别，可以直接返回微信的内置tag链接
@@ -135,82 +299,558 @@ def chat(message_ids: List[str]):
             # 发一个过去让客户知道关联的链接
             link_content = '\n'.join(links[0:2])
             _build_and_send_reply_msg(f"挑了些链接。\n{link_content}", messages[0].to, messages[0].from_, session_id, is_group)
+            question = question_rewrite
+        # 没搜索时预先发起的搜索用不上，结果直接丢弃
 
-            llm_messages.append(
-                LlmMessage(
-                    role=USER_ROLE,
-                    content=net_search_context_prompt.format(
-                        net_content="\n".join(search_contexts[0:10]), question=question_rewrite
-                    ),
-                )
+    llm_messages = _build_llm_messages(messages, histories_content, question, search_contexts)
+    logger.info(f"【{messages[0].from_}】pre-completion stages: {graph.report(_used_stages(searched))}")
+
+    # 汇总信息，获取最终llm信息
+    begin_at = datetime.now()
+    features = _route_features(messages, question, searched)
+    if CHAT_STREAM:
+        _stream_and_reply(llm_messages, features, begin_at, messages)
+        return
+    llm_result, model, route = routed_chat_completions(llm_messages, features, temperature=0.1)
+    logger.info(f"【{messages[0].from_}】route: {route}")
+    _save_and_reply(llm_messages, llm_result, route, begin_at, messages)
+
+
+async def _achat(message_ids: List[str]):
+    messages, previous, summary = await asyncio.to_thread(_load_messages, message_ids)
+    session_id = messages[0].session_id
+    is_group = messages[0].is_group
+    is_text_type = all([m.type_ == "text" for m in messages])
+
+    graph = _pre_completion_graph(messages, previous, summary, is_text_type, aai_consider, aweb_search, abatched_decide)
+    tasks = graph.arun()
+    histories_content = await tasks["histories"]
+    if _summary_outdated(previous, summary):
+        await asyncio.to_thread(summary_storage.save_summary, session_id, histories_content, previous[-1].id)
+
+    searched = False
+    question, search_contexts = None, None
+    if is_text_type:
+        question = "\n".join([m.content for m in messages])
+        question_rewrite = await tasks["rewrite"]
+        logger.info(f"【{messages[0].from_}】question rewrite：{question_rewrite}")
+
+        is_net_search = await tasks["decide"]
+        logger.info(f"【{messages[0].from_}】问题是否搜索：{is_net_search}")
+
+        if is_net_search == "是":
+            searched = True
+            intent, search_contexts, links = await tasks["search"]
+            search_contexts, links = _rerank_search(question_rewrite, search_contexts, links)
+            logger.info(f"【{messages[0].from_}】搜索意图：{intent}")
+
+            link_content = '\n'.join(links[0:2])
+            await asyncio.to_thread(
+                _build_and_send_reply_msg, f"挑了些链接。\n{link_content}", messages[0].to, messages[0].from_, session_id, is_group
             )
+            question = question_rewrite
         else:
-            llm_messages.append(LlmMessage(role=USER_ROLE, content=question))
+            graph.cancel("search")
 
+    llm_messages = _build_llm_messages(messages, histories_content, question, search_contexts)
+    logger.info(f"【{messages[0].from_}】pre-completion stages: {graph.report(_used_stages(searched))}")
+
+    begin_at = datetime.now()
+    features = _route_features(messages, question, searched)
+    if CHAT_STREAM:
+        await _astream_and_reply(llm_messages, features, begin_at, messages)
+        return
+    llm_result, model, route = await arouted_chat_completions(llm_messages, features, temperature=0.1)
+    logger.info(f"【{messages[0].from_}】route: {route}")
+    await asyncio.to_thread(_save_and_reply, llm_messages, llm_result, route, begin_at, messages)
+
+
+def _route_features(messages: List[Message], question: Optional[str], searched: bool) -> RouteFeatures:
+    types = {m.type_ for m in messages}
+    type_ = "text" if types == {"text"} else "+".join(sorted(types))
+    return RouteFeatures(
+        type_=type_,
+        length=len(question or ""),
+        searched=searched,
+        has_images="pic" in types,
+    )
+
+
+def _rerank_search(question: str, contexts: List[str], links: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    搜索结果按与（重写后的）问题的 BM25 相关度排序，只保留前 SEARCH_TOP_K 条
+    """
+    if SEARCH_TOP_K <= 0:
+        return contexts, links
+    ranked = rerank(question, contexts, SEARCH_TOP_K)
+    return [contexts[i] for i in ranked], [links[i] for i in ranked]
+
+
+def _used_stages(searched: bool) -> List[str]:
+    """本轮实际用到结果的阶段，预先发起但被丢弃的搜索不计入关键路径"""
+    return ["histories", "rewrite", "decide"] + (["search"] if searched else [])
+
+
+def _pre_completion_graph(
+    messages: List[Message],
+    previous: List[Message],
+    summary: Optional[SessionSummary],
+    is_text_type: bool,
+    consider: Callable[[str], Any],
+    search: Callable[[str], Any],
+    decide: Optional[Callable[[str], Any]] = None,
+    speculate: Optional[Callable[[str], Optional[Future]]] = None,
+) -> StageGraph:
+    """
+    请求最终 completion 之前的阶段：
+    histories（历史压缩） -> rewrite（问题重写） -> decide（是否搜索） -> search（搜索）
+
+    历史记录太长时使用 session 的滚动总结，只把总结之后新增的记录合并进去，每轮的压缩开销是固定的；
+
+    search 只依赖原始问题，CHAT_SPECULATIVE_SEARCH 时与其他阶段同时发起，不需要时结果丢弃：
+    协程里作为阶段直接发起，不需要时取消；线程池里取消不了，由 speculate 在单独的线程池里发起，
+    search 阶段等 decide 判断需要搜索后再取结果，没能预先发起时正常搜索；
+    CHAT_FAST_SEARCH_DECISION 时 decide 直接判断原始问题，与历史压缩、重写并发。
+    consider / search 同步异步均可，决定了图用 run 还是 arun 执行；
+    decide 直接判断问题是否需要搜索（跨 session 攒批），不传时用 consider + net_search_prompt
+    """
+    histories_content = _format_histories(previous)
+    graph = StageGraph()
+    # 字数太多影响发挥，压缩一下
+    if len(histories_content) <= 300:
+        graph.add("histories", lambda: histories_content)
+    elif summary is None:
+        graph.add(
+            "histories",
+            lambda: consider(
+                histories_compress_prompt.format(
+                    user=messages[0].from_, histories=histories_content
+                )
+            ),
+        )
+    elif not _summary_outdated(previous, summary):
+        graph.add("histories", lambda: summary.summary)
     else:
-        question = "\n".join([m.content for m in messages if m.type_ == "text"])
-        # todo voice
-        links = [m for m in messages if m.type_ == "link"]
-        pics = [m for m in messages if m.type_ == "pic"]
+        fresh = _format_histories([p for p in previous if p.id > summary.last_message_id])
+        graph.add(
+            "histories",
+            lambda: consider(
+                histories_fold_prompt.format(
+                    user=messages[0].from_, summary=summary.summary, histories=fresh
+                )
+            ),
+        )
+    if not is_text_type:
+        return graph
+
+    question = "\n".join([m.content for m in messages])
+    # 结合历史问题重写
+    graph.add(
+        "rewrite",
+        lambda histories: consider(
+            question_rewrite_prompt.format(histories=histories, content=question)
+        ),
+        deps=("histories",),
+    )
+    if decide is None:
 
+        def decide(content: str):
+            return consider(net_search_prompt.format(content=content))
+
+    if CHAT_FAST_SEARCH_DECISION:
+        graph.add("decide", lambda: decide(question))
+    else:
+        graph.add("decide", decide, deps=("rewrite",))
+    if CHAT_SPECULATIVE_SEARCH and speculate is None:
+        graph.add("search", lambda: search(question))
+    else:
+        speculated = speculate(question) if CHAT_SPECULATIVE_SEARCH else None
+        graph.add(
+            "search",
+            lambda decision: (speculated.result() if speculated else search(question)) if decision == "是" else None,
+            deps=("decide",),
+        )
+    return graph
+
+
+_speculative_slots = BoundedSemaphore(CHAT_SPECULATIVE_SEARCH_WORKERS)
+
+
+def _speculate(search: Callable[[str], Any], question: str) -> Optional[Future]:
+    """
+    在 speculative_executor 上预先发起搜索，线程都在忙（上游搜索变慢）时放弃，不排队
+    :return: 搜索的 future，放弃时为 None
+    """
+    if not _speculative_slots.acquire(blocking=False):
+        return None
+    # 带上截止时间等 context 变量
+    future = speculative_executor.submit(contextvars.copy_context().run, search, question)
+    future.add_done_callback(lambda _: _speculative_slots.release())
+    return future
+
+
+def _load_messages(message_ids: List[str]) -> Tuple[List[Message], List[Message], Optional[SessionSummary]]:
+    """
+    :return: 本轮消息 & 30分钟内的历史文字消息 & 30分钟内更新过的滚动总结
+    """
+    # 收消息时开始的链接抓取，与 debounce 的等待时间重叠
+    link_service.wait_prefetch(message_ids)
+    with session_scope() as db:
+        messages = msg_storage.list_messages(db, message_ids)
+    # 补抓链接要访问外网，不占着数据库连接；抓到的重新查一次
+    fetched = link_service.ensure_fetched(messages)
+    if fetched:
+        with session_scope() as db:
+            reloaded = {m.id: m for m in msg_storage.list_messages(db, fetched)}
+        messages = [reloaded.get(m.id, m) for m in messages]
+
+    # 历史记录跳过图片，只回忆30分钟前的
+    since = datetime.fromtimestamp((current_timestamp() - 30 * 60 * 1000) / 1000)
+    histories = msg_storage.list_previous_messages(messages[0].session_id, since)
+    previous = [h for h in histories if h.type_ == "text" and h.id not in message_ids]
+    summary = summary_storage.get_summary(messages[0].session_id, since)
+    return messages, previous, summary
+
+
+def _summary_outdated(previous: List[Message], summary: Optional[SessionSummary]) -> bool:
+    """
+    历史记录需要压缩，且有还没合并进滚动总结的记录
+    """
+    if len(_format_histories(previous)) <= 300:
+        return False
+    return summary is None or previous[-1].id > summary.last_message_id
+
+
+def _format_histories(previous: List[Message]) -> str:
+    return "\n".join(
+        [
+            f"#{p.created_at.strftime(DATE_TIME_PATTERN)} #{p.from_} #{p.content}"
+            for p in previous
+        ]
+    )
+
+
+def _build_llm_messages(
+    messages: List[Message],
+    histories_content: str,
+    question: Optional[str] = None,
+    search_contexts: Optional[List[str]] = None,
+) -> List[LlmMessage]:
+    """
+    按 token 预算组装最终 completion 的消息，优先级：
+    system prompt 模板 & 问题 & 图片 > 搜索结果 / 链接内容 > 历史记录
+    :param question: 纯文字消息的问题，有搜索结果时为重写后的问题
+    """
+    builder = ContextBuilder()
+    builder.reserve("system", system_prompt.format(histories=""))
+
+    if question is not None and search_contexts is None:
+        builder.reserve("question", question)
         content = question
-        if links:
-            # todo 因为没有链接总结，因此准确率很低
-            net_content = ""
-            for index, l in enumerate(links, start=1):
-                net_content += (
-                    f"{index}. {str(l.message_extra.content_bytes, encoding='UTF-8')}"
-                )
-            content = net_search_context_prompt.format(
-                net_content=net_content, question=question
-            )
-        if pics:
-            pic_contents = [
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{b64encode(p.message_extra.content_bytes).decode('UTF-8')}"
-                    },
-                }
-                for p in pics
-            ]
-            content = [{"type": "text", "text": content or pic_default_prompt}] + pic_contents
-        llm_messages.append(LlmMessage(role=USER_ROLE, content=content))
+    elif question is not None:
+        builder.reserve("question", net_search_context_prompt.format(net_content="", question=question))
+        # 给历史记录留 1/4
+        snippets = builder.fit_items("search", search_contexts, max_tokens=builder.remaining * 3 // 4)
+        content = net_search_context_prompt.format(net_content="\n".join(snippets), question=question)
+    else:
+        content = _build_rich_content(messages, builder)
 
-    # 汇总信息，获取最终llm信息
-    begin_at = datetime.now()
-    llm_result = chat_completions(llm_messages, "gpt-4o", temperature=0.1)
+    histories = builder.fit("histories", histories_content, keep_tail=True)
+    logger.info(f"【{messages[0].from_}】context {builder.report()}")
+    return [
+        LlmMessage(role=SYSTEM_ROLE, content=system_prompt.format(histories=histories)),
+        LlmMessage(role=USER_ROLE, content=content),
+    ]
+
+
+def _build_rich_content(messages: List[Message], builder: ContextBuilder):
+    """
+    非纯文字的消息，拼接链接内容和图片；多个链接平分 3/4 的剩余预算
+    """
+    question = "\n".join([m.content for m in messages if m.type_ == "text"])
+    # todo voice
+    links = [m for m in messages if m.type_ == "link"]
+    pics = [m for m in messages if m.type_ == "pic"]
+
+    builder.reserve("question", question)
+    builder.reserve("pics", tokens=IMAGE_TOKENS * len(pics))
+    content = question
+    if links:
+        builder.reserve("link_prompt", net_search_context_prompt.format(net_content="", question=""))
+        # todo 因为没有链接总结，因此准确率很低
+        per_link = builder.remaining * 3 // 4 // len(links)
+        net_content = ""
+        for index, l in enumerate(links, start=1):
+            # 抓取失败的链接没有内容
+            page = l.message_extra.link_text if l.message_extra else ""
+            text = builder.fit(f"link{index}", page, max_tokens=per_link)
+            net_content += f"{index}. {text}"
+        content = net_search_context_prompt.format(
+            net_content=net_content, question=question
+        )
+    if pics:
+        pic_contents = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": _image_url(p)
+                },
+            }
+            for p in pics
+        ]
+        content = [{"type": "text", "text": content or pic_default_prompt}] + pic_contents
+    return content
+
+
+def _image_url(message: Message) -> str:
+    extra = message.message_extra
+    # 之前缩放的图片都是 jpeg，没有记录格式
+    content_type = (extra.content_meta or {}).get("resize_content_type", "image/jpeg")
+    if extra.blob_digest:
+        return blob_service.image_url(extra.blob_digest, content_type)
+    return f"data:{content_type};base64,{b64encode(blob_service.read(extra)).decode('UTF-8')}"
+
+
+def _image_digests(llm_messages: List[LlmMessage], messages: List[Message]) -> Dict[str, str]:
+    """图片按消息的顺序拼在最后一条 content 里，审计记录直接用已知的 digest，不用再解码计算"""
+    content = llm_messages[-1].content
+    if not isinstance(content, list):
+        return {}
+    pics = [m for m in messages if m.type_ == "pic"]
+    parts = [p for p in content if p.get("type") == "image_url"]
+    return {
+        p["image_url"]["url"]: m.message_extra.blob_digest
+        for p, m in zip(parts, pics)
+        if m.message_extra and m.message_extra.blob_digest
+    }
+
+
+def _save_and_reply(llm_messages: List[LlmMessage], llm_result, route: str, begin_at: datetime, messages: List[Message]):
     db_completion = completion_storage.save_llm_result(
-        [m.model_dump() for m in llm_messages], llm_result, begin_at, messages[0].from_
+        audit_service.compact_request([m.model_dump() for m in llm_messages], digests=_image_digests(llm_messages, messages)),
+        llm_result, begin_at, messages[0].from_,
+        route=route, persist=_persist,
+    )
+    _build_and_send_reply_msg(db_completion.result, messages[0].to, messages[0].from_, messages[0].session_id, messages[0].is_group)
+
+
+def _stream_and_reply(llm_messages: List[LlmMessage], features: RouteFeatures, begin_at: datetime, messages: List[Message]):
+    """
+    流式获取 completion，每切出一段就发出去，结束后再记录完整的 completion。
+    已经发出去的内容收不回来，流式时只路由不升级
+    """
+    m = messages[0]
+    model, route = model_router.route(features)
+    stream = stream_chat_completions(llm_messages, model, temperature=0.1)
+    chunker = SentenceChunker(CHAT_STREAM_MIN_CHARS)
+    sent = 0
+    for delta in stream:
+        for chunk in chunker.feed(delta):
+            # 群聊只在第一段 @ 对方
+            _build_and_send_reply_msg(chunk, m.to, m.from_, m.session_id, m.is_group, mention=sent == 0)
+            sent += 1
+    tail = chunker.flush()
+    if tail:
+        _build_and_send_reply_msg(tail, m.to, m.from_, m.session_id, m.is_group, mention=sent == 0)
+    model_router.record(model, (datetime.now() - begin_at).total_seconds())
+    completion_storage.save_completion(
+        audit_service.compact_request([lm.model_dump() for lm in llm_messages], digests=_image_digests(llm_messages, messages)),
+        stream.content, stream.response_body(), stream.usage, begin_at, m.from_,
+        model=model, route=route, persist=_persist,
+    )
+
+
+async def _astream_and_reply(llm_messages: List[LlmMessage], features: RouteFeatures, begin_at: datetime, messages: List[Message]):
+    m = messages[0]
+    model, route = model_router.route(features)
+    stream = await astream_chat_completions(llm_messages, model, temperature=0.1)
+    chunker = SentenceChunker(CHAT_STREAM_MIN_CHARS)
+    sent = 0
+    async for delta in stream:
+        for chunk in chunker.feed(delta):
+            await asyncio.to_thread(
+                _build_and_send_reply_msg, chunk, m.to, m.from_, m.session_id, m.is_group, mention=sent == 0
+            )
+            sent += 1
+    tail = chunker.flush()
+    if tail:
+        await asyncio.to_thread(
+            _build_and_send_reply_msg, tail, m.to, m.from_, m.session_id, m.is_group, mention=sent == 0
+        )
+    model_router.record(model, (datetime.now() - begin_at).total_seconds())
+    # 精简请求时第一次用到模板会写库
+    request = await asyncio.to_thread(
+        audit_service.compact_request, [lm.model_dump() for lm in llm_messages], digests=_image_digests(llm_messages, messages)
+    )
+    await asyncio.to_thread(
+        functools.partial(completion_storage.save_completion, model=model, route=route, persist=_persist),
+        request, stream.content, stream.response_body(), stream.usage, begin_at, m.from_,
     )
-    _build_and_send_reply_msg(db_completion.result, messages[0].to, messages[0].from_, session_id, is_group)
 
 
-def _build_and_send_reply_msg(content, from_, to, session_id, is_group):
+def _build_and_send_reply_msg(content, from_, to, session_id, is_group, mention=True):
     reply_msg = Message(
         type_="text",
-        content=content if not is_group else f"@{to} {content}",
+        content=content if not (is_group and mention) else f"@{to} {content}",
         from_=from_,
         to=to,
         session_id=session_id,
         is_group=is_group,
+        # 由本进程发送，直接记为已抢占
+        state=msg_storage.STATE_SENDING,
+        claimed_at=datetime.now(),
         created_at=datetime.now(),
     )
-    save_entity(reply_msg)
-    message_reply_queue.send(session_id, reply_msg.id)
+    if write_behind is not None:
+        reply_msg.id = reply_ids.next()
+    _persist(reply_msg)
+    message_reply_queue.send(session_id, reply_msg.id, reply_msg.content, claimed=True)
+
+
+def _persist(entity):
+    """开启 write behind 时放进缓冲区，由后台线程批量写入"""
+    if write_behind is not None:
+        write_behind.add(entity)
+    else:
+        save_entity(entity)
 
 
-def reply(message_id: str):
-    db = next(get_db())
-    message = msg_storage.list_messages(db, message_id)[0]
+def reply(items: List[ReplyItem]):
+    """
+    按顺序发送同一个 session 积压的回复，CHAT_CALLBACK_BATCH_SIZE > 1 时合并为一次回调。
+    本进程刚生成的回复直接发送，不等写库；重放、重试的回复发送前先抢占，重复入队的只发送一次。
+    某一批重试后还是发送失败时，这一批和后面的放回队首，退避一段时间后再按顺序发送
+    """
+    try:
+        items = _claim_replies(items)
+    except Exception as e:
+        _retry_later(items, e)
+        return
+    batches = _batched(items, CHAT_CALLBACK_BATCH_SIZE)
+    for n, batch in enumerate(batches):
+        try:
+            _post_reply(batch[0].session_id, "\n\n".join([i.content for i in batch]))
+        except Exception as e:
+            _retry_later([i for b in batches[n:] for i in b], e)
+            return
+        _mark_sent(batch)
+
 
-    resp = requests.post(
+async def areply(items: List[ReplyItem]):
+    try:
+        items = await asyncio.to_thread(_claim_replies, items)
+    except Exception as e:
+        await asyncio.to_thread(_retry_later, items, e)
+        return
+    batches = _batched(items, CHAT_CALLBACK_BATCH_SIZE)
+    for n, batch in enumerate(batches):
+        try:
+            await _apost_reply(batch[0].session_id, "\n\n".join([i.content for i in batch]))
+        except Exception as e:
+            await asyncio.to_thread(_retry_later, [i for b in batches[n:] for i in b], e)
+            return
+        await asyncio.to_thread(_mark_sent, batch)
+
+
+def _claim_replies(items: List[ReplyItem]) -> List[ReplyItem]:
+    """
+    本进程已经抢占的直接保留，其余的到数据库抢占，抢不到的（其他实例在发、已经发过）丢掉
+    :return: 抢占到的回复，都标记为 claimed
+    """
+    unclaimed = [i.msg_id for i in items if not i.claimed]
+    if not unclaimed:
+        return items
+    if write_behind is not None and any(i.attempts for i in items if not i.claimed):
+        # 发送失败放回来的回复，改回 unsent 的状态变更可能还在缓冲区里
+        write_behind.flush()
+    claimed, kept = set(msg_storage.claim_replies(unclaimed)), []
+    for i in items:
+        if i.claimed:
+            kept.append(i)
+        elif i.msg_id in claimed:
+            # 同一条回复在队列里出现两次时只保留第一次
+            claimed.discard(i.msg_id)
+            kept.append(i._replace(claimed=True))
+    return kept
+
+
+def _set_reply_state(items: List[ReplyItem], state: str):
+    ids = [i.msg_id for i in items]
+    if write_behind is not None:
+        # 回复消息可能还在缓冲区里，状态变更排在它后面写入
+        write_behind.add(_StateChange(ids, state))
+    else:
+        msg_storage.update_state(ids, state)
+
+
+def _mark_sent(batch: List[ReplyItem]):
+    try:
+        _set_reply_state(batch, msg_storage.STATE_SENT)
+    except Exception as e:
+        # 已经发出去了，不能重发；状态停在 sending，超过 QUEUE_RECOVER_STALE_SECONDS 后由重放补发
+        log_exception(e)
+
+
+def _retry_later(items: List[ReplyItem], error: Exception):
+    """已经抢占的改回 unsent，放回队首；重新发送前再抢占一次"""
+    if not items:
+        return
+    log_exception(error)
+    attempts = items[0].attempts + 1
+    delay = min(2 ** attempts, CHAT_CALLBACK_REQUEUE_MAX_DELAY)
+    logger.warning(f"reply to {items[0].session_id} failed {attempts} times, retry {len(items)} replies in {delay}s")
+    claimed = [i for i in items if i.claimed]
+    if claimed:
+        try:
+            _set_reply_state(claimed, msg_storage.STATE_UNSENT)
+        except Exception as e:
+            # 改不回 unsent 时重新入队的回复抢占不到，等 sending 超时后由重放补发
+            log_exception(e)
+    message_reply_queue.retry([i._replace(attempts=attempts, claimed=False) for i in items], delay)
+
+
+def _batched(items: List[ReplyItem], size: int) -> List[List[ReplyItem]]:
+    size = max(size, 1)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+@retry(
+        wait=wait_random_exponential(multiplier=1, max=10),
+        stop=stop_after_attempt(CHAT_CALLBACK_RETRIES),
+        retry=retry_if_exception_type(httpx.HTTPError),
+        reraise=True,
+    )
+def _post_reply(session_id: str, content: str):
+    resp = http_client.post(
+        CHAT_CALLBACK_URL,
+        params={
+            "session_id": session_id,
+            "msg": content,
+        },
+        timeout=CHAT_CALLBACK_TIMEOUT,
+    )
+    logger.info(
+        f"send to wechat. response state: {resp.status_code}, text: {resp.text}"
+    )
+    resp.raise_for_status()
+
+
+@retry(
+        wait=wait_random_exponential(multiplier=1, max=10),
+        stop=stop_after_attempt(CHAT_CALLBACK_RETRIES),
+        retry=retry_if_exception_type(httpx.HTTPError),
+        reraise=True,
+    )
+async def _apost_reply(session_id: str, content: str):
+    resp = await async_http_client.post(
         CHAT_CALLBACK_URL,
         params={
-            "session_id": message.session_id,
-            "msg": message.content,
+            "session_id": session_id,
+            "msg": content,
         },
+        timeout=CHAT_CALLBACK_TIMEOUT,
     )
     logger.info(
         f"send to wechat. response state: {resp.status_code}, text: {resp.text}"
     )
+    resp.raise_for_status()
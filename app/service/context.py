@@ -0,0 +1,114 @@
+import re
+from typing import Callable, List, Optional, Tuple
+
+from app import CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_ESTIMATOR
+from app.logging_ import logger
+
+# 512px 以内的图片按 1 个 tile 计：85 + 170
+IMAGE_TOKENS = 255
+
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def heuristic_tokens(text: str) -> int:
+    """
+    不依赖 tokenizer 的估算：中日韩字符每个约 1 token，其余约 4 个字符 1 token，宁可略微高估
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _tiktoken_estimator() -> Callable[[str], int]:
+    # 可选依赖，没有安装时退回到估算
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken not installed, fallback to heuristic token estimator")
+        return heuristic_tokens
+
+    encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=())) if text else 0
+
+
+def get_estimator(name: str = CONTEXT_TOKEN_ESTIMATOR) -> Callable[[str], int]:
+    if name == "tiktoken":
+        return _tiktoken_estimator()
+    return heuristic_tokens
+
+
+class ContextBuilder:
+    """
+    按 token 预算组装 prompt。
+
+    调用顺序即优先级：先 reserve 必须完整保留的部分（system prompt 模板、问题），
+    再依次 fit 可裁剪的部分（搜索结果、链接内容、历史记录），预算用完后后面的部分被裁掉
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, estimate: Optional[Callable[[str], int]] = None):
+        self.budget = budget
+        self.estimate = estimate or get_estimator()
+        # (部分名称, 使用的 token, 原本需要的 token)
+        self.sections: List[Tuple[str, int, int]] = []
+
+    @property
+    def used(self) -> int:
+        return sum([used for _, used, _ in self.sections])
+
+    @property
+    def remaining(self) -> int:
+        return max(self.budget - self.used, 0)
+
+    def reserve(self, name: str, text: str = "", tokens: Optional[int] = None) -> str:
+        """必须保留的部分，超出预算也不裁剪"""
+        tokens = self.estimate(text) if tokens is None else tokens
+        self.sections.append((name, tokens, tokens))
+        return text
+
+    def fit(self, name: str, text: str, max_tokens: Optional[int] = None, keep_tail: bool = False) -> str:
+        """
+        裁剪文本到剩余预算（以及 max_tokens）以内
+        :param keep_tail: 保留末尾，历史记录越新越重要
+        """
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        need = self.estimate(text)
+        if need > limit:
+            text = self._truncate(text, limit, keep_tail)
+        self.sections.append((name, self.estimate(text), need))
+        return text
+
+    def fit_items(self, name: str, items: List[str], max_tokens: Optional[int] = None) -> List[str]:
+        """按顺序整条保留，放不下的条目丢弃"""
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        kept, used, need = [], 0, 0
+        for item in items:
+            tokens = self.estimate(item)
+            need += tokens
+            if used + tokens <= limit:
+                kept.append(item)
+                used += tokens
+        self.sections.append((name, used, need))
+        return kept
+
+    def report(self) -> str:
+        parts = ", ".join(
+            [f"{n} {u}" + (f"/{need}" if need > u else "") for n, u, need in self.sections]
+        )
+        return f"budget {self.used}/{self.budget}: {parts}"
+
+    def _truncate(self, text: str, limit: int, keep_tail: bool) -> str:
+        if limit <= 0:
+            return ""
+        # 二分找到预算内最长的前缀（或后缀）
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            part = text[-mid:] if keep_tail else text[:mid]
+            if self.estimate(part) <= limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        if lo == 0:
+            return ""
+        return text[-lo:] if keep_tail else text[:lo]
@@ -1,4 +1,5 @@
 import os
+import threading
 from typing import Optional
 from botocore.exceptions import ClientError
 
@@ -6,6 +7,7 @@ from app import (
     s3_client,
     S3_FILE_PATH_BASE,
     S3_BUCKET_NAME,
+    S3_ENDPOINT_DOMAIN,
     LOCAL_TEMP_FILE_PATH_BASE,
 )
 from app.logging_ import logger
@@ -20,12 +22,7 @@ def upload(content: bytes, path: str) -> tuple[str, str]:
     :return: 本地文件路径 & s3路径
     """
     with Timer(desc=f"Uploading {path} cost: "):
-        local_path = f"{LOCAL_TEMP_FILE_PATH_BASE}/{path}"
-        if not os.path.exists(local_path):
-            # 创建文件夹
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            with open(local_path, "wb") as f:
-                f.write(content)
+        local_path = save_local(content, path)
 
         s3_path = f"{S3_FILE_PATH_BASE}/{path}"
         s3_client.upload_file(local_path, S3_BUCKET_NAME, s3_path)
@@ -33,6 +30,36 @@ def upload(content: bytes, path: str) -> tuple[str, str]:
         return local_path, s3_path
 
 
+def save_local(content: bytes, path: str) -> str:
+    """
+    保存到本地，已经存在的不覆盖
+    :param path: 相对于 LOCAL_TEMP_FILE_PATH_BASE 的路径
+    :return: 本地文件路径
+    """
+    local_path = f"{LOCAL_TEMP_FILE_PATH_BASE}/{path}"
+    if not os.path.exists(local_path):
+        # 创建文件夹
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # 先写临时文件再改名，并发写同一个文件时读到的不会是半个文件
+        tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, local_path)
+    return local_path
+
+
+def read_local(path: str) -> Optional[bytes]:
+    """
+    :param path: 相对于 LOCAL_TEMP_FILE_PATH_BASE 的路径
+    :return: 本地不存在时为 None
+    """
+    local_path = f"{LOCAL_TEMP_FILE_PATH_BASE}/{path}"
+    if not os.path.exists(local_path):
+        return None
+    with open(local_path, "rb") as f:
+        return f.read()
+
+
 def fullpath_upload(local_path: str, s3_path: str) -> bool:
     """
     上传文件至S3
@@ -83,6 +110,30 @@ def get_local_file(path: str) -> str:
     return local_path
 
 
+def exists_remote(path: str) -> bool:
+    """
+    :param path: 相对于 LOCAL_TEMP_FILE_PATH_BASE 的路径
+    """
+    return _head_object(f"{S3_FILE_PATH_BASE}/{path}") is not None
+
+
+def presigned_url(path: str, expires: int) -> str:
+    """
+    :param path: 相对于 LOCAL_TEMP_FILE_PATH_BASE 的路径
+    :param expires: 有效秒数
+    """
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": S3_BUCKET_NAME, "Key": f"{S3_FILE_PATH_BASE}/{path}"},
+        ExpiresIn=expires,
+    )
+
+
+def public_url(path: str) -> str:
+    """公开读的 bucket，按 path 风格拼接访问地址"""
+    return f"{S3_ENDPOINT_DOMAIN.rstrip('/')}/{S3_BUCKET_NAME}/{S3_FILE_PATH_BASE}/{path}"
+
+
 def _head_object(path: str) -> Optional[dict]:
     """
     获取 s3 文件的 metadata
@@ -0,0 +1,74 @@
+import io
+from typing import NamedTuple
+
+from PIL import Image, ImageOps
+
+from app import IMAGE_MAX_SIDE, IMAGE_FORMAT, IMAGE_QUALITY
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+_EXIF_ORIENTATION = 0x0112
+
+
+class ImageResult(NamedTuple):
+    data: bytes
+    format: str
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    # 动图的帧数，只保留第一帧
+    frames: int
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+
+def resize(raw: bytes) -> ImageResult:
+    """
+    按配置缩放上传的图片，在进程池里执行，不占用接口线程的 GIL；IMAGE_WORKERS 为 0 时在当前线程执行
+    """
+    # 子进程只需要 process_image，不在模块级导入 app.core（导入时会启动队列线程）
+    from app.core import image_executor
+
+    if image_executor is None:
+        return process_image(raw, IMAGE_MAX_SIDE, IMAGE_FORMAT, IMAGE_QUALITY)
+    return image_executor.submit(process_image, raw, IMAGE_MAX_SIDE, IMAGE_FORMAT, IMAGE_QUALITY).result()
+
+
+def process_image(raw: bytes, max_side: int, format_: str, quality: int) -> ImageResult:
+    """
+    缩放到长边不超过 max_side，不放大：
+    JPEG 先用 draft 让解码器直接按 1/2、1/4、1/8 解码，再由 thumbnail 用 reduce + LANCZOS 缩到目标尺寸；
+    按 EXIF 方向摆正；动图取第一帧；透明背景在输出 JPEG 时铺白底
+    """
+    format_ = format_.upper()
+    if format_ not in CONTENT_TYPES:
+        raise ValueError(f"unsupported image format: {format_}")
+    img = Image.open(io.BytesIO(raw))
+    original_width, original_height = img.size
+    # exif 方向 5~8 需要旋转 90 度，摆正后的原图宽高互换
+    if img.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+        original_width, original_height = original_height, original_width
+    frames = getattr(img, "n_frames", 1)
+    # draft 得到的尺寸不小于请求的尺寸，留两倍给 LANCZOS 保证质量
+    img.draft("RGB", (max_side * 2, max_side * 2))
+    img = ImageOps.exif_transpose(img)
+    img = _flatten(img, keep_alpha=format_ == "WEBP")
+    img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+
+    bio = io.BytesIO()
+    img.save(bio, format=format_, quality=quality)
+    return ImageResult(bio.getvalue(), format_, img.width, img.height, original_width, original_height, frames)
+
+
+def _flatten(img: Image.Image, keep_alpha: bool) -> Image.Image:
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if not has_alpha:
+        return img.convert("RGB")
+    img = img.convert("RGBA")
+    if keep_alpha:
+        return img
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask=img.getchannel("A"))
+    return background
@@ -0,0 +1,331 @@
+import hashlib
+import re
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from bs4 import BeautifulSoup
+
+from app import (
+    http_client,
+    LINK_CONNECT_TIMEOUT,
+    LINK_READ_TIMEOUT,
+    LINK_TOTAL_TIMEOUT,
+    LINK_MAX_BYTES,
+    LINK_MAX_CHARS,
+    LINK_CACHE_TTL,
+)
+from app.core import link_executor
+from app.core.deadline import bounded_timeout
+from app.database import save_entity
+from app.logging_ import logger
+from app.model import link_cache as link_cache_storage
+from app.model import message as msg_storage
+from app.model.link_cache import LinkCache
+from app.model.message import Message, MessageExtra
+from app.service.net_search import normalize_url
+
+_HTML_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.I)
+# 导航、页眉页脚、侧栏、评论、分享、广告、推荐之类的样板内容
+_BOILERPLATE_TAGS = ["script", "style", "noscript", "iframe", "svg", "form", "nav", "header", "footer", "aside"]
+_BOILERPLATE_ATTR = re.compile(
+    r"nav|menu|footer|header|sidebar|comment|breadcrumb|share|social|advert|\bad[s_-]|banner|related|recommend|copyright",
+    re.I,
+)
+
+
+class LinkContent(NamedTuple):
+    url: str
+    status: int
+    content_type: str
+    charset: str
+    title: str
+    text: str
+    # 超过字节上限被截断
+    truncated: bool
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def fetch(url: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> LinkContent:
+    """
+    流式读取页面，连接、读取、总耗时都有超时，超过 LINK_MAX_BYTES 的部分不读；
+    只解析 html / 纯文本，其他类型返回空文本。
+    传入上次的 etag / last_modified 时发条件请求，未变化返回 304 和空文本
+    """
+    begin = time.monotonic()
+    total_timeout = bounded_timeout(LINK_TOTAL_TIMEOUT)
+    timeout = httpx.Timeout(
+        LINK_READ_TIMEOUT, connect=min(LINK_CONNECT_TIMEOUT, total_timeout)
+    )
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    with http_client.stream("GET", url, headers=headers, timeout=timeout, follow_redirects=True) as resp:
+        content_type = resp.headers.get("content-type", "")
+        mime = content_type.split(";")[0].strip().lower()
+        validators = (resp.headers.get("etag"), resp.headers.get("last-modified"))
+        if resp.status_code != 200 or mime not in _HTML_TYPES:
+            return LinkContent(str(resp.url), resp.status_code, mime, "", "", "", False, *validators)
+
+        chunks, size, truncated = [], 0, False
+        for chunk in resp.iter_bytes():
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= LINK_MAX_BYTES:
+                truncated = True
+                break
+            if time.monotonic() - begin > total_timeout:
+                logger.warning(f"fetch {url} exceeded {total_timeout}s, use partial body")
+                truncated = True
+                break
+        body = b"".join(chunks)[:LINK_MAX_BYTES]
+        charset = _detect_charset(resp.charset_encoding, body)
+
+    html = _decode(body, charset)
+    if mime == "text/plain":
+        return LinkContent(str(resp.url), 200, mime, charset, "", html[:LINK_MAX_CHARS], truncated, *validators)
+    title, text = extract_main_text(html)
+    return LinkContent(str(resp.url), 200, mime, charset, title, text[:LINK_MAX_CHARS], truncated, *validators)
+
+
+def cache_key(url: str) -> str:
+    return hashlib.sha256(normalize_url(url).encode("UTF-8")).hexdigest()
+
+
+_inflight: Dict[str, Future] = {}
+_inflight_lock = Lock()
+_counters = {"hits": 0, "revalidated": 0, "fetched": 0}
+
+
+def cached_fetch(url: str) -> Optional[LinkCache]:
+    """
+    先查按归一化 url 共享的抓取结果：没过期的直接用，不访问网络也不解析；
+    过期的带 etag / last_modified 重新验证，304 只延长过期时间；
+    同一个链接同时被多处分享时，只有一个线程去抓取，其他的等它的结果
+    :return: 抓取失败（非 200 且没有可用的缓存）时为 None
+    """
+    key = cache_key(url)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        return future.result(timeout=bounded_timeout(LINK_TOTAL_TIMEOUT))
+
+    try:
+        entry = _load_or_fetch(key, url)
+        future.set_result(entry)
+        return entry
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def stats() -> Dict[str, int]:
+    with _inflight_lock:
+        return dict(_counters, inflight=len(_inflight))
+
+
+def _load_or_fetch(key: str, url: str) -> Optional[LinkCache]:
+    entry = link_cache_storage.get_entry(key)
+    now = datetime.now()
+    if entry is not None and entry.expires_at > now:
+        _count("hits")
+        return entry
+
+    stale = entry if entry is not None and (entry.etag or entry.last_modified) else None
+    content = fetch(url, stale.etag, stale.last_modified) if stale else fetch(url)
+    expires_at = now + timedelta(seconds=LINK_CACHE_TTL)
+    if content.status == 304 and stale is not None:
+        _count("revalidated")
+        link_cache_storage.refresh_entry(key, now, expires_at)
+        stale.fetched_at, stale.expires_at = now, expires_at
+        return stale
+    if content.status != 200:
+        logger.info(f"scratch from url: {url}, status: {content.status}")
+        return None
+
+    _count("fetched")
+    logger.info(
+        f"scratch from url: {url}, status: {content.status}, type: {content.content_type}, "
+        f"charset: {content.charset}, chars: {len(content.text)}, truncated: {content.truncated}"
+    )
+    # 非 html 的页面也缓存下来（正文为空），避免每次分享都再请求一次
+    entry = LinkCache(
+        key=key,
+        url=url,
+        final_url=content.url,
+        status=content.status,
+        content_type=content.content_type,
+        charset=content.charset,
+        title=content.title,
+        text=content.text,
+        truncated=content.truncated,
+        etag=content.etag,
+        last_modified=content.last_modified,
+        fetched_at=now,
+        expires_at=expires_at,
+    )
+    link_cache_storage.save_entry(entry)
+    return entry
+
+
+def _count(name: str):
+    with _inflight_lock:
+        _counters[name] += 1
+
+
+def extract_main_text(html: str) -> Tuple[str, str]:
+    """
+    去掉脚本、导航、页眉页脚等样板内容后取正文：
+    优先 article / main，否则取直接包含段落文字最多的元素，都没有时退回整个 body
+    :return: 标题 & 正文
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    for tag in soup(_BOILERPLATE_TAGS):
+        tag.decompose()
+    total = len(soup.get_text(strip=True)) or 1
+    for tag in soup.find_all(attrs={"class": _BOILERPLATE_ATTR}) + soup.find_all(attrs={"id": _BOILERPLATE_ATTR}):
+        # 父节点已被移除的跳过
+        if tag.decomposed or tag.name in ("html", "body"):
+            continue
+        # 类似 with-sidebar 的外层容器，包含正文，不能整个去掉
+        if tag.find(["article", "main"]) is not None or len(tag.get_text(strip=True)) > total / 2:
+            continue
+        tag.decompose()
+
+    root = _main_element(soup)
+    if root is None:
+        return title, ""
+    lines = [line.strip() for line in root.get_text(separator="\n").splitlines()]
+    return title, "\n".join([line for line in lines if line])
+
+
+def _main_element(soup: BeautifulSoup):
+    for name in ("article", "main"):
+        candidates = soup.find_all(name)
+        if candidates:
+            return max(candidates, key=lambda c: len(c.get_text(strip=True)))
+
+    best, best_len = None, 0
+    for p in soup.find_all("p"):
+        parent = p.parent
+        if parent is None:
+            continue
+        length = sum([len(c.get_text(strip=True)) for c in parent.find_all("p", recursive=False)])
+        if length > best_len:
+            best, best_len = parent, length
+    # 段落太少时正文可能不在 p 里
+    if best is not None and best_len >= 200:
+        return best
+    return soup.body or soup
+
+
+def _detect_charset(header_charset: Optional[str], body: bytes) -> str:
+    if header_charset:
+        return header_charset
+    found = _META_CHARSET.search(body[:4096])
+    if found:
+        return found.group(1).decode("ascii")
+    return "utf-8"
+
+
+def _decode(body: bytes, charset: str) -> str:
+    try:
+        return body.decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        pass
+    # 没声明或声明错的中文页面多为 gbk
+    for fallback in ("utf-8", "gb18030"):
+        try:
+            return body.decode(fallback)
+        except UnicodeDecodeError:
+            continue
+    return body.decode("utf-8", errors="replace")
+
+
+_pending: Dict[int, Future] = {}
+_pending_lock = Lock()
+
+
+def prefetch(message_id: int, url: str):
+    """
+    收到链接消息时在后台开始抓取，不阻塞接口；chat 处理前用 wait_prefetch 等待结果
+    """
+    future = link_executor.submit(fetch_and_save, message_id, url)
+    with _pending_lock:
+        _pending[message_id] = future
+    future.add_done_callback(lambda _: _discard(message_id))
+
+
+def wait_prefetch(message_ids: List[int]):
+    """等待这些消息还在进行中的抓取，不超过当前的截止时间；失败的抓取不影响对话"""
+    with _pending_lock:
+        futures = [_pending[i] for i in message_ids if i in _pending]
+    for future in futures:
+        try:
+            future.result(timeout=bounded_timeout(LINK_TOTAL_TIMEOUT))
+        except FutureTimeoutError:
+            logger.warning("link prefetch not finished in time")
+        except Exception:
+            # fetch_and_save 已经记录了异常
+            pass
+
+
+def ensure_fetched(messages: List[Message]) -> List[int]:
+    """
+    没有抓取结果的链接消息（重启后重放、抓取失败）在这里再抓一次；要访问外网，不要在数据库 session 里调用。
+    预先抓取还没结束的（wait_prefetch 超时）跳过，不重复抓取，也不会给一条消息存两份结果
+    :return: 现在有了抓取结果、需要重新加载的消息 id
+    """
+    with _pending_lock:
+        missing = [m for m in messages if m.type_ == "link" and m.message_extra is None and m.id not in _pending]
+    if not missing:
+        return []
+    # 预先抓取可能在查出 messages 之后才保存完
+    fetched = set(msg_storage.list_extra_message_ids([m.id for m in missing]))
+    for m in missing:
+        if m.id not in fetched and fetch_and_save(m.id, m.content) is not None:
+            fetched.add(m.id)
+    return [m.id for m in missing if m.id in fetched]
+
+
+def fetch_and_save(message_id: int, url: str) -> Optional[MessageExtra]:
+    try:
+        entry = cached_fetch(url)
+    except Exception as e:
+        logger.warning(f"fetch {url} failed: {e!r}")
+        return None
+    if entry is None or not entry.text:
+        return None
+    # 正文只在 link_cache 里存一份，这里只保存引用
+    extra = MessageExtra(
+        message_id=message_id,
+        content_meta={
+            "link": url,
+            "final_url": entry.final_url,
+            "title": entry.title,
+            "charset": entry.charset,
+            "truncated": entry.truncated,
+        },
+        link_key=entry.key,
+    )
+    save_entity(extra)
+    return extra
+
+
+def _discard(message_id: int):
+    with _pending_lock:
+        _pending.pop(message_id, None)
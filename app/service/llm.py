@@ -1,5 +1,17 @@
-from typing import Any, List, Dict, Union
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+from threading import BoundedSemaphore, Lock
+from typing import Any, Awaitable, Callable, List, Dict, Optional, Tuple, Union
 
+import httpx
 import openai
 from tenacity import (
     retry,
@@ -10,37 +22,732 @@ from tenacity import (
 )
 from pydantic import BaseModel, Field
 
+from app import (
+    http_client,
+    async_http_client,
+    LLM_CACHE_SIZE,
+    LLM_CACHE_TTL,
+    LLM_CACHE_SHARED,
+    LLM_FAST_MODEL,
+    LLM_STRONG_MODEL,
+    LLM_ROUTE_SHORT_CHARS,
+    LLM_REQUEST_TIMEOUT,
+    LLM_CONNECT_TIMEOUT,
+    LLM_CALL_DEADLINE,
+    LLM_HEDGE,
+    LLM_HEDGE_QUANTILE,
+    LLM_HEDGE_MIN_DELAY,
+    CHAT_WORKERS,
+)
+from app.core import hedge_executor
+from app.core.deadline import (
+    DeadlineExceeded,
+    deadline,
+    bounded_timeout,
+    remaining,
+    stop_at_deadline,
+    wait_within_deadline,
+)
 from app.logging_ import logger
 
 SYSTEM_ROLE = "system"
 USER_ROLE = "user"
 
-client = openai.OpenAI()
+# 重试统一由 tenacity 按截止时间控制，关闭 sdk 自带的重试，否则两层重试次数相乘
+client = openai.OpenAI(
+    http_client=http_client,
+    timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    max_retries=0,
+)
+async_client = openai.AsyncOpenAI(
+    http_client=async_http_client,
+    timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    max_retries=0,
+)
 
 class LlmMessage(BaseModel):
     role: str
     content: str | List[Dict[str, Union[str, Dict[str, str]]]]
 
-@retry(
-        wait=wait_random_exponential(multiplier=3, max=60),
-        stop=stop_after_attempt(5),
-        retry=retry_if_exception_type(
-            (
-                openai.RateLimitError,
-                openai.APIError,
-                openai.InternalServerError,
-                openai.APITimeoutError,
+
+class RouteFeatures(BaseModel):
+    """用于选择模型的廉价特征"""
+
+    type_: str
+    length: int
+    searched: bool = False
+    has_images: bool = False
+
+
+class ModelRouter:
+    """
+    按消息特征选择最终回复使用的模型：短的纯文字闲聊走快模型，其余走强模型；
+    快模型的回答没通过检查时升级到强模型重新回答。
+    记录每个模型的调用次数和平均耗时，用于调整策略
+    """
+
+    # 快模型常见的放弃回答
+    _REFUSALS = ("抱歉，我无法", "抱歉，我不能", "我无法回答", "I'm sorry", "I cannot")
+
+    def __init__(self, fast_model: str, strong_model: str, short_chars: int):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.short_chars = short_chars
+        self._lock = Lock()
+        # model -> [调用次数, 总耗时秒数]
+        self._latency: Dict[str, List[float]] = {}
+        self._routes: Dict[str, int] = {}
+
+    def route(self, features: RouteFeatures) -> Tuple[str, str]:
+        """
+        :return: 模型 & 选择的原因
+        """
+        if features.has_images:
+            return self._count(self.strong_model, "images")
+        if features.type_ != "text":
+            return self._count(self.strong_model, features.type_)
+        if features.searched:
+            return self._count(self.strong_model, "searched")
+        if features.length > self.short_chars:
+            return self._count(self.strong_model, "long")
+        return self._count(self.fast_model, "short")
+
+    def escalation_reason(self, model: str, choice) -> Optional[str]:
+        """
+        快模型的回答是否需要升级，不需要时返回 None
+        """
+        if model == self.strong_model:
+            return None
+        content = (choice.message.content or "").strip()
+        if not content:
+            return "empty"
+        if choice.finish_reason == "length":
+            return "truncated"
+        if content.startswith(self._REFUSALS):
+            return "refusal"
+        return None
+
+    def record(self, model: str, seconds: float):
+        with self._lock:
+            entry = self._latency.setdefault(model, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "routes": dict(self._routes),
+                "models": {
+                    m: {"calls": int(c), "avg_ms": int(t / c * 1000)}
+                    for m, (c, t) in self._latency.items()
+                },
+            }
+
+    def _count(self, model: str, reason: str) -> Tuple[str, str]:
+        route = f"{model}:{reason}"
+        with self._lock:
+            self._routes[route] = self._routes.get(route, 0) + 1
+        return model, route
+
+
+model_router = ModelRouter(LLM_FAST_MODEL, LLM_STRONG_MODEL, LLM_ROUTE_SHORT_CHARS)
+
+
+class CompletionCache:
+    """
+    ai_consider 这类短 prompt 调用的结果缓存。
+
+    key 为 sha256(model, 参数, 归一化后的 prompt)；进程内是带 TTL 的 LRU，
+    shared 时再查一层数据库（llm_cache 表），多个实例共享；
+    同一个 key 同时只会有一个请求打到上游，其他调用等它的结果。
+
+    ttl_of 按结果决定过期秒数，返回 0 的结果不缓存；结果不是字符串时不能使用 shared。
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: int,
+        shared: bool = False,
+        ttl_of: Optional[Callable[[Any], int]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.ttl_of = ttl_of
+        self._lock = Lock()
+        # key -> (过期时间, 结果)
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._ainflight: Dict[str, asyncio.Future] = {}
+        self._counters = {"hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0}
+
+    @staticmethod
+    def key(model: str, params: Dict[str, Any], prompt: str) -> str:
+        normalized = re.sub(r"\s+", " ", prompt.strip())
+        raw = json.dumps([model, params, normalized], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("UTF-8")).hexdigest()
+
+    def cached(self, model: str, **params):
+        """
+        装饰 fn(prompt) -> str，同步、异步函数均可
+        """
+
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def async_wrapper(prompt: str):
+                    return await self.aget_or_compute(
+                        self.key(model, params, prompt), model, lambda: fn(prompt)
+                    )
+
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(prompt: str):
+                return self.get_or_compute(
+                    self.key(model, params, prompt), model, lambda: fn(prompt)
+                )
+
+            return wrapper
+
+        return decorator
+
+    def get_or_compute(self, key: str, model: str, compute: Callable[[], str]) -> str:
+        if self.maxsize <= 0:
+            return compute()
+
+        with self._lock:
+            hit = self._get_local(key)
+            if hit is not None:
+                return hit
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self._counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = self._get_shared(key)
+            if value is None:
+                value = compute()
+                self._save_shared(key, model, value)
+            self._put_local(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aget_or_compute(
+        self, key: str, model: str, compute: Callable[[], Awaitable[str]]
+    ) -> str:
+        """
+        协程版本，只在一个 event loop 上使用；数据库那一层放到线程里查
+        """
+        if self.maxsize <= 0:
+            return await compute()
+
+        with self._lock:
+            hit = self._get_local(key)
+            if hit is not None:
+                return hit
+        future = self._ainflight.get(key)
+        if future is not None:
+            with self._lock:
+                self._counters["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        future = self._ainflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await asyncio.to_thread(self._get_shared, key)
+            if value is None:
+                value = await compute()
+                await asyncio.to_thread(self._save_shared, key, model, value)
+            self._put_local(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时标记异常已读取
+            future.exception()
+            raise
+        finally:
+            self._ainflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), **self._counters}
+
+    def _get_local(self, key: str) -> Optional[str]:
+        """需持有锁调用"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self._counters["hits"] += 1
+        return value
+
+    def _put_local(self, key: str, value: str):
+        ttl = self.ttl if self.ttl_of is None else self.ttl_of(value)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, key: str) -> Optional[str]:
+        if self.shared:
+            from app.model import llm_cache as llm_cache_storage
+
+            value = llm_cache_storage.get_result(key)
+            if value is not None:
+                with self._lock:
+                    self._counters["shared_hits"] += 1
+                return value
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def _save_shared(self, key: str, model: str, value: str):
+        if not self.shared or value is None:
+            return
+        from app.model import llm_cache as llm_cache_storage
+
+        try:
+            llm_cache_storage.save_result(
+                key, model, value, datetime.now() + timedelta(seconds=self.ttl)
             )
-        ),
-    )
+        except Exception as e:
+            # 共享缓存写失败不影响本次结果
+            logger.warning(f"save llm cache failed: {e}")
+
+
+consider_cache = CompletionCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, shared=LLM_CACHE_SHARED)
+
+_RETRY_EXCEPTIONS = (
+    openai.RateLimitError,
+    openai.APIError,
+    openai.InternalServerError,
+    openai.APITimeoutError,
+)
+
+
+class RequestHedger:
+    """
+    请求超过该模型最近耗时的分位数还没返回时，再发一个相同的请求，先成功返回的为准。
+    用少量重复请求的费用换尾延迟；没有足够的耗时样本之前不 hedge。
+    同步调用在 pool 上最多同时占 slots 个线程，占满时直接在调用方线程请求、不 hedge，不会排在其他请求后面；
+    等待结果不超过当前的截止时间
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        quantile: float,
+        min_delay: float,
+        pool: Executor,
+        slots: int,
+        window: int = 200,
+        min_samples: int = 20,
+    ):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self._pool = pool
+        self._slots = BoundedSemaphore(slots) if slots > 0 else None
+        self._min_samples = min_samples
+        self._window = window
+        self._lock = Lock()
+        # model -> 最近成功请求的耗时
+        self._latency: Dict[str, deque] = {}
+        self._counters = {"hedged": 0, "hedge_wins": 0, "inline": 0}
+
+    def run(self, model: str, call: Callable[[], Any]) -> Any:
+        delay = self.delay(model)
+        if delay is None:
+            return self._timed(model, call)
+
+        primary = self._submit(model, call)
+        if primary is None:
+            self._count("inline")
+            return self._timed(model, call)
+        done, _ = wait([primary], timeout=_wait_timeout(delay))
+        if done:
+            return primary.result()
+
+        if _wait_timeout() == 0:
+            raise DeadlineExceeded()
+        # 线程都在忙时不 hedge，只等 primary
+        backup = self._submit(model, call)
+        pending, error = {primary}, None
+        if backup is not None:
+            self._count("hedged")
+            pending.add(backup)
+        while pending:
+            done, pending = wait(pending, timeout=_wait_timeout(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded()
+            for f in done:
+                if f.exception() is None:
+                    if f is backup:
+                        self._count("hedge_wins")
+                    # 落后的请求无法取消，结果直接丢弃
+                    return f.result()
+                error = error or f.exception()
+        raise error
+
+    async def arun(self, model: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        delay = self.delay(model)
+        if delay is None:
+            return await self._atimed(model, call)
+
+        primary = asyncio.ensure_future(self._atimed(model, call))
+        pending, error = {primary}, None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=_wait_timeout(delay))
+            if done:
+                return primary.result()
+
+            self._count("hedged")
+            backup = asyncio.ensure_future(self._atimed(model, call))
+            pending.add(backup)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=_wait_timeout(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise DeadlineExceeded()
+                for t in done:
+                    if t.exception() is None:
+                        if t is backup:
+                            self._count("hedge_wins")
+                        return t.result()
+                    error = error or t.exception()
+            raise error
+        finally:
+            for t in pending:
+                t.cancel()
+
+    def delay(self, model: str) -> Optional[float]:
+        """多久没返回就 hedge，None 表示不 hedge"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            samples = sorted(self._latency.get(model, ()))
+        if len(samples) < self._min_samples:
+            return None
+        index = min(int(len(samples) * self.quantile), len(samples) - 1)
+        return max(samples[index], self.min_delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        delays = {m: self.delay(m) for m in list(self._latency)}
+        return {**counters, "delays": {m: round(d, 3) for m, d in delays.items() if d is not None}}
+
+    def _submit(self, model: str, call: Callable[[], Any]) -> Optional[Future]:
+        """在 pool 上发起请求，slots 占满时返回 None"""
+        if self._slots is None or not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._pool.submit(self._timed, model, call)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _timed(self, model: str, call: Callable[[], Any]) -> Any:
+        begin = time.perf_counter()
+        result = call()
+        self._record(model, time.perf_counter() - begin)
+        return result
+
+    async def _atimed(self, model: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        begin = time.perf_counter()
+        result = await call()
+        self._record(model, time.perf_counter() - begin)
+        return result
+
+    def _record(self, model: str, seconds: float):
+        with self._lock:
+            self._latency.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+
+def _wait_timeout(default: Optional[float] = None) -> Optional[float]:
+    """等待的超时：不超过剩余时间，已经过了截止时间为 0"""
+    left = remaining()
+    if left is None:
+        return default
+    return max(min(left, default) if default is not None else left, 0)
+
+
+hedger = RequestHedger(LLM_HEDGE, LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_DELAY, hedge_executor, slots=CHAT_WORKERS * 4)
+
+
+def _request_timeout() -> httpx.Timeout:
+    """单次请求的超时，不超过当前截止时间的剩余时间"""
+    seconds = bounded_timeout(LLM_REQUEST_TIMEOUT)
+    return httpx.Timeout(seconds, connect=min(LLM_CONNECT_TIMEOUT, seconds))
+
+
 def chat_completions(messages: List[LlmMessage], model: str = "gpt-4o-mini", **kwargs):
-    return client.chat.completions.create(
-        messages=[m.model_dump() for m in messages],
-        model=model,
-        **kwargs,
+    """
+    一次调用（含重试）不超过 LLM_CALL_DEADLINE，也不超过所在对话的截止时间
+    """
+    with deadline(LLM_CALL_DEADLINE):
+        return _chat_completions(messages, model, **kwargs)
+
+
+@retry(
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(5) | stop_at_deadline(),
+        retry=retry_if_exception_type(_RETRY_EXCEPTIONS),
+    )
+def _chat_completions(messages: List[LlmMessage], model: str, **kwargs):
+    body = [m.model_dump() for m in messages]
+    # 超时在调用方线程计算，hedge 的线程里没有截止时间的 context
+    request_timeout = _request_timeout()
+    return hedger.run(
+        model,
+        lambda: client.chat.completions.create(
+            messages=body, model=model, timeout=request_timeout, **kwargs
+        ),
     )
 
 
+def routed_chat_completions(messages: List[LlmMessage], features: RouteFeatures, **kwargs) -> Tuple[Any, str, str]:
+    """
+    按特征选择模型请求 completion，快模型的回答不合格时升级到强模型
+    :return: completion & 使用的模型 & 路由记录
+    """
+    model, route = model_router.route(features)
+    begin = time.perf_counter()
+    result = chat_completions(messages, model, **kwargs)
+    model_router.record(model, time.perf_counter() - begin)
+
+    reason = model_router.escalation_reason(model, result.choices[0])
+    if reason is None:
+        return result, model, route
+
+    logger.info(f"escalate {model} -> {model_router.strong_model}, reason: {reason}")
+    model, route = model_router.strong_model, f"{route}>escalated:{reason}"
+    begin = time.perf_counter()
+    result = chat_completions(messages, model, **kwargs)
+    model_router.record(model, time.perf_counter() - begin)
+    return result, model, route
+
+
+async def arouted_chat_completions(messages: List[LlmMessage], features: RouteFeatures, **kwargs) -> Tuple[Any, str, str]:
+    model, route = model_router.route(features)
+    begin = time.perf_counter()
+    result = await achat_completions(messages, model, **kwargs)
+    model_router.record(model, time.perf_counter() - begin)
+
+    reason = model_router.escalation_reason(model, result.choices[0])
+    if reason is None:
+        return result, model, route
+
+    logger.info(f"escalate {model} -> {model_router.strong_model}, reason: {reason}")
+    model, route = model_router.strong_model, f"{route}>escalated:{reason}"
+    begin = time.perf_counter()
+    result = await achat_completions(messages, model, **kwargs)
+    model_router.record(model, time.perf_counter() - begin)
+    return result, model, route
+
+
+@consider_cache.cached("gpt-4o-mini")
 def ai_consider(content: str):
     resp = chat_completions([LlmMessage(role=USER_ROLE, content=content)])
     return resp.choices[0].message.content
+
+
+async def achat_completions(messages: List[LlmMessage], model: str = "gpt-4o-mini", **kwargs):
+    with deadline(LLM_CALL_DEADLINE):
+        return await _achat_completions(messages, model, **kwargs)
+
+
+@retry(
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(5) | stop_at_deadline(),
+        retry=retry_if_exception_type(_RETRY_EXCEPTIONS),
+    )
+async def _achat_completions(messages: List[LlmMessage], model: str, **kwargs):
+    body = [m.model_dump() for m in messages]
+    request_timeout = _request_timeout()
+    return await hedger.arun(
+        model,
+        lambda: async_client.chat.completions.create(
+            messages=body, model=model, timeout=request_timeout, **kwargs
+        ),
+    )
+
+
+@consider_cache.cached("gpt-4o-mini")
+async def aai_consider(content: str):
+    resp = await achat_completions([LlmMessage(role=USER_ROLE, content=content)])
+    return resp.choices[0].message.content
+
+
+class CompletionStream:
+    """
+    流式 completion，迭代得到增量文本；迭代结束后 content / usage 为汇总结果
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.id = None
+        self.model = None
+        self.content = ""
+        self.finish_reason = None
+        self.usage = None
+
+    def __iter__(self):
+        for chunk in self._stream:
+            delta = self._consume(chunk)
+            if delta:
+                yield delta
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            delta = self._consume(chunk)
+            if delta:
+                yield delta
+
+    def _consume(self, chunk) -> Optional[str]:
+        self.id = self.id or chunk.id
+        self.model = self.model or chunk.model
+        # include_usage 时最后一个 chunk 只有 usage，没有 choices
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        self.finish_reason = choice.finish_reason or self.finish_reason
+        delta = choice.delta.content
+        if delta:
+            self.content += delta
+        return delta
+
+    def response_body(self) -> Dict[str, Any]:
+        """与非流式的 ChatCompletion 结构保持一致，方便落库"""
+        return {
+            "id": self.id,
+            "model": self.model,
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": self.finish_reason,
+                    "message": {"role": "assistant", "content": self.content},
+                }
+            ],
+            "usage": self.usage.model_dump() if self.usage else None,
+        }
+
+
+def stream_chat_completions(messages: List[LlmMessage], model: str = "gpt-4o-mini", **kwargs) -> CompletionStream:
+    """
+    只重试建立连接，开始返回内容之后的错误直接抛出，避免重复发送已经回复的内容；
+    流式请求不 hedge，同样的内容会被发送两次
+    """
+    with deadline(LLM_CALL_DEADLINE):
+        return _stream_chat_completions(messages, model, **kwargs)
+
+
+@retry(
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(5) | stop_at_deadline(),
+        retry=retry_if_exception_type(_RETRY_EXCEPTIONS),
+    )
+def _stream_chat_completions(messages: List[LlmMessage], model: str, **kwargs) -> CompletionStream:
+    return CompletionStream(
+        client.chat.completions.create(
+            messages=[m.model_dump() for m in messages],
+            model=model,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=_request_timeout(),
+            **kwargs,
+        )
+    )
+
+
+async def astream_chat_completions(messages: List[LlmMessage], model: str = "gpt-4o-mini", **kwargs) -> CompletionStream:
+    with deadline(LLM_CALL_DEADLINE):
+        return await _astream_chat_completions(messages, model, **kwargs)
+
+
+@retry(
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(5) | stop_at_deadline(),
+        retry=retry_if_exception_type(_RETRY_EXCEPTIONS),
+    )
+async def _astream_chat_completions(messages: List[LlmMessage], model: str, **kwargs) -> CompletionStream:
+    return CompletionStream(
+        await async_client.chat.completions.create(
+            messages=[m.model_dump() for m in messages],
+            model=model,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=_request_timeout(),
+            **kwargs,
+        )
+    )
+
+
+class SentenceChunker:
+    """
+    把流式的增量文本按段落、句子切成适合逐条发送的片段。
+    段落（空行）一定切；句末标点只有在片段长度达到 min_chars 后才切，避免发出太碎的消息
+    """
+
+    _BOUNDARY = re.compile(r"\n\s*\n|[。！？!?；;…]+[”’」』）)\"']*|\.(?=\s)")
+
+    def __init__(self, min_chars: int):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, delta: str) -> List[str]:
+        self._buffer += delta
+        chunks = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return chunks
+            chunk, self._buffer = self._buffer[:cut].strip(), self._buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+
+    def flush(self) -> Optional[str]:
+        chunk, self._buffer = self._buffer.strip(), ""
+        return chunk or None
+
+    def _find_cut(self) -> Optional[int]:
+        for m in self._BOUNDARY.finditer(self._buffer):
+            if not m.group().strip():
+                if self._buffer[: m.start()].strip():
+                    return m.end()
+                continue
+            # 标点在末尾时可能还有后引号没到，等下一段再切
+            if m.end() >= self.min_chars and m.end() < len(self._buffer):
+                return m.end()
+        return None
@@ -1,8 +1,15 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Tuple
+from concurrent.futures import wait
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+import asyncio
+import contextvars
+import functools
+import inspect
+import re
+import unicodedata
 import uuid
-import requests
-from httpx import HTTPStatusError
+import httpx
 from requests import HTTPError
 from tenacity import (
     retry,
@@ -12,76 +19,298 @@ from tenacity import (
 )
 from duckduckgo_search import DDGS
 
-from app import ZHIPUAI_API_KEY
+from app import (
+    ZHIPUAI_API_KEY,
+    ZHIPUAI_BASE_URL,
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+    SEARCH_CACHE_INTENT_TTL,
+    SEARCH_FANOUT_TIMEOUT,
+    http_client,
+    async_http_client,
+)
+from app.core import search_executor
+from app.core.deadline import DeadlineExceeded, bounded_timeout, stop_at_deadline, wait_within_deadline
+from app.logging_ import logger
+from app.service.llm import consider_cache, CompletionCache
 
 client = DDGS()
 
+WEB_SEARCH_PRO_URL = f"{ZHIPUAI_BASE_URL}/tools"
+
+_INTENT_TTL = {
+    intent.strip(): int(ttl)
+    for intent, ttl in [item.split("=") for item in SEARCH_CACHE_INTENT_TTL.split(",") if item.strip()]
+}
+
+
+def _search_ttl(result) -> int:
+    """
+    web_search_pro 的结果按意图决定过期时间，天气、新闻这类很快过时；没有结果的不缓存
+    """
+    if not result:
+        return 0
+    if isinstance(result, tuple):
+        intent, results = result
+        if not results:
+            return 0
+        return _INTENT_TTL.get(intent, SEARCH_CACHE_TTL)
+    return SEARCH_CACHE_TTL
+
+
+class SearchCache(CompletionCache):
+    """
+    搜索结果缓存，key 为归一化后的查询：全角转半角、忽略大小写、空白和末尾的标点，
+    群里几秒内的相同问题只打一次上游
+    """
+
+    _TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.,，~～]+$")
+
+    def search(self, source: str):
+        """
+        装饰 fn(query)，同步、异步函数均可；上游收到的还是原始查询
+        """
+
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def async_wrapper(query: str):
+                    key = self.key(source, {}, self.normalize(query))
+                    return await self.aget_or_compute(key, source, lambda: fn(query))
+
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(query: str):
+                key = self.key(source, {}, self.normalize(query))
+                return self.get_or_compute(key, source, lambda: fn(query))
+
+            return wrapper
+
+        return decorator
+
+    @classmethod
+    def normalize(cls, query: str) -> str:
+        query = unicodedata.normalize("NFKC", query).lower()
+        query = re.sub(r"\s+", " ", query).strip()
+        return cls._TRAILING_PUNCTUATION.sub("", query) or query
+
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, ttl_of=_search_ttl)
+
+
+@search_cache.search("ddgs")
 @retry(
-        wait=wait_random_exponential(multiplier=3, max=60),
-        stop=stop_after_attempt(3),
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(3) | stop_at_deadline(),
     )
 def net_search(keywords: str) -> List[Dict[str, Any]]:
     return client.text(keywords, region='wt-wt', max_results=10)
 
 
+@consider_cache.cached("ddgs")
 @retry(
-        wait=wait_random_exponential(multiplier=3, max=60),
-        stop=stop_after_attempt(3),
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(3) | stop_at_deadline(),
         retry=retry_if_exception_type(HTTPError),
     )
 def ai_consider(content: str):
     return client.chat(content)
 
 
+@search_cache.search("web_search_pro")
 @retry(
-        wait=wait_random_exponential(multiplier=3, max=60),
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type(HTTPError),
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(3) | stop_at_deadline(),
+        retry=retry_if_exception_type(httpx.HTTPError),
+    )
+def web_search_pro_results(question: str) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    :return: 查询意图 & 搜索结果（title, content, link）
+    """
+    # 复用共享的 http 连接池，不再每次请求重新建立连接
+    resp = http_client.post(
+        WEB_SEARCH_PRO_URL,
+        json=_web_search_pro_request(question),
+        headers={'Authorization': ZHIPUAI_API_KEY},
+        timeout=bounded_timeout(300)
     )
+    resp.raise_for_status()
+
+    return _parse_web_search_pro(resp.json())
+
+
 def web_search_pro(question: str) -> tuple[str, list[str], list[str]]:
     """
     直接返回适用于查询意图，llm的上下文（title+content），以及对应的ref links（title+link）
     :param question:
     :return:
     """
+    intent, results = web_search_pro_results(question)
+    return (intent, *format_results(results))
+
+
+def fan_out_search(question: str) -> tuple[str, list[str], list[str]]:
+    """
+    智谱和 DDGS 并发搜索，SEARCH_FANOUT_TIMEOUT 内返回的结果按 URL 去重合并，
+    一个来源失败或超时不影响另一个；返回值与 web_search_pro 一致
+    """
+    providers = {
+        "web_search_pro": search_executor.submit(
+            contextvars.copy_context().run, web_search_pro_results, question
+        ),
+        "ddgs": search_executor.submit(
+            contextvars.copy_context().run, lambda: ("", _ddgs_results(net_search(question)))
+        ),
+    }
+    done, _ = wait(providers.values(), timeout=bounded_timeout(SEARCH_FANOUT_TIMEOUT))
+    outcomes, errors = [], []
+    for name, future in providers.items():
+        # 超时的来源不等，结果到了之后照样进缓存
+        if future not in done:
+            logger.warning(f"search provider {name} timed out")
+        elif future.exception() is not None:
+            logger.warning(f"search provider {name} failed: {future.exception()!r}")
+            errors.append(future.exception())
+        else:
+            outcomes.append(future.result())
+    return _merge_outcomes(outcomes, errors)
+
+
+async def anet_search(keywords: str) -> List[Dict[str, Any]]:
+    # DDGS 只有同步实现，放到线程里避免阻塞 event loop；net_search 已经带缓存
+    return await asyncio.to_thread(net_search, keywords)
+
+
+async def aai_consider(content: str):
+    # ai_consider 已经带缓存
+    return await asyncio.to_thread(ai_consider, content)
+
+
+@search_cache.search("web_search_pro")
+@retry(
+        wait=wait_within_deadline(wait_random_exponential(multiplier=3, max=60)),
+        stop=stop_after_attempt(3) | stop_at_deadline(),
+        retry=retry_if_exception_type(httpx.HTTPError),
+    )
+async def aweb_search_pro_results(question: str) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    web_search_pro_results 的异步版本，复用共享的 http 连接池
+    """
+    resp = await async_http_client.post(
+        WEB_SEARCH_PRO_URL,
+        json=_web_search_pro_request(question),
+        headers={'Authorization': ZHIPUAI_API_KEY},
+        timeout=bounded_timeout(300),
+    )
+    resp.raise_for_status()
+
+    return _parse_web_search_pro(resp.json())
+
+
+async def aweb_search_pro(question: str) -> tuple[str, list[str], list[str]]:
+    intent, results = await aweb_search_pro_results(question)
+    return (intent, *format_results(results))
+
+
+async def afan_out_search(question: str) -> tuple[str, list[str], list[str]]:
+    async def ddgs():
+        return "", _ddgs_results(await anet_search(question))
+
+    providers = {
+        "web_search_pro": asyncio.ensure_future(aweb_search_pro_results(question)),
+        "ddgs": asyncio.ensure_future(ddgs()),
+    }
+    done, pending = await asyncio.wait(providers.values(), timeout=bounded_timeout(SEARCH_FANOUT_TIMEOUT))
+    for task in pending:
+        task.cancel()
+    outcomes, errors = [], []
+    for name, task in providers.items():
+        if task not in done:
+            logger.warning(f"search provider {name} timed out")
+        elif task.exception() is not None:
+            logger.warning(f"search provider {name} failed: {task.exception()!r}")
+            errors.append(task.exception())
+        else:
+            outcomes.append(task.result())
+    return _merge_outcomes(outcomes, errors)
+
+
+def format_results(results: List[Dict[str, str]]) -> Tuple[List[str], List[str]]:
+    """
+    :return: llm的上下文（title+content） & 对应的ref links（title+link），两者一一对应
+    """
+    contexts = [f"title: {r.get('title', '')}\ncontent: {r.get('content', '')}" for r in results]
+    links = [f"标题: {r.get('title', '')}\n{r.get('link', '')}" for r in results]
+    return contexts, links
+
+
+def normalize_url(url: str) -> str:
+    """去重用：忽略协议、大小写的域名、www、末尾的 /、锚点和 utm_ 跟踪参数"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode(
+        sorted([(k, v) for k, v in parse_qsl(parts.query) if not k.startswith("utm_")])
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+
+def _merge_outcomes(
+    outcomes: List[Tuple[str, List[Dict[str, str]]]], errors: List[BaseException]
+) -> tuple[str, list[str], list[str]]:
+    if not outcomes:
+        if errors:
+            raise errors[0]
+        raise DeadlineExceeded("all search providers timed out")
+
+    intent, merged, seen = "", [], set()
+    for provider_intent, results in outcomes:
+        intent = intent or provider_intent
+        for r in results:
+            link = r.get("link")
+            if link:
+                key = normalize_url(link)
+                if key in seen:
+                    continue
+                seen.add(key)
+            merged.append(r)
+    return (intent, *format_results(merged))
+
+
+def _ddgs_results(raw: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    return [
+        {"title": r.get("title", ""), "content": r.get("body", ""), "link": r.get("href", "")}
+        for r in raw or []
+    ]
+
+
+def _web_search_pro_request(question: str) -> Dict[str, Any]:
     msg = [
         {
             "role": "user",
             "content": question
         }
     ]
-    tool = "web-search-pro"
-    url = "https://open.bigmodel.cn/api/paas/v4/tools"
-    request_id = str(uuid.uuid4())
-    data = {
-        "request_id": request_id,
-        "tool": tool,
+    return {
+        "request_id": str(uuid.uuid4()),
+        "tool": "web-search-pro",
         "stream": False,
         "messages": msg
     }
 
-    resp = requests.post(
-        url,
-        json=data,
-        headers={'Authorization': ZHIPUAI_API_KEY},
-        timeout=300
-    )
-    if resp.status_code != 200:
-        raise HTTPError()
 
-    tool_calls = resp.json()["choices"][0]["message"]["tool_calls"]
+def _parse_web_search_pro(body: Dict[str, Any]) -> Tuple[str, List[Dict[str, str]]]:
+    tool_calls = body["choices"][0]["message"]["tool_calls"]
 
-    contexts = []
-    links = []
     # e1是意图，e2是结果
     # {'category': '天气', 'index': 0, 'intent': 'SEARCH_TOOL', 'keywords': '最近辽宁的天气', 'query': '最近辽宁的天气'}
     intent = tool_calls[0]["search_intent"][0]["category"]
-    for t in tool_calls[-1]["search_result"]:
-        contexts.append(
-            f"title: {t.get('title', '')}\ncontent: {t.get('content', '')}"
-        )
-        links.append(
-            f"标题: {t.get('title', '')}\n{t.get('link', '')}"
-        )
-
-    return intent, contexts, links
\ No newline at end of file
+    results = [
+        {"title": t.get("title", ""), "content": t.get("content", ""), "link": t.get("link", "")}
+        for t in tool_calls[-1]["search_result"]
+    ]
+
+    return intent, results
@@ -0,0 +1,55 @@
+import math
+import re
+from collections import Counter
+from typing import List
+
+_LATIN = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    不依赖分词器：英文数字按单词，中日韩文字按相邻两字（bigram），单字的片段保留单字
+    """
+    text = (text or "").lower()
+    tokens = _LATIN.findall(text)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+            continue
+        tokens.extend([run[i : i + 2] for i in range(len(run) - 1)])
+    return tokens
+
+
+def bm25_scores(query: str, docs: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """
+    以 docs 本身为语料计算 BM25，搜索结果只有几十条，每次现算即可
+    """
+    tokenized = [tokenize(d) for d in docs]
+    if not tokenized:
+        return []
+    avg_len = sum([len(t) for t in tokenized]) / len(tokenized) or 1
+    df = Counter([term for t in tokenized for term in set(t)])
+    query_terms = set(tokenize(query))
+
+    scores = []
+    for tokens in tokenized:
+        tf = Counter(tokens)
+        norm = k1 * (1 - b + b * len(tokens) / avg_len)
+        score = 0.0
+        for term in query_terms:
+            if term not in tf:
+                continue
+            idf = math.log((len(docs) - df[term] + 0.5) / (df[term] + 0.5) + 1)
+            score += idf * tf[term] * (k1 + 1) / (tf[term] + norm)
+        scores.append(score)
+    return scores
+
+
+def rerank(query: str, docs: List[str], top_k: int) -> List[int]:
+    """
+    :return: 与 query 最相关的 top_k 个文档的下标，分数相同时保持原来的顺序
+    """
+    scores = bm25_scores(query, docs)
+    ranked = sorted(range(len(docs)), key=lambda i: -scores[i])
+    return ranked[:top_k]
@@ -0,0 +1,313 @@
+"""
+端到端压测：POST /messages 收消息 -> 合并、llm、搜索 -> 回调，全程走 HTTP，
+OpenAI、智谱搜索、微信回调、链接页面都由本地假服务（fakes.py）代替，只需要本地 postgres（DB_URL）。
+
+按泊松过程以给定速率发送文字、图片、链接混合的消息，每轮对话 1~3 条；
+统计每轮从最后一条消息被接收到第一条回复回调（first）、完整回复回调（full）的 p50/p95/p99，
+逐级加压，p95 不超过 --slo-ms 且没有拒绝、丢失的最大速率即最大可持续吞吐。
+
+# 启动假服务和被测服务，5、10、20、40 条/秒逐级加压，每级 30 秒
+python -m app_test.benchmark.bench_end_to_end --spawn --rates 5,10,20,40 --duration 30
+# 被测服务已在运行（按打印出的环境变量启动），只启动假服务
+python -m app_test.benchmark.bench_end_to_end --target http://127.0.0.1:8000 --fake-port 9100
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.utils import file_relative_path
+from app_test.benchmark import fakes
+
+_QUESTIONS = [
+    "今天北京天气怎么样",
+    "帮我想一个周末去哪玩",
+    "你好呀",
+    "最近有什么好看的电影",
+    "怎么做红烧肉",
+    "讲个笑话",
+    "python 的 asyncio 怎么用",
+]
+_LINK_REPLY_PREFIX = "挑了些链接"
+
+
+@dataclass
+class Turn:
+    session_id: str
+    sent: int = 0
+    rejected: int = 0
+    errors: int = 0
+    ingested_at: Optional[float] = None
+    first_at: Optional[float] = None
+    full_at: Optional[float] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+@dataclass
+class StepResult:
+    rate: float
+    duration: float
+    turns: List[Turn]
+
+    @property
+    def sent(self) -> int:
+        return sum([t.sent for t in self.turns])
+
+    @property
+    def rejected(self) -> int:
+        return sum([t.rejected for t in self.turns])
+
+    @property
+    def errors(self) -> int:
+        return sum([t.errors for t in self.turns])
+
+    @property
+    def lost(self) -> int:
+        """消息被接收了，但在超时前没有收到完整回复"""
+        return len([t for t in self.turns if t.ingested_at is not None and t.full_at is None])
+
+    def latencies(self, attr: str) -> List[float]:
+        return sorted(
+            [getattr(t, attr) - t.ingested_at for t in self.turns if t.ingested_at and getattr(t, attr)]
+        )
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        target: str,
+        fake_base_url: str,
+        recorder: fakes.CallbackRecorder,
+        mix: Dict[str, float],
+        turn_size: Tuple[int, int],
+        gap_ms: int,
+        turn_timeout: float,
+    ):
+        self.target = target
+        self.fake_base_url = fake_base_url
+        self.recorder = recorder
+        self.mix = mix
+        self.turn_size = turn_size
+        self.gap_ms = gap_ms
+        self.turn_timeout = turn_timeout
+        # 空闲的用户，一个用户同时只有一轮对话，下一轮会带上历史记录
+        self._idle: deque = deque()
+        with open(file_relative_path(__file__, "../resources/test_upload.webp"), "rb") as f:
+            self._pic = f.read()
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200),
+            timeout=30,
+        )
+
+    async def run_step(self, rate: float, duration: float) -> StepResult:
+        """rate 为每秒消息数，按平均每轮消息数换算成每秒对话轮数"""
+        turns_per_second = rate / (sum(self.turn_size) / 2)
+        loop = asyncio.get_running_loop()
+        turns, tasks = [], []
+        begin = time.perf_counter()
+        next_at = begin
+        while next_at < begin + duration:
+            await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            turn = Turn(self._checkout())
+            turns.append(turn)
+            tasks.append(asyncio.create_task(self._run_turn(turn, loop)))
+            next_at += random.expovariate(turns_per_second)
+        await asyncio.gather(*tasks)
+        return StepResult(rate, time.perf_counter() - begin, turns)
+
+    async def close(self):
+        await self._client.aclose()
+
+    def _checkout(self) -> str:
+        if self._idle:
+            return self._idle.popleft()
+        return f"load-{uuid.uuid4().hex[:12]}"
+
+    async def _run_turn(self, turn: Turn, loop: asyncio.AbstractEventLoop):
+        def on_callback(msg: str, at: float):
+            # 在假服务的线程里回调
+            if msg.startswith(_LINK_REPLY_PREFIX):
+                return
+            if turn.first_at is None:
+                turn.first_at = at
+            if fakes.END_MARKER in msg:
+                turn.full_at = at
+                loop.call_soon_threadsafe(turn.done.set)
+
+        self.recorder.watch(turn.session_id, on_callback)
+        try:
+            for i in range(random.randint(*self.turn_size)):
+                if i > 0:
+                    await asyncio.sleep(self.gap_ms / 1000)
+                await self._send(turn)
+            if turn.ingested_at is not None:
+                try:
+                    await asyncio.wait_for(turn.done.wait(), self.turn_timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.recorder.unwatch(turn.session_id)
+            self._idle.append(turn.session_id)
+
+    async def _send(self, turn: Turn):
+        type_ = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        data = {
+            "from_username": turn.session_id,
+            "to_username": "bot",
+            "session_id": turn.session_id,
+            "is_group": "false",
+            "type": type_,
+        }
+        files = None
+        if type_ == "text":
+            data["content"] = random.choice(_QUESTIONS)
+        elif type_ == "link":
+            data["content"] = fakes.page_url(self.fake_base_url)
+        elif type_ == "pic":
+            files = {"uploaded_file": ("pic.webp", self._pic, "image/webp")}
+
+        turn.sent += 1
+        try:
+            resp = await self._client.post(f"{self.target}/messages", data=data, files=files)
+        except httpx.HTTPError:
+            turn.errors += 1
+            return
+        if resp.status_code == 429:
+            turn.rejected += 1
+        elif resp.status_code >= 400:
+            turn.errors += 1
+        else:
+            turn.ingested_at = time.perf_counter()
+
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    return {k: float(v) for k, v in [part.split("=") for part in spec.split(",")]}
+
+
+def _spawn_app(port: int, fake_base_url: str) -> subprocess.Popen:
+    env = {**os.environ, **fakes.app_env(fake_base_url)}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def _wait_ready(target: str, timeout: float = 60):
+    async with httpx.AsyncClient() as client:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            try:
+                if (await client.get(f"{target}/messages/stats")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"{target} not ready after {timeout}s")
+
+
+def _report(step: StepResult, slo_ms: float) -> bool:
+    first, full = step.latencies("first_at"), step.latencies("full_at")
+    p95 = percentile(full, 0.95) * 1000
+    sustained = step.rejected == 0 and step.lost == 0 and step.errors == 0 and p95 <= slo_ms
+    print(
+        f"rate {step.rate:g}/s: sent {step.sent} ({step.sent / step.duration:.1f}/s), "
+        f"rejected {step.rejected}, errors {step.errors}, lost {step.lost} | "
+        f"first p50/p95/p99 {percentile(first, 0.5) * 1000:.0f}/{percentile(first, 0.95) * 1000:.0f}/"
+        f"{percentile(first, 0.99) * 1000:.0f}ms | "
+        f"full p50/p95/p99 {percentile(full, 0.5) * 1000:.0f}/{p95:.0f}/{percentile(full, 0.99) * 1000:.0f}ms"
+        f"{'' if sustained else '  (not sustained)'}"
+    )
+    return sustained
+
+
+async def run(args):
+    recorder = fakes.CallbackRecorder()
+    fake_app = fakes.create_app(
+        fakes.Latency(args.openai_latency),
+        fakes.Latency(args.search_latency),
+        fakes.Latency(args.callback_latency),
+        fakes.Latency(args.page_latency),
+        recorder,
+        search_ratio=args.search_ratio,
+    )
+    _, fake_port = fakes.serve(fake_app, port=args.fake_port)
+    fake_base_url = f"http://127.0.0.1:{fake_port}"
+
+    app_process = None
+    if args.spawn:
+        app_process = _spawn_app(args.app_port, fake_base_url)
+        target = f"http://127.0.0.1:{args.app_port}"
+    else:
+        target = args.target
+        print("start the app with:")
+        for k, v in fakes.app_env(fake_base_url).items():
+            print(f"  {k}={v}")
+
+    generator = LoadGenerator(
+        target,
+        fake_base_url,
+        recorder,
+        _parse_mix(args.mix),
+        tuple([int(n) for n in args.turn_size.split("-")]),
+        args.gap_ms,
+        args.turn_timeout,
+    )
+    try:
+        await _wait_ready(target)
+        max_sustained = None
+        for rate in [float(r) for r in args.rates.split(",")]:
+            step = await generator.run_step(rate, args.duration)
+            if _report(step, args.slo_ms):
+                max_sustained = rate
+            elif args.stop_on_failure:
+                break
+        print(
+            f"max sustained: {max_sustained:g} msgs/s (full reply p95 <= {args.slo_ms:g}ms)"
+            if max_sustained
+            else f"no rate sustained within full reply p95 <= {args.slo_ms:g}ms"
+        )
+        async with httpx.AsyncClient() as client:
+            print(f"app stats: {(await client.get(f'{target}/messages/stats')).json()}")
+        print(f"unexpected callbacks: {recorder.unexpected}")
+    finally:
+        await generator.close()
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--spawn", action="store_true", help="启动被测服务，需要 DB_URL")
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--fake-port", type=int, default=0)
+    parser.add_argument("--rates", default="5,10,20,40", help="逐级加压的每秒消息数")
+    parser.add_argument("--duration", type=float, default=30, help="每级持续秒数")
+    parser.add_argument("--mix", default="text=0.8,pic=0.1,link=0.1")
+    parser.add_argument("--turn-size", default="1-3", help="每轮对话的消息数范围")
+    parser.add_argument("--gap-ms", type=int, default=300, help="同一轮内消息的间隔")
+    parser.add_argument("--turn-timeout", type=float, default=120)
+    parser.add_argument("--slo-ms", type=float, default=15000)
+    parser.add_argument("--stop-on-failure", action="store_true")
+    parser.add_argument("--search-ratio", type=float, default=0.3, help="需要搜索的问题比例")
+    parser.add_argument("--openai-latency", default="lognormal:1200,0.4")
+    parser.add_argument("--search-latency", default="lognormal:2000,0.5")
+    parser.add_argument("--callback-latency", default="uniform:20-80")
+    parser.add_argument("--page-latency", default="uniform:100-400")
+    asyncio.run(run(parser.parse_args()))
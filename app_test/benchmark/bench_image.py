@@ -0,0 +1,132 @@
+"""
+图片缩放：原来的整图解码 + convert + LANCZOS resize，对比 draft 解码 + thumbnail，
+以及放到进程池里并发处理的吞吐。默认生成手机照片尺寸（4032*3024）的 JPEG，
+其中一部分带 EXIF 旋转，另有带透明通道的 PNG 和动图 GIF；也可以用 --corpus 指定真实照片所在的目录
+
+python -m app_test.benchmark.bench_image --images 40 --workers 4
+python -m app_test.benchmark.bench_image --corpus ~/Pictures --format WEBP --quality 80
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List
+
+from PIL import Image
+
+from app.service.image import process_image
+
+_SUFFIXES = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+
+def _photo(width: int, height: int, orientation: int = 1) -> bytes:
+    # 噪点让 JPEG 的体积和解码耗时接近真实照片
+    noise = Image.effect_noise((width, height), 64)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge("RGB", (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    bio = io.BytesIO()
+    img.save(bio, format="JPEG", quality=90, exif=exif.tobytes())
+    return bio.getvalue()
+
+
+def _transparent_png(width: int, height: int) -> bytes:
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    img.paste((255, 0, 0, 255), (width // 4, height // 4, width * 3 // 4, height * 3 // 4))
+    bio = io.BytesIO()
+    img.save(bio, format="PNG")
+    return bio.getvalue()
+
+
+def _animated_gif(width: int, height: int, frames: int) -> bytes:
+    images = []
+    for i in range(frames):
+        frame = Image.new("RGB", (width, height), (255, 255, 255))
+        frame.paste((0, 0, 255), (i * 10, i * 10, i * 10 + 60, i * 10 + 60))
+        images.append(frame.convert("P"))
+    bio = io.BytesIO()
+    images[0].save(bio, format="GIF", save_all=True, append_images=images[1:], duration=80, loop=0)
+    return bio.getvalue()
+
+
+def generate(count: int) -> List[bytes]:
+    corpus = []
+    for i in range(count):
+        if i % 10 == 8:
+            corpus.append(_transparent_png(1080, 1920))
+        elif i % 10 == 9:
+            corpus.append(_animated_gif(480, 480, 24))
+        else:
+            # 竖着拍的照片像素是横的，靠 EXIF 方向 6 摆正
+            corpus.append(_photo(4032, 3024, orientation=6 if i % 2 else 1))
+    return corpus
+
+
+def load(directory: str, count: int) -> List[bytes]:
+    names = sorted([n for n in os.listdir(directory) if n.lower().endswith(_SUFFIXES)])[:count]
+    corpus = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def legacy_resize(raw: bytes, max_side: int, format_: str, quality: int):
+    """改动之前 receive_msg 里的实现"""
+    img = Image.open(io.BytesIO(raw)).convert("RGB")
+    scaling_factor = min(max_side / img.width, max_side / img.height)
+    size = (int(img.width * scaling_factor), int(img.height * scaling_factor))
+    bio = io.BytesIO()
+    img.resize(size, Image.LANCZOS).save(bio, format=format_, quality=quality)
+    return bio.getvalue()
+
+
+def measure(name: str, corpus: List[bytes], fn: Callable[[bytes], object]):
+    latencies = []
+    begin = time.perf_counter()
+    for raw in corpus:
+        start = time.perf_counter()
+        fn(raw)
+        latencies.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - begin
+    latencies.sort()
+    print(
+        f"{name:<10}: {len(corpus) / elapsed:7.1f} images/s, "
+        f"p50 {statistics.median(latencies):7.1f}ms, p95 {latencies[int(len(latencies) * 0.95) - 1]:7.1f}ms"
+    )
+
+
+def run(corpus: List[bytes], workers: int, max_side: int, format_: str, quality: int):
+    megabytes = sum([len(r) for r in corpus]) / 1024 / 1024
+    print(f"{len(corpus)} images, {megabytes:.1f}MB, target {max_side}px {format_} q{quality}")
+    measure("legacy", corpus, lambda raw: legacy_resize(raw, max_side, format_, quality))
+    measure("draft", corpus, lambda raw: process_image(raw, max_side, format_, quality))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # 预热，不把子进程启动的时间算进去
+        list(pool.map(process_image, corpus[:workers], [max_side] * workers, [format_] * workers, [quality] * workers))
+        begin = time.perf_counter()
+        results = list(
+            pool.map(process_image, corpus, [max_side] * len(corpus), [format_] * len(corpus), [quality] * len(corpus))
+        )
+        elapsed = time.perf_counter() - begin
+    print(f"{'pool x' + str(workers):<10}: {len(corpus) / elapsed:7.1f} images/s")
+    out = sum([len(r.data) for r in results]) / 1024
+    print(f"output {out:.0f}KB, sizes: {sorted({(r.width, r.height) for r in results})}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--corpus", default=None, help="真实照片所在的目录，不指定时生成")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 4))
+    parser.add_argument("--max-side", type=int, default=512)
+    parser.add_argument("--format", default="JPEG")
+    parser.add_argument("--quality", type=int, default=75)
+    args = parser.parse_args()
+    images = load(args.corpus, args.images) if args.corpus else generate(args.images)
+    run(images, args.workers, args.max_side, args.format.upper(), args.quality)
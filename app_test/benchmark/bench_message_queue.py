@@ -0,0 +1,65 @@
+"""
+MessageReceiveQueue 调度吞吐压测
+
+python -m app_test.benchmark.bench_message_queue --sessions 1000 --messages 5 --work-ms 20
+"""
+import argparse
+import statistics
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+from app.core import MessageReceiveQueue
+from app.utils import current_timestamp
+
+
+def run(sessions: int, messages: int, work_ms: int, workers: int):
+    lock = Lock()
+    done = Event()
+    received = defaultdict(list)
+    lags = []
+    total = sessions * messages
+
+    def handler(msgs):
+        # msg 为 (session_id, seq, 入队时的 flush 截止时间)
+        lag = current_timestamp() - max(m[2] for m in msgs)
+        time.sleep(work_ms / 1000)
+        with lock:
+            lags.append(lag)
+            received[msgs[0][0]].extend(m[1] for m in msgs)
+            if sum(len(v) for v in received.values()) >= total:
+                done.set()
+
+    queue = MessageReceiveQueue(
+        handler=handler, pool=ThreadPoolExecutor(max_workers=workers)
+    )
+    Thread(target=queue._proceed, daemon=True).start()
+
+    begin = time.perf_counter()
+    for seq in range(messages):
+        for s in range(sessions):
+            session_id = f"session-{s}"
+            queue.send(session_id, (session_id, seq, current_timestamp()), delay=0)
+    done.wait()
+    elapsed = time.perf_counter() - begin
+
+    ordered = all(v == sorted(v) for v in received.values())
+    lags.sort()
+    print(f"sessions: {sessions}, messages/session: {messages}, workers: {workers}")
+    print(f"chat calls: {len(lags)}, elapsed: {elapsed:.3f}s, msgs/s: {total / elapsed:.1f}")
+    print(
+        f"dispatch lag ms p50: {statistics.median(lags):.1f}, "
+        f"p99: {lags[int(len(lags) * 0.99) - 1]:.1f}, max: {lags[-1]:.1f}"
+    )
+    print(f"in-session order kept: {ordered}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--work-ms", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=50)
+    args = parser.parse_args()
+    run(args.sessions, args.messages, args.work_ms, args.workers)
@@ -0,0 +1,57 @@
+"""
+是否搜索判断的跨 session 攒批：并发调用方各自发请求 vs 攒批后一次请求，
+用 sleep 模拟一次 http 往返，信号量模拟连接池，对比吞吐和请求次数
+
+python -m app_test.benchmark.bench_micro_batch --callers 200 --requests 2000 --rtt-ms 400 --connections 20
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Semaphore
+
+from app.core.batch import MicroBatcher
+
+
+def run(callers: int, requests: int, rtt_ms: int, per_item_ms: float, connections: int, window_ms: int, max_size: int):
+    pool_slots = Semaphore(connections)
+    lock = Lock()
+    calls = [0]
+
+    def round_trip(items):
+        # 一次往返，批量时输出变长，按条目数加一点生成耗时
+        with pool_slots:
+            with lock:
+                calls[0] += 1
+            time.sleep((rtt_ms + per_item_ms * len(items)) / 1000)
+        return ["否" for _ in items]
+
+    def drive(call) -> float:
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=callers) as callers_pool:
+            list(callers_pool.map(call, [f"问题 {i}" for i in range(requests)]))
+        return time.perf_counter() - begin
+
+    calls[0] = 0
+    elapsed = drive(lambda q: round_trip([q])[0])
+    print(f"single : {requests / elapsed:7.1f} req/s, {calls[0]} calls, {requests / elapsed / connections:.1f} req/s per connection")
+
+    calls[0] = 0
+    batcher = MicroBatcher(round_trip, window_ms, max_size, ThreadPoolExecutor(max_workers=connections))
+    elapsed = drive(batcher.run)
+    print(
+        f"batched: {requests / elapsed:7.1f} req/s, {calls[0]} calls, {requests / elapsed / connections:.1f} req/s per connection, "
+        f"{batcher.stats()}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callers", type=int, default=200, help="并发的调用方（session）数")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rtt-ms", type=int, default=400)
+    parser.add_argument("--per-item-ms", type=float, default=15, help="批量时每多一条增加的生成耗时")
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--window-ms", type=int, default=10)
+    parser.add_argument("--max-size", type=int, default=16)
+    args = parser.parse_args()
+    run(args.callers, args.requests, args.rtt_ms, args.per_item_ms, args.connections, args.window_ms, args.max_size)
@@ -0,0 +1,53 @@
+"""
+大量不同 session id 下 MessageReceiveQueue 的常驻内存
+
+python -m app_test.benchmark.bench_session_memory --sessions 2000000 --report-every 200000 --max-resident 10000
+"""
+import argparse
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from app.core import MessageReceiveQueue
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1024 / 1024
+
+
+def run(sessions: int, report_every: int, workers: int, max_resident: int):
+    queue = MessageReceiveQueue(
+        handler=lambda msgs: None, pool=ThreadPoolExecutor(max_workers=workers)
+    )
+    Thread(target=queue._proceed, daemon=True).start()
+
+    begin = time.perf_counter()
+    for i in range(sessions):
+        # 发送速度远超处理速度时 rss 反映的是积压而不是泄漏，限制一下在途的 session
+        while i % 1000 == 0 and queue.stats()["resident_sessions"] > max_resident:
+            time.sleep(0.01)
+        # 模拟 wechat 每次重启都换一个 session id
+        queue.send(f"@{i:032x}", i, delay=0)
+        if (i + 1) % report_every == 0:
+            stats = queue.stats()
+            print(
+                f"sent: {i + 1}, resident sessions: {stats['resident_sessions']}, "
+                f"rss: {_rss_mb():.1f}MB, elapsed: {time.perf_counter() - begin:.1f}s"
+            )
+
+    while queue.stats()["resident_sessions"] > 0:
+        time.sleep(0.1)
+    print(f"drained, resident sessions: 0, rss: {_rss_mb():.1f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2_000_000)
+    parser.add_argument("--report-every", type=int, default=200_000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-resident", type=int, default=10_000)
+    args = parser.parse_args()
+    run(args.sessions, args.report_every, args.workers, args.max_resident)
@@ -0,0 +1,74 @@
+"""
+chat 在最终 completion 之前各阶段的关键路径耗时，用 sleep 模拟各阶段的网络延迟，
+对比串行执行与按阶段图并发执行
+
+python -m app_test.benchmark.bench_stage_graph --consider-ms 800 --search-ms 2500
+"""
+import argparse
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from app.service import chatflow
+
+
+def _fake_messages(n: int, content: str):
+    return [
+        SimpleNamespace(
+            type_="text", content=content, from_="user", created_at=datetime.now()
+        )
+        for _ in range(n)
+    ]
+
+
+def run(consider_ms: int, search_ms: int, need_search: bool, rounds: int):
+    def consider(prompt: str):
+        time.sleep(consider_ms / 1000)
+        if "只需回答“是”或者“否”" in prompt:
+            return "是" if need_search else "否"
+        return "ok"
+
+    def search(question: str):
+        time.sleep(search_ms / 1000)
+        return "天气", ["title: t\ncontent: c"], ["标题: t\nhttp://example.com"]
+
+    messages = _fake_messages(1, "今天北京天气怎么样")
+    # 超过 300 字，触发历史压缩
+    previous = _fake_messages(20, "聊点别的" * 5)
+
+    serial = (3 * consider_ms + (search_ms if need_search else 0)) / 1000
+    pool = ThreadPoolExecutor(max_workers=8)
+    for speculative in (False, True):
+        for fast in (False, True):
+            chatflow.CHAT_SPECULATIVE_SEARCH = speculative
+            chatflow.CHAT_FAST_SEARCH_DECISION = fast
+            elapsed = []
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                graph = chatflow._pre_completion_graph(
+                    messages, previous, None, True, consider, search,
+                    speculate=functools.partial(chatflow._speculate, search),
+                )
+                futures = graph.run(pool)
+                futures["histories"].result()
+                futures["rewrite"].result()
+                if futures["decide"].result() == "是":
+                    futures["search"].result()
+                elapsed.append(time.perf_counter() - begin)
+            print(
+                f"speculative search: {speculative!s:5}, fast decision: {fast!s:5} -> "
+                f"critical path {sum(elapsed) / rounds:.2f}s (serial {serial:.2f}s)"
+            )
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consider-ms", type=int, default=800)
+    parser.add_argument("--search-ms", type=int, default=2500)
+    parser.add_argument("--no-search", action="store_true")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    run(args.consider_ms, args.search_ms, not args.no_search, args.rounds)
@@ -0,0 +1,225 @@
+"""
+压测用的本地假服务：OpenAI chat completions、智谱 web-search-pro、微信回调、链接页面，
+都挂在同一个 FastAPI 应用上，各自的延迟分布可配置，压测时不会调用任何付费服务。
+
+被测服务需要指向这里：
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+ZHIPUAI_BASE_URL=http://127.0.0.1:<port>/api/paas/v4
+CHAT_CALLBACK_URL=http://127.0.0.1:<port>/callback
+CHAT_CONSIDER_BACKEND=openai
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+
+# 最终回复以此结尾，压测端据此判断一轮对话的回复已经全部送达（流式回复会分多次回调）
+END_MARKER = "（完）"
+
+_REPLY = (
+    "这是压测用的假回复。今天天气不错，适合出去走走。"
+    "如果你还有其他问题，可以继续问我。我们下次再聊。"
+)
+
+
+class Latency:
+    """
+    延迟分布，毫秒：
+    fixed:800 | uniform:200-1500 | lognormal:800,0.5（中位数, sigma）
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        if kind == "fixed":
+            ms = float(args)
+            self._sample: Callable[[], float] = lambda: ms
+        elif kind == "uniform":
+            low, high = [float(a) for a in args.split("-")]
+            self._sample = lambda: random.uniform(low, high)
+        elif kind == "lognormal":
+            median, sigma = [float(a) for a in args.split(",")]
+            self._sample = lambda: median * random.lognormvariate(0, sigma)
+        else:
+            raise ValueError(f"unknown latency spec: {spec}")
+
+    def seconds(self) -> float:
+        return max(self._sample(), 0) / 1000
+
+
+class CallbackRecorder:
+    """记录回调到达的时间，压测端按 session 等待回复"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._waiters: Dict[str, Callable[[str, float], None]] = {}
+        self.unexpected = 0
+
+    def watch(self, session_id: str, on_callback: Callable[[str, float], None]):
+        with self._lock:
+            self._waiters[session_id] = on_callback
+
+    def unwatch(self, session_id: str):
+        with self._lock:
+            self._waiters.pop(session_id, None)
+
+    def record(self, session_id: str, msg: str):
+        now = time.perf_counter()
+        with self._lock:
+            on_callback = self._waiters.get(session_id)
+            if on_callback is None:
+                self.unexpected += 1
+                return
+        on_callback(msg, now)
+
+
+def create_app(
+    openai_latency: Latency,
+    search_latency: Latency,
+    callback_latency: Latency,
+    page_latency: Latency,
+    recorder: CallbackRecorder,
+    search_ratio: float = 0.3,
+) -> FastAPI:
+    app = FastAPI()
+    counters = {"completions": 0, "searches": 0, "callbacks": 0, "pages": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        counters["completions"] += 1
+        await asyncio.sleep(openai_latency.seconds())
+        content = _fake_completion(body["messages"], search_ratio)
+        if body.get("stream"):
+            return StreamingResponse(
+                _stream_chunks(body["model"], content), media_type="text/event-stream"
+            )
+        return _completion_body(body["model"], content)
+
+    @app.post("/api/paas/v4/tools")
+    async def web_search_pro():
+        counters["searches"] += 1
+        await asyncio.sleep(search_latency.seconds())
+        return _web_search_body()
+
+    @app.post("/callback")
+    async def callback(session_id: str, msg: str):
+        counters["callbacks"] += 1
+        await asyncio.sleep(callback_latency.seconds())
+        recorder.record(session_id, msg)
+        return {"ok": True}
+
+    @app.get("/pages/{page_id}", response_class=HTMLResponse)
+    async def page(page_id: str):
+        counters["pages"] += 1
+        await asyncio.sleep(page_latency.seconds())
+        paragraphs = "".join([f"<p>第 {i} 段，{_REPLY}</p>" for i in range(20)])
+        return f"<html><head><title>page {page_id}</title></head><body>{paragraphs}</body></html>"
+
+    @app.get("/stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+def _fake_completion(messages: List[Dict], search_ratio: float) -> str:
+    text = json.dumps(messages, ensure_ascii=False)
+    batch = re.search(r"判断以下 (\d+) 个相互独立的问题", text)
+    if batch:
+        answers = ["是" if random.random() < search_ratio else "否" for _ in range(int(batch.group(1)))]
+        return json.dumps(answers, ensure_ascii=False)
+    if "只需回答“是”或者“否”" in text:
+        return "是" if random.random() < search_ratio else "否"
+    # 只有最终回复带 system prompt，历史压缩、问题重写等只有一条 user 消息
+    if any([m.get("role") == "system" for m in messages]):
+        return f"{_REPLY}{END_MARKER}"
+    return "压测用的假结果"
+
+
+def _completion_body(model: str, content: str) -> Dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+        "usage": {"prompt_tokens": 100, "completion_tokens": len(content), "total_tokens": 100 + len(content)},
+    }
+
+
+async def _stream_chunks(model: str, content: str):
+    id_ = f"chatcmpl-{uuid.uuid4().hex}"
+    base = {"id": id_, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+    for i in range(0, len(content), 8):
+        chunk = {**base, "choices": [{"index": 0, "delta": {"content": content[i : i + 8]}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        await asyncio.sleep(0.01)
+    yield f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+    usage = {"prompt_tokens": 100, "completion_tokens": len(content), "total_tokens": 100 + len(content)}
+    yield f"data: {json.dumps({**base, 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def _web_search_body() -> Dict:
+    results = [
+        {"title": f"结果 {i}", "content": _REPLY, "link": f"https://example.com/{i}"}
+        for i in range(5)
+    ]
+    return {
+        "choices": [
+            {
+                "message": {
+                    "tool_calls": [
+                        {"search_intent": [{"category": "天气", "intent": "SEARCH_TOOL"}]},
+                        {"search_result": results},
+                    ]
+                }
+            }
+        ]
+    }
+
+
+def serve(app: FastAPI, host: str = "127.0.0.1", port: int = 0) -> Tuple[uvicorn.Server, int]:
+    """
+    在后台线程启动，port 为 0 时随机选择端口
+    :return: server & 实际端口
+    """
+    server = uvicorn.Server(
+        uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False)
+    )
+    Thread(target=server.run, name="fake_services", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, port
+
+
+def app_env(base_url: str) -> Dict[str, str]:
+    """被测服务指向假服务需要的环境变量"""
+    return {
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENAI_API_KEY": "fake",
+        "ZHIPUAI_BASE_URL": f"{base_url}/api/paas/v4",
+        "ZHIPUAI_API_KEY": "fake",
+        "CHAT_CALLBACK_URL": f"{base_url}/callback",
+        "CHAT_CONSIDER_BACKEND": "openai",
+    }
+
+
+def page_url(base_url: str, page_id: Optional[str] = None) -> str:
+    return f"{base_url}/pages/{page_id or uuid.uuid4().hex}"
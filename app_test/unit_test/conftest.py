@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def database():
+    """需要一个可以写的 postgres（DB_URL），连不上时跳过"""
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    from app.database import Base, engine
+
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("select 1"))
+    except OperationalError:
+        pytest.skip("database is not available")
+    Base.metadata.create_all(bind=engine)
+    return engine
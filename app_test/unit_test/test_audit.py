@@ -0,0 +1,116 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from app.service import audit as audit_service
+from app.service import blob as blob_service
+
+_IMAGE = b"\xff\xd8fake jpeg"
+_DATA_URL = "data:image/jpeg;base64," + base64.b64encode(_IMAGE).decode("ascii")
+
+
+@pytest.fixture
+def template(monkeypatch):
+    template = audit_service._templates[0]
+    monkeypatch.setattr(template, "id", None)
+    monkeypatch.setattr(audit_service.template_storage, "get_or_create", lambda name, version, content: 7)
+    monkeypatch.setattr(audit_service.template_storage, "get_content", lambda id_: template.content)
+    return template
+
+
+def _messages(template):
+    return [
+        {"role": "system", "content": template.content.format(histories="#10:00 #alice #你好\n#10:01 #bob #{在吗}")},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "这是什么"},
+                {"type": "image_url", "image_url": {"url": _DATA_URL}},
+                {"type": "image_url", "image_url": {"url": "https://example.com/a.jpg"}},
+            ],
+        },
+    ]
+
+
+def test_system_prompt_is_stored_as_template_reference(template):
+    compact = audit_service.compact_request(_messages(template))
+
+    assert compact[0] == {
+        "role": "system",
+        "template_id": 7,
+        "template": template.name,
+        "version": template.version,
+        "variables": {"histories": "#10:00 #alice #你好\n#10:01 #bob #{在吗}"},
+    }
+    assert audit_service.expand_request(compact)[0] == _messages(template)[0]
+
+
+def test_inline_images_are_replaced_by_digest(template):
+    compact = audit_service.compact_request(_messages(template))
+    parts = compact[1]["content"]
+
+    assert parts[0] == {"type": "text", "text": "这是什么"}
+    assert parts[1] == {
+        "type": "image_url",
+        "image_url": {"digest": blob_service.digest_of(_IMAGE), "content_type": "image/jpeg", "size": len(_IMAGE)},
+    }
+    # 按链接引用的图片原样保留
+    assert parts[2] == _messages(template)[1]["content"][2]
+
+
+def test_store_media_saves_images_before_referencing(template, monkeypatch):
+    saved = []
+    monkeypatch.setattr(blob_service, "put", lambda data, content_type: saved.append(data) or "digest")
+
+    compact = audit_service.compact_request(_messages(template), store_media=True)
+
+    assert saved == [_IMAGE]
+    assert compact[1]["content"][1]["image_url"]["digest"] == "digest"
+
+
+def test_other_messages_are_kept_as_is(template):
+    messages = [{"role": "system", "content": "不是模板"}, {"role": "assistant", "content": "好的"}]
+    assert audit_service.compact_request(messages) == messages
+    assert audit_service.expand_request(messages) == messages
+
+
+def test_large_records_round_trip_through_zstd(monkeypatch):
+    pytest.importorskip("zstandard")
+    from app.model import completion
+
+    monkeypatch.setattr(completion, "AUDIT_ZSTD_MIN_BYTES", 64)
+    small = {"content": "短"}
+    large = {"content": "很长的回复" * 100}
+
+    assert completion._pack(small) == (small, None)
+    value, compressed = completion._pack(large)
+    assert value is None and len(compressed) < len("很长的回复".encode("UTF-8") * 100)
+    assert completion._unpack(value, compressed) == large
+
+
+def test_known_digests_skip_decoding(template, monkeypatch):
+    def digest_of(data):
+        raise AssertionError("已知 digest 的图片不用再计算")
+
+    monkeypatch.setattr(blob_service, "digest_of", digest_of)
+    compact = audit_service.compact_request(_messages(template), digests={_DATA_URL: "known"})
+
+    assert compact[1]["content"][1]["image_url"] == {"digest": "known", "content_type": "image/jpeg", "size": len(_IMAGE)}
+
+
+def test_chatflow_passes_digests_of_pictures_in_order():
+    from app.service import chatflow
+    from app.service.llm import LlmMessage
+
+    def pic(digest):
+        return SimpleNamespace(type_="pic", message_extra=SimpleNamespace(blob_digest=digest))
+
+    messages = [SimpleNamespace(type_="text", message_extra=None), pic("d1"), pic(None), pic("d3")]
+    content = [{"type": "text", "text": "这是什么"}] + [
+        {"type": "image_url", "image_url": {"url": url}} for url in ("data:1", "data:2", "data:3")
+    ]
+    llm_messages = [LlmMessage(role="system", content="s"), LlmMessage(role="user", content=content)]
+
+    assert chatflow._image_digests(llm_messages, messages) == {"data:1": "d1", "data:3": "d3"}
+    assert chatflow._image_digests([LlmMessage(role="user", content="纯文字")], messages) == {}
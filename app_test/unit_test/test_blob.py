@@ -0,0 +1,173 @@
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from app.model.blob import Blob, STORAGE_DB, STORAGE_DISK, STORAGE_S3
+from app.model.message import MessageExtra
+from app.service import blob as blob_service
+
+_IMAGE = b"\xff\xd8fake jpeg"
+_DIGEST = blob_service.digest_of(_IMAGE)
+
+
+class FakeRemote:
+    """file_service 里和 s3 打交道的部分"""
+
+    def __init__(self):
+        self.objects, self.uploads, self.signed = set(), [], []
+
+    def exists_remote(self, path):
+        return path in self.objects
+
+    def upload(self, data, path):
+        self.uploads.append(path)
+        self.objects.add(path)
+
+    def presigned_url(self, path, expires):
+        self.signed.append(path)
+        return f"https://s3/{path}?sig={len(self.signed)}"
+
+    def public_url(self, path):
+        return f"https://cdn/{path}"
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    fake = FakeRemote()
+    for name in ("exists_remote", "upload", "presigned_url", "public_url"):
+        monkeypatch.setattr(blob_service.file_service, name, getattr(fake, name))
+    monkeypatch.setattr(blob_service, "_remote_urls", {})
+    monkeypatch.setattr(blob_service, "data_url_cache", blob_service.BlobCache(1024))
+    monkeypatch.setattr(blob_service, "blob_cache", blob_service.BlobCache(1024))
+    blob = Blob(digest=_DIGEST, size=len(_IMAGE), content_type="image/jpeg", storage=STORAGE_DB, data=_IMAGE)
+    monkeypatch.setattr(blob_service.blob_storage, "get_blob", lambda digest: blob if digest == _DIGEST else None)
+    fake.blob = blob
+    return fake
+
+
+def test_data_mode_inlines_the_image_once(remote, monkeypatch):
+    monkeypatch.setattr(blob_service, "IMAGE_URL_MODE", "data")
+
+    url = blob_service.image_url(_DIGEST, "image/jpeg")
+
+    assert url == "data:image/jpeg;base64," + base64.b64encode(_IMAGE).decode("ascii")
+    assert blob_service.image_url(_DIGEST, "image/jpeg") is url
+    assert blob_service.data_url_cache.stats()["hits"] == 1
+    assert remote.uploads == []
+
+
+def test_presigned_mode_uploads_once_and_resigns_after_half_the_expiry(remote, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(blob_service, "IMAGE_URL_MODE", "presigned")
+    monkeypatch.setattr(blob_service, "IMAGE_URL_EXPIRES", 600)
+    monkeypatch.setattr(blob_service, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    path = f"blobs/{_DIGEST[:2]}/{_DIGEST}"
+
+    first = blob_service.image_url(_DIGEST, "image/jpeg")
+    assert first == f"https://s3/{path}?sig=1"
+    now[0] += 299
+    assert blob_service.image_url(_DIGEST, "image/jpeg") == first
+
+    now[0] += 2
+    assert blob_service.image_url(_DIGEST, "image/jpeg") == f"https://s3/{path}?sig=2"
+    assert remote.uploads == [path]
+
+
+def test_public_mode_reuses_blobs_already_on_s3(remote, monkeypatch):
+    monkeypatch.setattr(blob_service, "IMAGE_URL_MODE", "public")
+    remote.blob.storage = STORAGE_S3
+
+    url = blob_service.image_url(_DIGEST, "image/jpeg")
+
+    assert url == f"https://cdn/blobs/{_DIGEST[:2]}/{_DIGEST}"
+    assert remote.uploads == []
+
+
+def test_falls_back_to_data_url_when_upload_fails(remote, monkeypatch):
+    def upload(data, path):
+        raise ConnectionError("s3 down")
+
+    monkeypatch.setattr(blob_service, "IMAGE_URL_MODE", "presigned")
+    monkeypatch.setattr(blob_service.file_service, "upload", upload)
+
+    assert blob_service.image_url(_DIGEST, "image/jpeg").startswith("data:image/jpeg;base64,")
+    assert blob_service._remote_urls == {}
+
+
+class FakeBlobStorage:
+    """blob 表"""
+
+    def __init__(self):
+        self.blobs = {}
+
+    def exists(self, digest):
+        return digest in self.blobs
+
+    def get_blob(self, digest):
+        return self.blobs.get(digest)
+
+    def save_blob(self, blob):
+        self.blobs[blob.digest] = blob
+
+
+@pytest.fixture
+def disk(monkeypatch, tmp_path):
+    storage = FakeBlobStorage()
+    monkeypatch.setattr(blob_service, "blob_storage", storage)
+    monkeypatch.setattr(blob_service.file_service, "LOCAL_TEMP_FILE_PATH_BASE", str(tmp_path))
+    monkeypatch.setattr(blob_service, "blob_cache", blob_service.BlobCache(1024))
+    return storage
+
+
+def test_disk_blobs_are_content_addressed(disk, tmp_path):
+    first = blob_service.put(_IMAGE, "image/jpeg", storage=STORAGE_DISK)
+    second = blob_service.put(_IMAGE, "image/jpeg", storage=STORAGE_DISK)
+
+    assert first == second == _DIGEST
+    assert list(disk.blobs) == [_DIGEST]
+    blob = disk.blobs[_DIGEST]
+    assert (blob.storage, blob.size, blob.data) == (STORAGE_DISK, len(_IMAGE), None)
+    assert [p.name for p in tmp_path.rglob("*") if p.is_file()] == [_DIGEST]
+
+
+def test_disk_blobs_round_trip_through_get_and_read(disk, monkeypatch):
+    digest = blob_service.put(_IMAGE, "image/jpeg", storage=STORAGE_DISK)
+    # 换一个进程内缓存，从磁盘读
+    monkeypatch.setattr(blob_service, "blob_cache", blob_service.BlobCache(1024))
+
+    assert blob_service.get(digest) == _IMAGE
+    assert blob_service.blob_cache.stats()["misses"] == 1
+    assert blob_service.read(MessageExtra(blob_digest=digest)) == _IMAGE
+    assert blob_service.blob_cache.stats()["hits"] == 1
+    # 旧数据直接存在 content_bytes
+    assert blob_service.read(MessageExtra(content_bytes=b"legacy")) == b"legacy"
+
+
+def test_missing_blobs_raise(disk, tmp_path, monkeypatch):
+    digest = blob_service.put(_IMAGE, "image/jpeg", storage=STORAGE_DISK)
+    monkeypatch.setattr(blob_service, "blob_cache", blob_service.BlobCache(1024))
+    for path in tmp_path.rglob(digest):
+        path.unlink()
+
+    with pytest.raises(FileNotFoundError):
+        blob_service.get(digest)
+    with pytest.raises(FileNotFoundError):
+        blob_service.get("0" * 64)
+    with pytest.raises(ValueError):
+        blob_service.put(b"other", "image/jpeg", storage="ftp")
+
+
+def test_blob_cache_evicts_least_recently_used_by_size():
+    cache = blob_service.BlobCache(10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa" and cache.get("c") == b"cccc"
+    # 单个超过上限的不缓存
+    cache.put("d", b"d" * 11)
+    assert cache.get("d") is None
+    assert cache.stats() == {"hits": 3, "misses": 2, "evictions": 1, "size": 2, "bytes": 8}
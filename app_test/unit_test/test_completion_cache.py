@@ -0,0 +1,124 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+from app.service import llm
+from app.service.llm import CompletionCache
+
+
+def _counting(value="ok", before_return=None):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        if before_return is not None:
+            before_return()
+        return value
+
+    return compute, calls
+
+
+def _until_coalesced(cache, count):
+    """上游调用一直挂着，直到 count 个调用方都在等它的结果"""
+    ready = Event()
+
+    def wait():
+        while cache.stats()["coalesced"] < count and not ready.wait(0.01):
+            pass
+
+    return wait
+
+
+def test_cached_ignores_whitespace_differences():
+    cache = CompletionCache(8, 60)
+    calls = []
+
+    @cache.cached("m", temperature=0)
+    def consider(prompt):
+        calls.append(prompt)
+        return prompt.strip()
+
+    assert consider("  hello   world ") == "hello   world"
+    assert consider("hello world") == "hello   world"
+    assert len(calls) == 1
+    assert CompletionCache.key("m", {"t": 0}, "p") != CompletionCache.key("m", {"t": 1}, "p")
+
+
+def test_concurrent_misses_share_one_upstream_call():
+    cache = CompletionCache(8, 60)
+    compute, calls = _counting(before_return=_until_coalesced(cache, 4))
+
+    with ThreadPoolExecutor(5) as pool:
+        results = list(pool.map(lambda _: cache.get_or_compute("k", "m", compute), range(5)))
+
+    assert results == ["ok"] * 5
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_errors_reach_waiters_and_are_not_cached():
+    cache = CompletionCache(8, 60)
+    started = Event()
+    coalesced = _until_coalesced(cache, 1)
+
+    def failing():
+        started.set()
+        coalesced()
+        raise RuntimeError("upstream")
+
+    with ThreadPoolExecutor(2) as pool:
+        owner = pool.submit(cache.get_or_compute, "k", "m", failing)
+        started.wait(1)
+        waiter = pool.submit(cache.get_or_compute, "k", "m", lambda: "unused")
+        for future in (owner, waiter):
+            with pytest.raises(RuntimeError):
+                future.result(timeout=3)
+
+    assert cache.get_or_compute("k", "m", lambda: "retried") == "retried"
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(llm, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    cache = CompletionCache(8, 1)
+    compute, calls = _counting()
+    cache.get_or_compute("k", "m", compute)
+    now[0] += 0.9
+    cache.get_or_compute("k", "m", compute)
+    assert len(calls) == 1
+
+    now[0] += 0.2
+    cache.get_or_compute("k", "m", compute)
+    assert len(calls) == 2
+
+
+def test_ttl_of_zero_and_lru_eviction():
+    cache = CompletionCache(2, 60, ttl_of=lambda value: 0 if value == "" else 60)
+    compute, calls = _counting(value="")
+    cache.get_or_compute("empty", "m", compute)
+    cache.get_or_compute("empty", "m", compute)
+    assert len(calls) == 2
+
+    for key in ("a", "b", "c"):
+        cache.get_or_compute(key, "m", lambda: key)
+    assert cache.stats()["size"] == 2
+    assert cache.get_or_compute("a", "m", lambda: "recomputed") == "recomputed"
+
+
+def test_async_concurrent_misses_share_one_upstream_call():
+    cache = CompletionCache(8, 60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "ok"
+
+    async def main():
+        return await asyncio.gather(*[cache.aget_or_compute("k", "m", compute) for _ in range(5)])
+
+    assert asyncio.run(main()) == ["ok"] * 5
+    assert len(calls) == 1
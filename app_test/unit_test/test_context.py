@@ -0,0 +1,34 @@
+from app.service.context import ContextBuilder, heuristic_tokens
+
+
+def _chars(text):
+    return len(text)
+
+
+def test_heuristic_tokens_counts_cjk_per_char():
+    assert heuristic_tokens("") == 0
+    assert heuristic_tokens("你好") == 2
+    assert heuristic_tokens("abcdefgh") == 2
+
+
+def test_reserve_is_never_trimmed():
+    builder = ContextBuilder(budget=5, estimate=_chars)
+    assert builder.reserve("question", "0123456789") == "0123456789"
+    assert builder.remaining == 0
+    assert builder.fit("histories", "abc") == ""
+
+
+def test_fit_trims_to_remaining_budget_keeping_head_or_tail():
+    builder = ContextBuilder(budget=10, estimate=_chars)
+    builder.reserve("system", "sys")
+    assert builder.fit("link", "abcdefghij", max_tokens=4) == "abcd"
+    assert builder.fit("histories", "0123456789", keep_tail=True) == "789"
+    assert builder.used == 10
+    assert builder.report() == "budget 10/10: system 3, link 4/10, histories 3/10"
+
+
+def test_fit_items_drops_whole_items_that_do_not_fit():
+    builder = ContextBuilder(budget=10, estimate=_chars)
+    kept = builder.fit_items("search", ["aaaa", "bbbbbbb", "cc", "dddd"])
+    assert kept == ["aaaa", "cc", "dddd"]
+    assert builder.remaining == 0
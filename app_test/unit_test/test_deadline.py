@@ -0,0 +1,42 @@
+import pytest
+from tenacity import wait_fixed
+
+from app.core.deadline import DeadlineExceeded, bounded_timeout, deadline, remaining, stop_at_deadline, wait_within_deadline
+
+
+def test_nested_deadline_keeps_the_earlier_one():
+    assert remaining() is None
+    with deadline(10):
+        with deadline(100):
+            assert remaining() <= 10
+        with deadline(1):
+            assert remaining() <= 1
+    assert remaining() is None
+
+
+def test_bounded_timeout_never_exceeds_remaining_time():
+    assert bounded_timeout(30) == 30
+    with deadline(5):
+        assert 0 < bounded_timeout(30) <= 5
+        assert bounded_timeout(1) == 1
+    with deadline(-1):
+        with pytest.raises(DeadlineExceeded):
+            bounded_timeout(30)
+
+
+def test_stop_at_deadline():
+    stop = stop_at_deadline()
+    assert not stop(None)
+    with deadline(5):
+        assert not stop(None)
+    with deadline(-1):
+        assert stop(None)
+
+
+def test_wait_within_deadline_caps_backoff():
+    wait = wait_within_deadline(wait_fixed(30))
+    assert wait(None) == 30
+    with deadline(5):
+        assert 0 < wait(None) <= 5
+    with deadline(-1):
+        assert wait(None) == 0
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+from app.core.deadline import DeadlineExceeded, deadline
+from app.service.llm import RequestHedger
+
+
+def _hedger(slots=4):
+    hedger = RequestHedger(True, quantile=0.5, min_delay=0.01, pool=ThreadPoolExecutor(4), slots=slots, min_samples=1)
+    hedger._record("m", 0.01)
+    return hedger
+
+
+def _slow_then_fast(release):
+    """第一次调用一直等到 release，之后的调用立即返回"""
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(3)
+            return "primary"
+        return "backup"
+
+    return call, calls
+
+
+def test_no_hedge_without_latency_samples():
+    hedger = RequestHedger(True, quantile=0.5, min_delay=0.01, pool=ThreadPoolExecutor(1), slots=1)
+    assert hedger.delay("m") is None
+    assert hedger.run("m", lambda: "ok") == "ok"
+    assert hedger.stats()["hedged"] == 0
+
+
+def test_backup_wins_when_primary_is_slow():
+    release = Event()
+    hedger = _hedger()
+    call, calls = _slow_then_fast(release)
+
+    assert hedger.run("m", call) == "backup"
+    release.set()
+    assert len(calls) == 2
+    assert {k: hedger.stats()[k] for k in ("hedged", "hedge_wins")} == {"hedged": 1, "hedge_wins": 1}
+
+
+def test_fast_primary_is_not_hedged():
+    hedger = _hedger()
+    assert hedger.run("m", lambda: "primary") == "primary"
+    assert hedger.stats()["hedged"] == 0
+
+
+def test_runs_inline_without_hedge_when_pool_is_busy():
+    hedger = _hedger(slots=0)
+    assert hedger.run("m", lambda: threading.current_thread().name) == threading.current_thread().name
+    assert hedger.stats()["inline"] == 1
+    assert hedger.stats()["hedged"] == 0
+
+
+def test_wait_is_bounded_by_deadline():
+    release = Event()
+    hedger = _hedger()
+
+    with deadline(0.1):
+        with pytest.raises(DeadlineExceeded):
+            hedger.run("m", lambda: release.wait(3))
+    release.set()
+
+
+def test_arun_backup_wins_and_wait_is_bounded_by_deadline():
+    hedger = _hedger()
+
+    async def main():
+        release = asyncio.Event()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            if len(calls) == 1:
+                await release.wait()
+                return "primary"
+            return "backup"
+
+        assert await hedger.arun("m", call) == "backup"
+        with deadline(0.1):
+            with pytest.raises(DeadlineExceeded):
+                await hedger.arun("m", release.wait)
+
+    asyncio.run(main())
+    assert hedger.stats()["hedge_wins"] == 1
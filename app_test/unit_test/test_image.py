@@ -0,0 +1,60 @@
+import io
+
+import pytest
+from PIL import Image
+
+from app.service.image import process_image
+
+
+def _encode(img, format_, **params):
+    bio = io.BytesIO()
+    img.save(bio, format=format_, **params)
+    return bio.getvalue()
+
+
+def test_jpeg_is_scaled_down_and_rotated_by_exif():
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    raw = _encode(Image.new("RGB", (2000, 1000), (200, 10, 10)), "JPEG", exif=exif.tobytes())
+
+    result = process_image(raw, 512, "JPEG", 75)
+
+    # 方向 6 需要旋转 90 度，摆正后是竖图
+    assert (result.original_width, result.original_height) == (1000, 2000)
+    assert (result.width, result.height) == (256, 512)
+    assert Image.open(io.BytesIO(result.data)).size == (256, 512)
+    assert result.content_type == "image/jpeg"
+
+
+def test_small_images_are_not_upscaled():
+    result = process_image(_encode(Image.new("RGB", (100, 50)), "PNG"), 512, "JPEG", 75)
+    assert (result.width, result.height) == (100, 50)
+
+
+def test_alpha_is_flattened_on_white_for_jpeg_and_kept_for_webp():
+    raw = _encode(Image.new("RGBA", (64, 64), (0, 0, 0, 0)), "PNG")
+
+    jpeg = Image.open(io.BytesIO(process_image(raw, 512, "JPEG", 90).data))
+    assert jpeg.mode == "RGB"
+    assert all(c > 240 for c in jpeg.getpixel((32, 32)))
+
+    webp = Image.open(io.BytesIO(process_image(raw, 512, "WEBP", 90).data))
+    assert webp.mode == "RGBA"
+    assert webp.getpixel((32, 32))[3] == 0
+
+
+def test_animated_gif_keeps_first_frame_and_counts_frames():
+    frames = [Image.new("RGB", (600, 300), color).convert("P") for color in ((255, 0, 0), (0, 0, 255), (0, 255, 0))]
+    raw = _encode(frames[0], "GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+
+    result = process_image(raw, 300, "JPEG", 90)
+
+    assert result.frames == 3
+    assert (result.width, result.height) == (300, 150)
+    r, g, b = Image.open(io.BytesIO(result.data)).getpixel((150, 75))
+    assert r > 200 and g < 50 and b < 50
+
+
+def test_unsupported_output_format():
+    with pytest.raises(ValueError):
+        process_image(_encode(Image.new("RGB", (10, 10)), "PNG"), 512, "BMP", 75)
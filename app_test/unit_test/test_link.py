@@ -0,0 +1,155 @@
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app.service import link as link_service
+from app.service.link import extract_main_text
+
+_PARAGRAPH = "<p>" + "正文内容很长的一段话。" * 10 + "</p>"
+
+
+def test_prefers_article_and_drops_boilerplate():
+    html = f"""
+    <html><head><title> 标题 </title><script>var x = 1;</script></head>
+    <body>
+      <nav>首页 | 新闻</nav>
+      <div class="sidebar">推荐阅读</div>
+      <article><h1>文章</h1>{_PARAGRAPH}</article>
+      <footer>版权所有</footer>
+    </body></html>
+    """
+    title, text = extract_main_text(html)
+
+    assert title == "标题"
+    assert text.startswith("文章\n正文内容")
+    for noise in ("首页", "推荐阅读", "版权所有", "var x"):
+        assert noise not in text
+
+
+def test_picks_element_with_most_paragraph_text():
+    html = f"""
+    <body>
+      <div id="comments"><p>评论一</p><p>评论二</p></div>
+      <div class="content">{_PARAGRAPH}{_PARAGRAPH}</div>
+    </body>
+    """
+    _, text = extract_main_text(html)
+
+    assert "正文内容" in text
+    assert "评论" not in text
+
+
+def test_keeps_wrapper_that_contains_the_main_content():
+    html = f'<body><div class="with-sidebar"><main>{_PARAGRAPH}</main></div></body>'
+    assert "正文内容" in extract_main_text(html)[1]
+
+
+def test_decode_falls_back_for_undeclared_gbk():
+    body = "中文页面".encode("gbk")
+    assert link_service._decode(body, link_service._detect_charset(None, body)) == "中文页面"
+    assert link_service._detect_charset(None, b'<meta charset="gb2312">') == "gb2312"
+
+
+def test_ensure_fetched_skips_messages_still_prefetching(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(link_service, "fetch_and_save", lambda id_, url: fetched.append(id_))
+    monkeypatch.setitem(link_service._pending, 1, Future())
+
+    link_service.ensure_fetched([SimpleNamespace(id=1, type_="link", content="https://example.com", message_extra=None)])
+
+    assert fetched == []
+
+
+class FakeCacheStorage:
+    """link_cache 表"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_entry(self, key):
+        return self.entries.get(key)
+
+    def save_entry(self, entry):
+        self.entries[entry.key] = entry
+
+    def refresh_entry(self, key, fetched_at, expires_at):
+        self.entries[key].fetched_at, self.entries[key].expires_at = fetched_at, expires_at
+
+
+@pytest.fixture
+def site(monkeypatch):
+    """一个带 ETag / Last-Modified 的页面，记录收到的请求头"""
+    site = SimpleNamespace(requests=[], gate=None, entered=Event())
+
+    def handler(request):
+        site.requests.append(request.headers)
+        if site.gate is not None:
+            site.entered.set()
+            assert site.gate.wait(3)
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        html = "<html><head><title>标题</title></head><body>" + _PARAGRAPH * 3 + "</body></html>"
+        headers = {"content-type": "text/html; charset=utf-8", "etag": '"v1"', "last-modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        return httpx.Response(200, headers=headers, content=html.encode("utf-8"))
+
+    site.storage = FakeCacheStorage()
+    monkeypatch.setattr(link_service, "http_client", httpx.Client(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(link_service, "link_cache_storage", site.storage)
+    monkeypatch.setattr(link_service, "_counters", {"hits": 0, "revalidated": 0, "fetched": 0})
+    return site
+
+
+def test_cached_fetch_reuses_fresh_entries_without_network(site):
+    first = link_service.cached_fetch("https://example.com/a?utm_source=x")
+    second = link_service.cached_fetch("https://example.com/a")
+
+    assert first.title == "标题" and first.etag == '"v1"'
+    assert second is first
+    assert len(site.requests) == 1
+    assert link_service.stats()["hits"] == 1
+
+
+def test_cached_fetch_revalidates_expired_entries(site):
+    entry = link_service.cached_fetch("https://example.com/a")
+    entry.expires_at = datetime.now() - timedelta(seconds=1)
+
+    revalidated = link_service.cached_fetch("https://example.com/a")
+
+    headers = site.requests[-1]
+    assert headers["if-none-match"] == '"v1"'
+    assert headers["if-modified-since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    # 304 时沿用缓存的正文，只延长过期时间
+    assert revalidated is entry and revalidated.text
+    assert revalidated.expires_at > datetime.now()
+    assert link_service.stats()["revalidated"] == 1
+
+
+def test_cached_fetch_coalesces_concurrent_requests(site, monkeypatch):
+    site.gate = Event()
+    joined = Event()
+
+    class Inflight(dict):
+        # 跟随者拿到领头线程的 future 时通知
+        def get(self, key, default=None):
+            future = super().get(key, default)
+            if future is not None:
+                joined.set()
+            return future
+
+    monkeypatch.setattr(link_service, "_inflight", Inflight())
+    results = []
+    threads = [Thread(target=lambda: results.append(link_service.cached_fetch("https://example.com/a"))) for _ in range(2)]
+    threads[0].start()
+    assert site.entered.wait(3)
+    threads[1].start()
+    assert joined.wait(3)
+    site.gate.set()
+    for t in threads:
+        t.join(3)
+
+    assert len(site.requests) == 1
+    assert len(results) == 2 and results[0] is results[1]
@@ -0,0 +1,37 @@
+from contextlib import contextmanager
+
+import pytest
+
+from app.api import message_api
+from app.errors import RateLimitException
+
+
+def _receive(content):
+    message_api.receive_msg(
+        from_username="u", to_username="bot", session_id="s1", is_group=False,
+        type_="text", content=content, uploaded_file=None,
+    )
+
+
+def test_remake_is_not_rejected_when_queue_is_full(monkeypatch):
+    added, sent = [], []
+
+    class Db:
+        def add_all(self, entities):
+            added.extend(entities)
+
+    @contextmanager
+    def session_scope():
+        yield Db()
+
+    monkeypatch.setattr(message_api, "session_scope", session_scope)
+    monkeypatch.setattr(message_api.msg_storage, "clear_messages", lambda db, session_id: None)
+    monkeypatch.setattr(message_api.message_receive_queue, "admit", lambda session_id, is_group: 5)
+    monkeypatch.setattr(message_api.message_reply_queue, "send", lambda *args: sent.append(args))
+
+    _receive("remake")
+    assert [m.is_clear for m in added] == [True, True]
+    assert sent[0][2] == "我已经忘了之前聊过的内容了"
+
+    with pytest.raises(RateLimitException):
+        _receive("hello")
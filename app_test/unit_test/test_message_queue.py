@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+import app.core
+from app.core import MessageReceiveQueue, MessageReplyQueue, ReplyItem, TimedList
+
+
+def _start(queue):
+    Thread(target=queue._proceed, daemon=True).start()
+    return queue
+
+
+def _wake(queue):
+    """时钟是假的，推进之后唤醒调度线程重新计算截止时间"""
+    with queue.cond:
+        queue.cond.notify()
+
+
+def test_timed_list_append_pushes_deadline():
+    tls_ = TimedList()
+    first = tls_.append(1, delay=1)
+    second = tls_.append(2, delay=1)
+    assert second - first == 1000
+    assert tls_.clear() == [1, 2]
+    assert len(tls_) == 0
+
+
+def test_receive_queue_debounces_session_messages(monkeypatch):
+    now = [1_000_000]
+    monkeypatch.setattr(app.core, "current_timestamp", lambda: now[0])
+    batches, handled = [], Event()
+
+    def handler(msgs):
+        batches.append(msgs)
+        handled.set()
+
+    queue = _start(MessageReceiveQueue(handler=handler, pool=ThreadPoolExecutor(2)))
+    for i in range(3):
+        queue.send("s1", i, delay=1)
+        now[0] += 500
+
+    # 每条消息把截止时间往后推 1 秒，最后一条之后还没到期
+    deadline = 1_000_000 + 3 * 1000
+    now[0] = deadline - 1
+    _wake(queue)
+    assert not handled.wait(0.1)
+
+    now[0] = deadline
+    _wake(queue)
+    assert handled.wait(3)
+    assert batches == [[0, 1, 2]]
+
+
+def test_receive_queue_keeps_session_order_and_never_overlaps():
+    lock = Lock()
+    running, overlapped, batches = set(), [], []
+    s1_started, release, all_done = Event(), Event(), Event()
+
+    def handler(msgs):
+        session_id = msgs[0][0]
+        with lock:
+            if session_id in running:
+                overlapped.append(session_id)
+            running.add(session_id)
+        if msgs == [("s1", 1)]:
+            s1_started.set()
+            release.wait(3)
+        with lock:
+            running.discard(session_id)
+            batches.append(msgs)
+            if len(batches) == 3:
+                all_done.set()
+
+    pool = ThreadPoolExecutor(4)
+    queue = _start(MessageReceiveQueue(handler=handler, pool=pool))
+    queue.send("s1", ("s1", 1), delay=0)
+    queue.send("s2", ("s2", 1), delay=0)
+    # s1 还在处理时到达的消息，等上一批结束后再调度
+    assert s1_started.wait(3)
+    queue.send("s1", ("s1", 2), delay=0)
+    queue.send("s1", ("s1", 3), delay=0)
+    release.set()
+
+    assert all_done.wait(3)
+    pool.shutdown(wait=True)
+    assert not overlapped
+    s1 = [m for batch in batches for m in batch if m[0] == "s1"]
+    assert s1 == [("s1", 1), ("s1", 2), ("s1", 3)]
+    assert queue.stats()["resident_sessions"] == 0
+
+
+class _CountingPool(ThreadPoolExecutor):
+    """派发了 count 批之后 set dispatched"""
+
+    def __init__(self, max_workers, count):
+        super().__init__(max_workers)
+        self.count = count
+        self.dispatched = Event()
+
+    def submit(self, *args, **kwargs):
+        future = super().submit(*args, **kwargs)
+        self.count -= 1
+        if self.count == 0:
+            self.dispatched.set()
+        return future
+
+
+def test_admit_counts_messages_waiting_for_a_worker(monkeypatch):
+    now = [1_000_000]
+    monkeypatch.setattr(app.core, "current_timestamp", lambda: now[0])
+    monkeypatch.setattr(app.core, "ADMISSION_MAX_QUEUED_MESSAGES", 5)
+    started, release = Event(), Event()
+
+    def handler(msgs):
+        if msgs == [0]:
+            started.set()
+            release.wait(3)
+
+    pool = _CountingPool(1, count=6)
+    queue = _start(MessageReceiveQueue(handler=handler, pool=pool))
+    queue.send("s0", 0, delay=0)
+    assert started.wait(3)
+    for i in range(1, 6):
+        queue.send(f"s{i}", i, delay=0)
+
+    # 都已经派发给线程池，但唯一的 worker 还被占着，仍然算积压
+    assert pool.dispatched.wait(3)
+    assert queue.stats()["queued_messages"] == 5
+    assert queue.admit("s9") is not None
+
+    now[0] += 5000
+    release.set()
+    pool.shutdown(wait=True)
+    stats = queue.stats()
+    assert stats["queued_messages"] == 0
+    assert stats["wait_ms_max"] == 5000
+    assert queue.admit("s9") is None
+    with queue.cond:
+        # 5 批各等了 5 秒，平均值按 0.9 衰减
+        assert queue._retry_after() == 3
+
+
+def test_reply_queue_sends_fifo_without_debounce():
+    sent, done = [], Event()
+
+    def handler(items):
+        sent.extend(items)
+        if len(sent) == 5:
+            done.set()
+
+    queue = _start(MessageReplyQueue(handler=handler, pool=ThreadPoolExecutor(2)))
+    for i in range(5):
+        queue.send("s1", i, f"reply {i}")
+
+    assert done.wait(3)
+    assert [item.msg_id for item in sent] == [0, 1, 2, 3, 4]
+
+
+def test_reply_queue_retry_goes_before_newer_replies():
+    sent, failed, done = [], [], Event()
+
+    def handler(items):
+        if not failed:
+            failed.extend(items)
+            # 发送失败期间又来了新的回复
+            queue.send("s1", 9, "newer")
+            queue.retry([i._replace(attempts=i.attempts + 1) for i in items], delay=0)
+            return
+        sent.extend(items)
+        if len(sent) == 3:
+            done.set()
+
+    queue = _start(MessageReplyQueue(handler=handler, pool=ThreadPoolExecutor(2)))
+    queue.send("s1", 1, "a")
+    queue.send("s1", 2, "b")
+
+    assert done.wait(3)
+    assert [(i.msg_id, i.attempts) for i in sent] == [(1, 1), (2, 1), (9, 0)]
+
+
+def test_reply_requeues_failed_batch_and_the_rest(monkeypatch):
+    from app.service import chatflow
+
+    states, retried, posted = [], [], []
+
+    def post(session_id, content):
+        if content == "b":
+            raise RuntimeError("callback down")
+        posted.append(content)
+
+    monkeypatch.setattr(chatflow, "CHAT_CALLBACK_BATCH_SIZE", 1)
+    monkeypatch.setattr(chatflow, "write_behind", None)
+    monkeypatch.setattr(chatflow, "_post_reply", post)
+    monkeypatch.setattr(chatflow.msg_storage, "claim_replies", lambda ids: list(ids))
+    monkeypatch.setattr(chatflow.msg_storage, "update_state", lambda ids, state: states.append((list(ids), state)))
+    monkeypatch.setattr(chatflow.message_reply_queue, "retry", lambda items, delay: retried.append((items, delay)))
+
+    chatflow.reply([ReplyItem("s1", i, c) for i, c in enumerate(["a", "b", "c"])])
+
+    assert posted == ["a"]
+    items, delay = retried[0]
+    assert [(i.msg_id, i.attempts) for i in items] == [(1, 1), (2, 1)]
+    assert delay == 2
+    assert states == [([0], chatflow.msg_storage.STATE_SENT), ([1, 2], chatflow.msg_storage.STATE_UNSENT)]
@@ -0,0 +1,139 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import app.core
+from app.core import MessageReceiveQueue, MessageReplyQueue
+from app.database import session_scope
+from app.model import message as msg_storage
+from app.model.message import Message
+
+
+@pytest.fixture
+def session_id(database):
+    session_id = f"test_{uuid.uuid4().hex}"
+    yield session_id
+    with session_scope() as db:
+        db.query(Message).filter(Message.session_id == session_id).delete(synchronize_session=False)
+
+
+def _add(session_id, state, age_seconds=0, claimed_seconds_ago=None):
+    now = datetime.now()
+    msg = Message(
+        type_="text", content=state, from_="u", to="bot", session_id=session_id,
+        is_group=False, is_clear=False, state=state, created_at=now - timedelta(seconds=age_seconds),
+        claimed_at=None if claimed_seconds_ago is None else now - timedelta(seconds=claimed_seconds_ago),
+    )
+    with session_scope() as db:
+        db.add(msg)
+    return msg.id
+
+
+def _states(ids):
+    with session_scope() as db:
+        return [m.state for m in db.query(Message).filter(Message.id.in_(ids)).order_by(Message.id)]
+
+
+def test_claim_only_once_and_only_from_expected_state(session_id):
+    pending = _add(session_id, msg_storage.STATE_PENDING)
+    unsent = _add(session_id, msg_storage.STATE_UNSENT)
+
+    assert msg_storage.claim_messages([pending, unsent]) == [pending]
+    assert msg_storage.claim_messages([pending]) == []
+    assert msg_storage.claim_replies([pending, unsent]) == [unsent]
+    assert _states([pending, unsent]) == [msg_storage.STATE_PROCESSING, msg_storage.STATE_SENDING]
+
+
+def test_recover_resets_stale_claims_and_skips_fresh_or_excluded(session_id):
+    old_pending = _add(session_id, msg_storage.STATE_PENDING, age_seconds=120)
+    new_pending = _add(session_id, msg_storage.STATE_PENDING)
+    stale = _add(session_id, msg_storage.STATE_PROCESSING, age_seconds=600, claimed_seconds_ago=300)
+    running = _add(session_id, msg_storage.STATE_PROCESSING, age_seconds=600, claimed_seconds_ago=10)
+    resident = _add(session_id, msg_storage.STATE_PENDING, age_seconds=120)
+    old_unsent = _add(session_id, msg_storage.STATE_UNSENT, age_seconds=120)
+    stale_sending = _add(session_id, msg_storage.STATE_SENDING, age_seconds=600, claimed_seconds_ago=300)
+
+    now = datetime.now()
+    inbound, outbound = msg_storage.recover_messages(
+        now - timedelta(seconds=60), now - timedelta(seconds=240), exclude={resident}
+    )
+
+    assert [m.id for m in inbound if m.session_id == session_id] == [old_pending, stale]
+    assert [m.id for m in outbound if m.session_id == session_id] == [old_unsent, stale_sending]
+    assert _states([old_pending, new_pending, stale, running, resident, old_unsent, stale_sending]) == [
+        msg_storage.STATE_PENDING,
+        msg_storage.STATE_PENDING,
+        msg_storage.STATE_PENDING,
+        msg_storage.STATE_PROCESSING,
+        msg_storage.STATE_PENDING,
+        msg_storage.STATE_UNSENT,
+        msg_storage.STATE_UNSENT,
+    ]
+
+
+def test_recover_does_not_requeue_messages_already_in_this_process(monkeypatch):
+    receive_queue, reply_queue = MessageReceiveQueue(), MessageReplyQueue()
+    receive_queue.send("s1", 1, delay=60)
+    reply_queue.send("s1", 2, "queued reply")
+    excluded = []
+
+    def recover_messages(before, stale_before, exclude=()):
+        excluded.extend(sorted(exclude))
+        return [], []
+
+    monkeypatch.setattr(app.core, "message_receive_queue", receive_queue)
+    monkeypatch.setattr(app.core, "message_reply_queue", reply_queue)
+    monkeypatch.setattr(msg_storage, "recover_messages", recover_messages)
+    app.core.recover()
+
+    assert excluded == [1, 2]
+    assert receive_queue.stats()["queued_messages"] == 1
+    assert reply_queue.stats()["queued_messages"] == 1
+
+
+def test_list_messages_defers_attachment_bytes_except_legacy_rows(session_id):
+    from sqlalchemy import inspect
+
+    from app.model.message import MessageExtra
+
+    def add_with_extra(**extra):
+        msg = Message(
+            type_="pic", content="", from_="u", to="bot", session_id=session_id,
+            is_group=False, is_clear=False, state=msg_storage.STATE_PENDING, created_at=datetime.now(),
+        )
+        msg.message_extra = MessageExtra(content_meta={}, **extra)
+        with session_scope() as db:
+            db.add(msg)
+        return msg.id
+
+    new = add_with_extra(blob_digest="0" * 64, content_bytes=b"unused")
+    legacy = add_with_extra(content_bytes=b"legacy")
+    with session_scope() as db:
+        messages = {m.id: m for m in msg_storage.list_messages(db, [new, legacy])}
+
+    assert "content_bytes" in inspect(messages[new].message_extra).unloaded
+    assert messages[legacy].message_extra.content_bytes == b"legacy"
+
+
+def test_load_messages_fetches_links_without_holding_a_connection(session_id, monkeypatch):
+    from app.database import engine, save_entity
+    from app.model.message import MessageExtra
+    from app.service import chatflow, link as link_service
+
+    link = _add(session_id, msg_storage.STATE_PROCESSING)
+    with session_scope() as db:
+        db.query(Message).filter(Message.id == link).update({"type_": "link", "content": "https://example.com"})
+    checked_out = []
+
+    def fetch_and_save(message_id, url):
+        checked_out.append(engine.pool.checkedout())
+        extra = MessageExtra(message_id=message_id, content_meta={"link": url}, content_bytes="页面正文".encode())
+        save_entity(extra)
+        return extra
+
+    monkeypatch.setattr(link_service, "fetch_and_save", fetch_and_save)
+    messages, _, _ = chatflow._load_messages([link])
+
+    assert checked_out == [0]
+    assert messages[0].message_extra.link_text == "页面正文"
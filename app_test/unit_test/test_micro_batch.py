@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.core.batch import MicroBatcher
+
+
+def test_flushes_when_batch_is_full():
+    batches = []
+
+    def handler(items):
+        batches.append(list(items))
+        return [i * 10 for i in items]
+
+    # 窗口足够长，只能靠攒满触发
+    batcher = MicroBatcher(handler, window_ms=10000, max_size=3, pool=ThreadPoolExecutor(2))
+    futures = [batcher.submit(i) for i in range(3)]
+
+    assert [f.result(timeout=3) for f in futures] == [0, 10, 20]
+    assert batches == [[0, 1, 2]]
+
+
+def test_flushes_partial_batch_when_window_ends():
+    # 攒不满，只能靠等待窗口结束触发
+    batcher = MicroBatcher(lambda items: items, window_ms=50, max_size=10, pool=ThreadPoolExecutor(2))
+    futures = [batcher.submit(i) for i in range(2)]
+
+    assert [f.result(timeout=3) for f in futures] == [0, 1]
+    assert batcher.stats()["batches"] == 1
+
+
+def test_handler_errors_and_wrong_result_count_reach_every_caller():
+    def handler(items):
+        if 0 in items:
+            raise RuntimeError("upstream")
+        return items[:1]
+
+    batcher = MicroBatcher(handler, window_ms=10000, max_size=2, pool=ThreadPoolExecutor(2))
+    failed = [batcher.submit(0), batcher.submit(1)]
+    mismatched = [batcher.submit(2), batcher.submit(3)]
+    for f in failed:
+        with pytest.raises(RuntimeError):
+            f.result(timeout=3)
+    for f in mismatched:
+        with pytest.raises(ValueError):
+            f.result(timeout=3)
@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.service import llm
+from app.service.llm import ModelRouter, RouteFeatures
+
+_MESSAGES = [llm.LlmMessage(role="user", content="你好")]
+
+
+def _result(content, finish_reason="stop"):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish_reason)])
+
+
+@pytest.fixture
+def router(monkeypatch):
+    router = ModelRouter("fast", "strong", short_chars=20)
+    monkeypatch.setattr(llm, "model_router", router)
+    return router
+
+
+@pytest.mark.parametrize(
+    "features, expected",
+    [
+        (RouteFeatures(type_="text", length=5), ("fast", "fast:short")),
+        (RouteFeatures(type_="text", length=21), ("strong", "strong:long")),
+        (RouteFeatures(type_="text", length=5, searched=True), ("strong", "strong:searched")),
+        (RouteFeatures(type_="link", length=5), ("strong", "strong:link")),
+        (RouteFeatures(type_="pic", length=5, has_images=True), ("strong", "strong:images")),
+    ],
+)
+def test_route(router, features, expected):
+    assert router.route(features) == expected
+    assert router.stats()["routes"] == {expected[1]: 1}
+
+
+@pytest.mark.parametrize(
+    "result, reason",
+    [
+        (_result("好的，没问题"), None),
+        (_result("  "), "empty"),
+        (_result(None), "empty"),
+        (_result("一半的回答", finish_reason="length"), "truncated"),
+        (_result("抱歉，我无法回答这个问题"), "refusal"),
+        (_result("I'm sorry, but"), "refusal"),
+    ],
+)
+def test_escalation_reason(router, result, reason):
+    assert router.escalation_reason("fast", result.choices[0]) == reason
+    # 强模型的回答不再升级
+    assert router.escalation_reason("strong", result.choices[0]) is None
+
+
+def test_routed_completion_escalates_to_the_strong_model(router, monkeypatch):
+    calls = []
+
+    def chat_completions(messages, model, **kwargs):
+        calls.append((model, kwargs))
+        return _result("抱歉，我不能回答") if model == "fast" else _result("回答")
+
+    monkeypatch.setattr(llm, "chat_completions", chat_completions)
+
+    result, model, route = llm.routed_chat_completions(_MESSAGES, RouteFeatures(type_="text", length=2), temperature=0.1)
+
+    assert (model, route) == ("strong", "fast:short>escalated:refusal")
+    assert result.choices[0].message.content == "回答"
+    assert calls == [("fast", {"temperature": 0.1}), ("strong", {"temperature": 0.1})]
+    assert {m: s["calls"] for m, s in router.stats()["models"].items()} == {"fast": 1, "strong": 1}
+
+
+def test_routed_completion_keeps_a_good_fast_answer(router, monkeypatch):
+    calls = []
+    monkeypatch.setattr(llm, "chat_completions", lambda messages, model, **kwargs: calls.append(model) or _result("回答"))
+
+    _, model, route = llm.routed_chat_completions(_MESSAGES, RouteFeatures(type_="text", length=2))
+
+    assert (model, route) == ("fast", "fast:short")
+    assert calls == ["fast"]
+
+
+def test_async_routed_completion_escalates_truncated_answers(router, monkeypatch):
+    calls = []
+
+    async def achat_completions(messages, model, **kwargs):
+        calls.append(model)
+        return _result("一半", finish_reason="length") if model == "fast" else _result("完整的回答")
+
+    monkeypatch.setattr(llm, "achat_completions", achat_completions)
+
+    _, model, route = asyncio.run(llm.arouted_chat_completions(_MESSAGES, RouteFeatures(type_="text", length=2)))
+
+    assert (model, route) == ("strong", "fast:short>escalated:truncated")
+    assert calls == ["fast", "strong"]
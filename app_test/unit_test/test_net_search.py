@@ -0,0 +1,75 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+from tenacity import wait_none
+
+from app.core.deadline import DeadlineExceeded, deadline
+from app.service import net_search
+
+_BODY = {
+    "choices": [{"message": {"tool_calls": [
+        {"search_intent": [{"category": "天气"}]},
+        {"search_result": [{"title": "t", "content": "c", "link": "https://example.com"}]},
+    ]}}]
+}
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    # 外层是搜索缓存，里面才是 tenacity 的重试
+    monkeypatch.setattr(net_search.aweb_search_pro_results.__wrapped__.retry, "wait", wait_none())
+
+
+def _client(failures):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) <= failures:
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200, json=_BODY)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), calls
+
+
+def test_async_search_retries_transport_errors(monkeypatch, no_backoff):
+    client, calls = _client(failures=2)
+    monkeypatch.setattr(net_search, "async_http_client", client)
+
+    intent, results = asyncio.run(net_search.aweb_search_pro_results(f"q {uuid.uuid4()}"))
+
+    assert intent == "天气" and results[0]["link"] == "https://example.com"
+    assert len(calls) == 3
+
+
+def test_async_search_does_not_retry_past_deadline(monkeypatch, no_backoff):
+    client, calls = _client(failures=10)
+    monkeypatch.setattr(net_search, "async_http_client", client)
+
+    async def search():
+        with deadline(-1):
+            return await net_search.aweb_search_pro_results(f"q {uuid.uuid4()}")
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(search())
+    assert calls == []
+
+
+def test_sync_search_uses_shared_client_and_retries(monkeypatch):
+    monkeypatch.setattr(net_search.web_search_pro_results.__wrapped__.retry, "wait", wait_none())
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(503)
+        return httpx.Response(200, json=_BODY)
+
+    monkeypatch.setattr(net_search, "http_client", httpx.Client(transport=httpx.MockTransport(handler)))
+
+    intent, results = net_search.web_search_pro_results(f"q {uuid.uuid4()}")
+
+    assert intent == "天气" and len(results) == 1
+    assert len(calls) == 2
@@ -0,0 +1,33 @@
+from app.service.rerank import bm25_scores, rerank, tokenize
+
+
+def test_tokenize_words_and_cjk_bigrams():
+    assert tokenize("Python 3 教程") == ["python", "3", "教程"]
+    assert tokenize("北京天气") == ["北京", "京天", "天气"]
+    assert tokenize("我 和 你") == ["我", "和", "你"]
+
+
+def test_rerank_puts_relevant_docs_first():
+    docs = [
+        "上海今天多云，气温 20 度",
+        "北京今天天气晴，北京气温 25 度",
+        "股票市场今日上涨",
+        "北京旅游攻略",
+    ]
+    assert rerank("北京天气", docs, 2) == [1, 3]
+
+
+def test_rerank_keeps_original_order_on_ties():
+    docs = ["无关 a", "无关 b", "无关 c"]
+    assert bm25_scores("北京", docs) == [0.0, 0.0, 0.0]
+    assert rerank("北京", docs, 2) == [0, 1]
+    assert rerank("北京", [], 3) == []
+
+
+def test_normalize_url_dedupes_equivalent_links():
+    from app.service.net_search import normalize_url
+
+    assert normalize_url("https://www.Example.com/a/?utm_source=x&b=2&a=1#top") == normalize_url(
+        "http://example.com/a?a=1&b=2"
+    )
+    assert normalize_url("https://example.com/a?id=1") != normalize_url("https://example.com/a?id=2")
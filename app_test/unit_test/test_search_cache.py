@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.service import net_search
+from app.service.net_search import SearchCache
+
+
+def test_normalize_query():
+    assert SearchCache.normalize("  北京  天气？？ ") == "北京 天气"
+    assert SearchCache.normalize("ＡＢＣ　News!") == "abc news"
+    # 只有标点时不去掉，全角仍转成半角
+    assert SearchCache.normalize("？") == "?"
+
+
+def test_equivalent_queries_hit_upstream_once_with_original_query():
+    cache = SearchCache(8, 60)
+    seen = []
+
+    @cache.search("test")
+    def search(query):
+        seen.append(query)
+        time.sleep(0.1)
+        return ["result"]
+
+    with ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(search, ["北京天气?", "北京天气？", "北京天气"]))
+
+    assert results == [["result"]] * 3
+    assert len(seen) == 1 and seen[0] in ("北京天气?", "北京天气？", "北京天气")
+
+
+def test_ttl_by_intent_and_empty_results_not_cached(monkeypatch):
+    monkeypatch.setitem(net_search._INTENT_TTL, "天气", 300)
+    assert net_search._search_ttl(("天气", [{"title": "t"}])) == 300
+    assert net_search._search_ttl(("闲聊", [{"title": "t"}])) == net_search.SEARCH_CACHE_TTL
+    assert net_search._search_ttl(("天气", [])) == 0
+    assert net_search._search_ttl([]) == 0
+
+    cache = SearchCache(8, 60, ttl_of=net_search._search_ttl)
+    calls = []
+
+    @cache.search("test")
+    def search(query):
+        calls.append(query)
+        return ("天气", [])
+
+    search("q")
+    search("q")
+    assert len(calls) == 2
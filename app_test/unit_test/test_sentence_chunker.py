@@ -0,0 +1,34 @@
+from app.service.llm import SentenceChunker
+
+
+def _chunks(deltas, min_chars):
+    chunker = SentenceChunker(min_chars)
+    chunks = [c for d in deltas for c in chunker.feed(d)]
+    tail = chunker.flush()
+    return chunks + ([tail] if tail else [])
+
+
+def test_paragraphs_are_always_split():
+    assert _chunks(["第一段。\n\n第二段"], min_chars=100) == ["第一段。", "第二段"]
+
+
+def test_sentences_split_only_after_min_chars():
+    text = "短句。再来一句比较长的话。最后一句"
+    assert _chunks([text], min_chars=8) == ["短句。再来一句比较长的话。", "最后一句"]
+    assert _chunks([text], min_chars=100) == [text]
+
+
+def test_split_across_deltas_waits_for_closing_quote():
+    # 句号在末尾时可能还有后引号没到
+    chunks = _chunks(["他说：“好的。", "”然后走了。", "结束"], min_chars=4)
+    assert chunks == ["他说：“好的。”", "然后走了。", "结束"]
+
+
+def test_english_period_needs_following_space():
+    assert _chunks(["Version 1.5 is out. Try it"], min_chars=5) == ["Version 1.5 is out.", "Try it"]
+
+
+def test_flush_returns_none_when_empty():
+    chunker = SentenceChunker(10)
+    assert chunker.feed("\n\n") == []
+    assert chunker.flush() is None
@@ -0,0 +1,93 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.database import session_scope
+from app.model import message as msg_storage
+from app.model import session_summary as summary_storage
+from app.model.message import Message
+from app.model.session_summary import SessionSummary
+from app.service import chatflow
+
+
+def _history(id_, content):
+    return Message(id=id_, type_="text", content=content, from_="u", created_at=datetime(2024, 1, 1, 10, 0))
+
+
+# 格式化后每条 60 多个字，超过 4 条才需要压缩
+_LONG = [_history(i, f"第 {i} 条消息，" + "很长的聊天内容" * 4) for i in range(1, 11)]
+_QUESTION = [Message(type_="text", content="问题", from_="u")]
+
+
+def _histories(previous, summary):
+    prompts = []
+
+    def consider(prompt):
+        prompts.append(prompt)
+        return "压缩后的记录"
+
+    graph = chatflow._pre_completion_graph(_QUESTION, previous, summary, False, consider, lambda q: None)
+    return graph.run(ThreadPoolExecutor(2))["histories"].result(timeout=3), prompts
+
+
+def test_short_histories_are_used_as_is():
+    previous = _LONG[:2]
+    assert _histories(previous, None) == (chatflow._format_histories(previous), [])
+    assert not chatflow._summary_outdated(previous, None)
+
+
+def test_without_summary_all_histories_are_compressed():
+    histories, prompts = _histories(_LONG, None)
+
+    assert histories == "压缩后的记录"
+    assert len(prompts) == 1 and "第 1 条" in prompts[0] and "第 10 条" in prompts[0]
+    assert chatflow._summary_outdated(_LONG, None)
+
+
+def test_up_to_date_summary_is_used_without_calling_llm():
+    summary = SessionSummary(summary="之前的总结", last_message_id=10)
+
+    assert _histories(_LONG, summary) == ("之前的总结", [])
+    assert not chatflow._summary_outdated(_LONG, summary)
+
+
+def test_only_new_messages_are_folded_into_the_summary():
+    summary = SessionSummary(summary="之前的总结", last_message_id=8)
+
+    histories, prompts = _histories(_LONG, summary)
+
+    assert histories == "压缩后的记录"
+    assert "之前的总结" in prompts[0]
+    assert "第 9 条" in prompts[0] and "第 10 条" in prompts[0]
+    assert "第 8 条" not in prompts[0]
+    assert chatflow._summary_outdated(_LONG, summary)
+
+
+@pytest.fixture
+def session_id(database):
+    session_id = f"test_{uuid.uuid4().hex}"
+    yield session_id
+    with session_scope() as db:
+        db.query(Message).filter(Message.session_id == session_id).delete(synchronize_session=False)
+        summary_storage.delete_summary(db, session_id)
+
+
+def test_save_summary_replaces_the_previous_one(session_id):
+    summary_storage.save_summary(session_id, "第一版", 3)
+    summary_storage.save_summary(session_id, "第二版", 7)
+
+    summary = summary_storage.get_summary(session_id, datetime.now() - timedelta(minutes=1))
+    assert (summary.summary, summary.last_message_id) == ("第二版", 7)
+    # 30 分钟内没更新过的总结不再使用
+    assert summary_storage.get_summary(session_id, datetime.now() + timedelta(minutes=1)) is None
+
+
+def test_remake_clears_the_summary(session_id):
+    summary_storage.save_summary(session_id, "总结", 3)
+
+    with session_scope() as db:
+        msg_storage.clear_messages(db, session_id)
+
+    assert summary_storage.get_summary(session_id, datetime.now() - timedelta(minutes=1)) is None
@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+import pytest
+
+from app.core.stage import StageGraph
+
+
+def _graph(order, fail=None, barrier=None):
+    def stage(name, value):
+        def fn(*deps):
+            if name == fail:
+                raise RuntimeError(name)
+            if barrier is not None and name in ("b", "c"):
+                # b、c 互相等待，只有并发执行时才能都通过
+                barrier.wait(3)
+            order.append(name)
+            return value + sum(deps)
+
+        return fn
+
+    return (
+        StageGraph()
+        .add("a", stage("a", 1))
+        .add("b", stage("b", 10), deps=("a",))
+        .add("c", stage("c", 100), deps=("a",))
+        .add("d", stage("d", 1000), deps=("b", "c"))
+    )
+
+
+def test_add_rejects_unknown_dependency():
+    with pytest.raises(ValueError):
+        StageGraph().add("b", lambda a: a, deps=("a",))
+
+
+def test_run_respects_dependencies():
+    order = []
+    futures = _graph(order).run(ThreadPoolExecutor(4))
+
+    assert futures["d"].result(timeout=3) == 1000 + (10 + 1) + (100 + 1)
+    assert order[0] == "a" and order[-1] == "d"
+    assert set(order[1:3]) == {"b", "c"}
+
+
+def test_run_runs_independent_stages_concurrently():
+    graph = _graph([], barrier=Barrier(2))
+    graph.run(ThreadPoolExecutor(4))["d"].result(timeout=3)
+
+    b, c = graph.timings["b"], graph.timings["c"]
+    assert b[0] < c[1] and c[0] < b[1]
+
+
+def test_run_propagates_errors_downstream():
+    order = []
+    futures = _graph(order, fail="b").run(ThreadPoolExecutor(4))
+
+    with pytest.raises(RuntimeError, match="b"):
+        futures["d"].result(timeout=3)
+    assert futures["c"].result(timeout=3) == 101
+    assert "d" not in order
+
+
+def test_arun_awaits_async_stages_and_propagates_errors():
+    async def double(x):
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def main():
+        graph = StageGraph().add("a", lambda: 2).add("b", double, deps=("a",)).add("c", lambda b: 1 / 0, deps=("b",))
+        tasks = graph.arun()
+        assert await tasks["b"] == 4
+        with pytest.raises(ZeroDivisionError):
+            await tasks["c"]
+        assert graph.critical_path("c") == ["a", "b", "c"]
+
+    asyncio.run(main())
+
+
+def test_speculative_search_is_dropped_when_pool_is_busy(monkeypatch):
+    from threading import BoundedSemaphore, Event
+
+    from app.service import chatflow
+
+    release = Event()
+    monkeypatch.setattr(chatflow, "_speculative_slots", BoundedSemaphore(1))
+
+    def search(question):
+        release.wait(3)
+        return question
+
+    first = chatflow._speculate(search, "q1")
+    assert first is not None
+    assert chatflow._speculate(search, "q2") is None
+    release.set()
+    assert first.result(timeout=3) == "q1"
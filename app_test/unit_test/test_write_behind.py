@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from types import SimpleNamespace
+
+import pytest
+
+from app.core.write_behind import WriteBehind
+from app.database import SequenceAllocator
+
+
+class Unavailable(Exception):
+    pass
+
+
+def test_flush_writes_in_order_in_batches_of_max_size():
+    batches = []
+    wb = WriteBehind("test", batches.append, interval_ms=10000, max_size=3)
+    for i in range(7):
+        wb.add(i)
+    wb.flush()
+
+    assert [i for b in batches for i in b] == list(range(7))
+    assert all(len(b) <= 3 for b in batches)
+    assert wb.stats()["pending"] == 0
+
+
+def test_background_thread_flushes_after_interval():
+    written, flushed = [], Event()
+
+    def writer(batch):
+        written.extend(batch)
+        flushed.set()
+
+    wb = WriteBehind("test", writer, interval_ms=50, max_size=100)
+    wb.add("a")
+
+    assert flushed.wait(3)
+    assert written == ["a"]
+
+
+def test_retryable_errors_keep_the_batch_for_next_flush():
+    down, written = [True], []
+
+    def writer(batch):
+        if down[0]:
+            raise Unavailable()
+        written.extend(batch)
+
+    wb = WriteBehind("test", writer, interval_ms=10000, max_size=10, retryable=(Unavailable,))
+    wb.add(1)
+    wb.add(2)
+    with pytest.raises(RuntimeError):
+        wb.flush()
+    assert wb.stats()["pending"] == 2
+
+    down[0] = False
+    wb.add(3)
+    wb.flush()
+    assert written == [1, 2, 3]
+
+
+def test_bad_rows_are_dropped_one_by_one():
+    written = []
+
+    def writer(batch):
+        if "bad" in batch:
+            raise ValueError("constraint")
+        written.extend(batch)
+
+    wb = WriteBehind("test", writer, interval_ms=10000, max_size=10)
+    for item in ("a", "bad", "b"):
+        wb.add(item)
+    wb.flush()
+
+    assert written == ["a", "b"]
+    assert wb.stats()["dropped"] == 1
+
+
+def test_add_after_close_writes_directly():
+    written = []
+    wb = WriteBehind("test", written.extend, interval_ms=10000, max_size=10)
+    wb.add(1)
+    wb.close()
+    wb.add(2)
+    assert written == [1, 2]
+
+
+def test_sequence_allocator_hands_out_unique_ids_block_by_block(monkeypatch):
+    blocks = iter([[3, 1, 2], [4, 5, 6], [7, 8, 9]])
+    fetches = []
+
+    def fetch(self):
+        fetches.append(1)
+        return sorted(next(blocks))
+
+    monkeypatch.setattr(SequenceAllocator, "_fetch", fetch)
+    allocator = SequenceAllocator("message", block=3)
+
+    assert [allocator.next() for _ in range(4)] == [1, 2, 3, 4]
+    assert len(fetches) == 2
+
+    with ThreadPoolExecutor(4) as pool:
+        ids = list(pool.map(lambda _: allocator.next(), range(5)))
+    assert sorted(ids) == [5, 6, 7, 8, 9]
+
+
+def test_reply_is_posted_while_the_completion_insert_is_blocked(monkeypatch):
+    from app.core import ReplyItem
+    from app.service import chatflow
+
+    blocked, release, posted = Event(), Event(), Event()
+    writes, queued = [], []
+
+    def insert_all(entities):
+        if "completion" in entities:
+            blocked.set()
+            assert release.wait(3)
+        writes.extend(entities)
+
+    def claim_replies(ids):
+        raise AssertionError("本进程生成的回复不用到数据库抢占")
+
+    wb = WriteBehind("test", chatflow._write_rows, interval_ms=10000, max_size=10)
+    monkeypatch.setattr(chatflow, "write_behind", wb)
+    monkeypatch.setattr(chatflow, "insert_all", insert_all)
+    monkeypatch.setattr(chatflow, "reply_ids", SimpleNamespace(next=lambda: 42))
+    monkeypatch.setattr(chatflow, "message_reply_queue", SimpleNamespace(send=lambda *a, **kw: queued.append(ReplyItem(*a, **kw))))
+    monkeypatch.setattr(chatflow, "_post_reply", lambda session_id, content: posted.set())
+    monkeypatch.setattr(chatflow.msg_storage, "claim_replies", claim_replies)
+    monkeypatch.setattr(chatflow.msg_storage, "update_state", lambda ids, state: writes.append((ids, state)))
+
+    wb.add("completion")
+    flusher = Thread(target=wb.flush)
+    flusher.start()
+    assert blocked.wait(3)
+
+    chatflow._build_and_send_reply_msg("hi", "bot", "user", "s1", False)
+    sender = Thread(target=chatflow.reply, args=(queued,))
+    sender.start()
+    assert posted.wait(3)
+    sender.join(3)
+
+    release.set()
+    flusher.join(3)
+    wb.flush()
+    reply_msg = writes[1]
+    assert writes[0] == "completion" and reply_msg.id == 42
+    assert reply_msg.state == chatflow.msg_storage.STATE_SENDING
+    assert writes[2:] == [([42], chatflow.msg_storage.STATE_SENT)]